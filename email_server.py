@@ -10,7 +10,10 @@ from email import encoders
 import re
 import os
 from aiosmtpd.controller import Controller
-from email import message_from_bytes
+from src.async_smtp import SendLoop
+from src.mail_store import MailStore, StoreLocked
+from src.parsing import parse_headers
+from src.smtp_sender import SMTPSender
 
 class EmailHandler:
     """Handler for incoming SMTP messages"""
@@ -20,36 +23,22 @@ class EmailHandler:
     async def handle_DATA(self, server, session, envelope):
         """Process incoming email"""
         try:
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Parse email
-            msg = message_from_bytes(envelope.content)
+            # Only the headers are needed; the body is parsed when it is opened
+            msg = parse_headers(envelope.content)
             subject = msg.get('Subject', 'No Subject')
             
-            # Get body
-            if msg.is_multipart():
-                body = ''
-                for part in msg.walk():
-                    if part.get_content_type() == 'text/plain':
-                        body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        break
-            else:
-                body = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-            
-            # Store email
-            email_data = {
-                'time': timestamp,
+            # Store raw message; the body is extracted when it is opened
+            msg_id = self.gui.received_emails.append(envelope.content, {
                 'from': envelope.mail_from,
-                'to': ', '.join(envelope.rcpt_tos),
-                'subject': subject,
-                'body': body,
+                'to': envelope.rcpt_tos,
+                'subject': str(subject),
                 'peer': session.peer
-            }
+            })
             
-            self.gui.received_emails.append(email_data)
+            record = self.gui.received_emails.get(msg_id)
             
             # Update GUI (thread-safe)
-            self.gui.root.after(0, self.gui.add_email_to_inbox, email_data)
+            self.gui.root.after(0, self.gui.add_email_to_inbox, record)
             self.gui.root.after(0, self.gui.log, 
                 f"Received email from {envelope.mail_from} - Subject: {subject}")
             
@@ -64,14 +53,28 @@ class EmailServerGUI:
         self.root.title("Python Email Server")
         self.root.geometry("950x750")
         
-        self.received_emails = []
+        self.received_emails = MailStore()
         self.server_running = False
         self.smtp_controller = None
         self.email_pattern = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
         self.attachments = []
+        # Sending runs here so the window stays responsive
+        self.send_loop = SendLoop()
+        self.send_loop.start()
+        self.send_job = None
         
         self.create_widgets()
-        
+        self.refresh_inbox()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+    
+    def on_close(self):
+        """Stop the server and flush the mail store before exiting"""
+        if self.smtp_controller:
+            self.smtp_controller.stop()
+        self.send_loop.stop()
+        self.received_emails.close()
+        self.root.destroy()
+    
     def create_widgets(self):
         # Create notebook for tabs
         notebook = ttk.Notebook(self.root)
@@ -91,7 +94,7 @@ class EmailServerGUI:
         inbox_frame = ttk.Frame(notebook)
         notebook.add(inbox_frame, text='Inbox')
         self.create_inbox_tab(inbox_frame)
-        
+    
     def create_server_tab(self, parent):
         # Server controls
         control_frame = ttk.LabelFrame(parent, text="Server Control", padding=10)
@@ -122,7 +125,7 @@ class EmailServerGUI:
         
         self.log_text = scrolledtext.ScrolledText(log_frame, height=20, wrap=tk.WORD)
         self.log_text.pack(fill='both', expand=True)
-        
+    
     def create_send_tab(self, parent):
         # Create scrollable frame
         canvas = tk.Canvas(parent)
@@ -262,13 +265,16 @@ class EmailServerGUI:
         self.send_btn = ttk.Button(button_frame, text="Send Email", 
                                    command=self.send_email)
         self.send_btn.pack(side='left', padx=5)
+        self.cancel_btn = ttk.Button(button_frame, text="Cancel",
+                                     command=self.cancel_send, state='disabled')
+        self.cancel_btn.pack(side='left', padx=5)
         
         fields_frame.columnconfigure(1, weight=1)
         fields_frame.rowconfigure(6, weight=1)
         
         # Initially hide external config
         self.toggle_smtp_config()
-        
+    
     def create_inbox_tab(self, parent):
         inbox_frame = ttk.Frame(parent, padding=10)
         inbox_frame.pack(fill='both', expand=True)
@@ -316,7 +322,7 @@ class EmailServerGUI:
         
         self.content_text = scrolledtext.ScrolledText(content_frame, height=10, wrap=tk.WORD)
         self.content_text.pack(fill='both', expand=True)
-        
+    
     def log(self, message):
         timestamp = datetime.now().strftime('%H:%M:%S')
         self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
@@ -351,13 +357,17 @@ class EmailServerGUI:
         
         try:
             port = int(port)
-            self.log(f"Testing connection to {server}:{port}...")
-            
-            smtp = smtplib.SMTP(server, port, timeout=10)
-            smtp.starttls()
-            smtp.login(email, password)
-            smtp.quit()
-            
+        except ValueError:
+            messagebox.showerror("Error", f"Invalid port: {port}")
+            return
+        self.log(f"Testing connection to {server}:{port}...")
+        job = self.send_loop.submit(SMTPSender.check_login_async(server, port, email, password))
+        job.add_done_callback(lambda job: self.root.after(0, self.connection_tested, job))
+    
+    def connection_tested(self, job):
+        """Report the outcome of test_smtp_connection()"""
+        try:
+            job.result()
             messagebox.showinfo("Success", "SMTP connection successful!")
             self.log("SMTP connection test successful")
         except smtplib.SMTPAuthenticationError:
@@ -366,7 +376,7 @@ class EmailServerGUI:
         except Exception as e:
             messagebox.showerror("Error", f"Connection failed: {str(e)}")
             self.log(f"SMTP connection failed: {str(e)}")
-        
+    
     def start_server(self):
         host = self.host_entry.get().strip()
         
@@ -395,7 +405,7 @@ class EmailServerGUI:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start server: {str(e)}")
             self.log(f"Error starting server: {str(e)}")
-        
+    
     def run_server(self, host, port):
         """Run SMTP server in background thread"""
         try:
@@ -406,7 +416,7 @@ class EmailServerGUI:
             self.root.after(0, self.log, f"Server error: {str(e)}")
             self.root.after(0, messagebox.showerror, "Server Error", str(e))
             self.root.after(0, self.reset_server_ui)
-        
+    
     def stop_server(self):
         self.log("Stopping server...")
         try:
@@ -467,7 +477,7 @@ class EmailServerGUI:
         self.message_text.delete('1.0', tk.END)
         self.clear_attachments()
         self.log("Form cleared")
-        
+    
     def send_email(self):
         sender = self.from_entry.get().strip()
         recipient = self.to_entry.get().strip()
@@ -536,144 +546,123 @@ class EmailServerGUI:
             # Combine all recipients
             all_recipients = recipients + cc_list + bcc_list
             
-            # Send based on mode
+            # Route based on mode; the send loop does the network I/O
+            password = None
             if self.smtp_mode.get() == "local":
-                # Local mode - use local server
-                host = self.host_entry.get()
-                port = int(self.port_entry.get())
-                
-                server = smtplib.SMTP(host, port, timeout=10)
-                server.sendmail(sender, all_recipients, msg.as_string())
-                server.quit()
-                
-                messagebox.showinfo("Success", "Email sent successfully to local server!")
-                
+                route = {'mode': 'local', 'host': self.host_entry.get(),
+                         'port': int(self.port_entry.get())}
+            
             elif self.smtp_mode.get() == "direct":
-                # Direct mode - send directly to recipient's mail server
-                import dns.resolver
-                
-                sent_count = 0
-                failed = []
-                
-                for recipient_email in all_recipients:
-                    try:
-                        # Extract domain from email
-                        domain = recipient_email.split('@')[1]
-                        
-                        # Look up MX records
-                        self.log(f"Looking up MX records for {domain}...")
-                        mx_records = dns.resolver.resolve(domain, 'MX')
-                        mx_host = str(mx_records[0].exchange).rstrip('.')
-                        
-                        self.log(f"Connecting to {mx_host}:25 for {recipient_email}...")
-                        
-                        # Connect to recipient's mail server
-                        server = smtplib.SMTP(timeout=20)
-                        server.set_debuglevel(1)  # Show debug info
-                        
-                        # Try to connect
-                        try:
-                            server.connect(mx_host, 25)
-                        except Exception as conn_err:
-                            # Try port 587 if 25 fails
-                            self.log(f"Port 25 failed, trying port 587...")
-                            server.connect(mx_host, 587)
-                        
-                        # Try EHLO with a proper hostname
-                        server.ehlo('localhost.localdomain')
-                        
-                        # Try STARTTLS if available
-                        if server.has_extn('STARTTLS'):
-                            try:
-                                server.starttls()
-                                server.ehlo('localhost.localdomain')
-                            except:
-                                pass  # Continue without TLS
-                        
-                        # Send the email
-                        server.sendmail(sender, [recipient_email], msg.as_string())
-                        server.quit()
-                        
-                        sent_count += 1
-                        self.log(f"✓ Sent to {recipient_email}")
-                        
-                    except smtplib.SMTPRecipientsRefused as e:
-                        error_msg = f"Recipient refused (likely needs authentication)"
-                        failed.append(f"{recipient_email}: {error_msg}")
-                        self.log(f"✗ {recipient_email}: {error_msg}")
-                    except smtplib.SMTPSenderRefused as e:
-                        error_msg = f"Sender refused (server doesn't trust your address)"
-                        failed.append(f"{recipient_email}: {error_msg}")
-                        self.log(f"✗ {recipient_email}: {error_msg}")
-                    except ConnectionRefusedError:
-                        error_msg = "Connection refused (port 25 likely blocked by ISP)"
-                        failed.append(f"{recipient_email}: {error_msg}")
-                        self.log(f"✗ {recipient_email}: {error_msg}")
-                    except Exception as e:
-                        error_msg = str(e)
-                        failed.append(f"{recipient_email}: {error_msg}")
-                        self.log(f"✗ Failed to send to {recipient_email}: {error_msg}")
-                
-                if sent_count > 0:
-                    msg_text = f"Sent to {sent_count} recipient(s)!\n\n"
-                    msg_text += "Note: Email may be in spam folder or rejected by recipient's server."
-                    if failed:
-                        msg_text += f"\n\nFailed: {len(failed)}"
-                    messagebox.showinfo("Partial Success" if failed else "Success", msg_text)
-                else:
-                    error_summary = "\n".join(failed[:3])
-                    if "port 25" in error_summary.lower() or "connection refused" in error_summary.lower():
-                        msg_text = "Direct sending failed!\n\n"
-                        msg_text += "Common reasons:\n"
-                        msg_text += "• Your ISP blocks port 25 (most do)\n"
-                        msg_text += "• Mail servers require authentication\n"
-                        msg_text += "• Your IP is not trusted\n\n"
-                        msg_text += "Try using 'Gmail SMTP' mode instead."
-                    else:
-                        msg_text = f"Could not send to any recipients:\n\n{error_summary}"
-                    messagebox.showerror("Failed", msg_text)
-                    
+                route = {'mode': 'direct'}
+            
             else:
                 # External mode - use configured SMTP server
                 smtp_server = self.smtp_server_entry.get().strip()
                 smtp_port = int(self.smtp_port_entry.get())
                 smtp_email = self.smtp_email_entry.get().strip()
-                smtp_password = self.smtp_password_entry.get()
+                password = self.smtp_password_entry.get()
                 
-                if not all([smtp_server, smtp_email, smtp_password]):
+                if not all([smtp_server, smtp_email, password]):
                     messagebox.showerror("Error", "Please configure SMTP settings for external mode")
                     return
-                
-                server = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
-                server.starttls()
-                server.login(smtp_email, smtp_password)
-                server.sendmail(sender, all_recipients, msg.as_string())
-                server.quit()
-                
-                messagebox.showinfo("Success", f"Email sent successfully to {len(all_recipients)} recipient(s)!")
-            
-            self.log(f"Sent email to {recipient} - Subject: {subject}")
-            if self.attachments:
-                self.log(f"  with {len(self.attachments)} attachment(s)")
+                route = {'mode': 'external', 'host': smtp_server, 'port': smtp_port,
+                         'user': smtp_email}
             
-        except ConnectionRefusedError:
-            messagebox.showerror("Error", "Connection refused. Is the server running?")
-            self.log("Error: Connection refused - server may not be running")
-        except smtplib.SMTPAuthenticationError:
-            messagebox.showerror("Error", "Authentication failed. Check your email and password.\nFor Gmail, use an App Password.")
-            self.log("Error: SMTP authentication failed")
-        except TimeoutError:
-            messagebox.showerror("Error", "Connection timeout")
-            self.log("Error: Connection timeout")
+            logger = lambda message: self.root.after(0, self.log, message)
+            self.send_job = self.send_loop.submit(SMTPSender.deliver_async(
+                route, sender, all_recipients, msg.as_bytes(), logger,
+                password=password, progress=self.on_send_progress))
+            self.send_job.add_done_callback(
+                lambda job: self.root.after(0, self.send_finished, job, route['mode'],
+                                            all_recipients, recipient, subject))
+            self.send_btn.config(state='disabled')
+            self.cancel_btn.config(state='normal')
+            self.log(f"Sending email to {recipient} - Subject: {subject}")
+        
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send email: {str(e)}")
             self.log(f"Error sending email: {str(e)}")
-            
-    def add_email_to_inbox(self, email_data):
+    
+    def cancel_send(self):
+        """Abandon the email being sent"""
+        if self.send_job is not None:
+            self.send_job.cancel()
+    
+    def on_send_progress(self, recipient_email, error):
+        """Log the outcome for one recipient; called on the send loop"""
+        if error is None:
+            self.root.after(0, self.log, f"✓ Sent to {recipient_email}")
+        else:
+            self.root.after(0, self.log,
+                            f"✗ {recipient_email}: {SMTPSender.failure_reason(error)}")
+    
+    def send_finished(self, job, mode, all_recipients, recipient, subject):
+        """Report a finished send job to the user"""
+        self.send_job = None
+        self.send_btn.config(state='normal')
+        self.cancel_btn.config(state='disabled')
+        if job.cancelled():
+            self.log("Sending cancelled")
+            return
+        try:
+            errors = job.result()
+        except Exception as e:
+            errors = {recipient_email: e for recipient_email in all_recipients}
+        
+        if mode == "direct":
+            sent_count = len(all_recipients) - len(errors)
+            failed = [f"{recipient_email}: {SMTPSender.failure_reason(error)}"
+                      for recipient_email, error in errors.items()]
+            if sent_count > 0:
+                msg_text = f"Sent to {sent_count} recipient(s)!\n\n"
+                msg_text += "Note: Email may be in spam folder or rejected by recipient's server."
+                if failed:
+                    msg_text += f"\n\nFailed: {len(failed)}"
+                messagebox.showinfo("Partial Success" if failed else "Success", msg_text)
+            else:
+                error_summary = "\n".join(failed[:3])
+                if "port 25" in error_summary.lower() or "connection refused" in error_summary.lower():
+                    msg_text = "Direct sending failed!\n\n"
+                    msg_text += "Common reasons:\n"
+                    msg_text += "• Your ISP blocks port 25 (most do)\n"
+                    msg_text += "• Mail servers require authentication\n"
+                    msg_text += "• Your IP is not trusted\n\n"
+                    msg_text += "Try using 'Gmail SMTP' mode instead."
+                else:
+                    msg_text = f"Could not send to any recipients:\n\n{error_summary}"
+                messagebox.showerror("Failed", msg_text)
+        
+        elif len(errors) == len(all_recipients):
+            # The whole transaction failed; every recipient has the same error
+            error = next(iter(errors.values()))
+            if isinstance(error, ConnectionRefusedError):
+                messagebox.showerror("Error", "Connection refused. Is the server running?")
+                self.log("Error: Connection refused - server may not be running")
+            elif isinstance(error, smtplib.SMTPAuthenticationError):
+                messagebox.showerror("Error", "Authentication failed. Check your email and password.\nFor Gmail, use an App Password.")
+                self.log("Error: SMTP authentication failed")
+            elif isinstance(error, TimeoutError):
+                messagebox.showerror("Error", "Connection timeout")
+                self.log("Error: Connection timeout")
+            else:
+                messagebox.showerror("Error", f"Failed to send email: {str(error)}")
+                self.log(f"Error sending email: {str(error)}")
+            return
+        
+        elif mode == "local":
+            messagebox.showinfo("Success", "Email sent successfully to local server!")
+        else:
+            messagebox.showinfo("Success", f"Email sent successfully to {len(all_recipients) - len(errors)} recipient(s)!")
+        
+        self.log(f"Sent email to {recipient} - Subject: {subject}")
+        if self.attachments:
+            self.log(f"  with {len(self.attachments)} attachment(s)")
+    
+    def add_email_to_inbox(self, record):
         idx = len(self.received_emails)
         self.email_tree.insert('', 'end', text=str(idx), 
-                              values=(email_data['time'], email_data['from'], 
-                                     email_data['to'], email_data['subject']))
+                              values=(record.time, record.sender, 
+                                     record.to, record.subject))
         self.update_email_count()
     
     def update_email_count(self):
@@ -700,30 +689,36 @@ class EmailServerGUI:
         for item in self.email_tree.get_children():
             self.email_tree.delete(item)
         
-        for idx, email_data in enumerate(self.received_emails, 1):
+        for idx, record in enumerate(self.received_emails, 1):
             self.email_tree.insert('', 'end', text=str(idx), 
-                                  values=(email_data['time'], email_data['from'], 
-                                         email_data['to'], email_data['subject']))
+                                  values=(record.time, record.sender, 
+                                         record.to, record.subject))
         self.update_email_count()
         self.log("Inbox refreshed")
-        
+    
     def on_email_select(self, event):
         selection = self.email_tree.selection()
         if selection:
             item = self.email_tree.item(selection[0])
             idx = int(item['text']) - 1
             if 0 <= idx < len(self.received_emails):
-                email_data = self.received_emails[idx]
-                content = f"From: {email_data['from']}\n"
-                content += f"To: {email_data['to']}\n"
-                content += f"Subject: {email_data['subject']}\n"
-                content += f"Time: {email_data['time']}\n"
-                content += f"\n{email_data['body']}"
+                record = self.received_emails[idx]
+                content = f"From: {record.sender}\n"
+                content += f"To: {record.to}\n"
+                content += f"Subject: {record.subject}\n"
+                content += f"Time: {record.time}\n"
+                content += f"\n{record.body}"
                 
                 self.content_text.delete('1.0', tk.END)
                 self.content_text.insert('1.0', content)
 
 if __name__ == "__main__":
     root = tk.Tk()
-    app = EmailServerGUI(root)
-    root.mainloop()
+    try:
+        app = EmailServerGUI(root)
+    except StoreLocked as e:
+        root.withdraw()
+        messagebox.showerror("Error", str(e))
+        root.destroy()
+    else:
+        root.mainloop()
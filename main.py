@@ -5,13 +5,21 @@ Main entry point for the application
 """
 
 import tkinter as tk
+from tkinter import messagebox
 from src.gui import EmailServerGUI
+from src.mail_store import StoreLocked
 
 
 def main():
     """Main application entry point"""
     root = tk.Tk()
-    app = EmailServerGUI(root)
+    try:
+        app = EmailServerGUI(root)
+    except StoreLocked as e:
+        root.withdraw()
+        messagebox.showerror("Error", str(e))
+        root.destroy()
+        return
     root.mainloop()
 
 
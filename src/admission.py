@@ -0,0 +1,237 @@
+"""Connection admission control and per-peer rate limiting
+
+AdmissionControl decides whether a new SMTP session or a new message
+should be accepted. It caps the number of concurrent sessions overall and
+per peer IP, and keeps a connection and a message token bucket per peer.
+
+Peer state is dropped once a peer has been idle long enough for its
+buckets to be full again, at which point forgetting it changes nothing.
+Expiry runs on a timing wheel, so every event costs O(1) no matter how
+many peers have been seen.
+"""
+
+import math
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate`` tokens per second"""
+    
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+    
+    def refill(self, now):
+        """Add the tokens earned since the last call"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+    
+    def take(self, now, amount=1):
+        """Remove ``amount`` tokens if available, return whether it did"""
+        self.refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class TimingWheel:
+    """Expires keys ``timeout`` seconds after they were last touched
+
+    Keys live in one of a ring of slots, one per ``tick`` seconds. Touching
+    a key moves it to the slot that comes up again after at least
+    ``timeout``; advancing the clock empties the slots it passes.
+    """
+    
+    def __init__(self, timeout, tick=1.0, now=0.0):
+        self.tick = tick
+        # One extra slot because a key may be touched late in its tick
+        self.size = int(math.ceil(timeout / tick)) + 2
+        self._slots = [set() for _ in range(self.size)]
+        self._where = {}
+        self._current = int(now / tick)
+    
+    def __len__(self):
+        return len(self._where)
+    
+    def touch(self, key):
+        """(Re)schedule ``key`` to expire a full timeout from now"""
+        slot = (self._current - 1) % self.size
+        old = self._where.get(key)
+        if old == slot:
+            return
+        if old is not None:
+            self._slots[old].discard(key)
+        self._slots[slot].add(key)
+        self._where[key] = slot
+    
+    def advance(self, now):
+        """Move the clock to ``now`` and return the keys that expired"""
+        target = int(now / self.tick)
+        steps = min(target - self._current, self.size)
+        self._current = max(self._current, target)
+        expired = []
+        for i in range(steps):
+            slot = (self._current - i) % self.size
+            keys = self._slots[slot]
+            if keys:
+                self._slots[slot] = set()
+                for key in keys:
+                    del self._where[key]
+                expired.extend(keys)
+        return expired
+
+
+class PeerState:
+    """Limiter state for one peer IP"""
+    
+    def __init__(self, limits, now):
+        self.sessions = 0
+        self.connections = None
+        self.messages = None
+        self.configure(limits, now)
+    
+    def configure(self, limits, now):
+        """Set up the buckets for the rates of ``limits``, keeping the tokens left"""
+        self.connections = _bucket(self.connections, limits.connection_rate,
+                                   limits.connection_burst, now)
+        self.messages = _bucket(self.messages, limits.message_rate, limits.message_burst, now)
+
+
+def _bucket(old, rate, burst, now):
+    """A full TokenBucket, or None without a rate; tokens left in ``old`` carry over"""
+    if not rate:
+        return None
+    bucket = TokenBucket(rate, burst, now)
+    if old is not None:
+        old.refill(now)
+        bucket.tokens = min(burst, old.tokens)
+    return bucket
+
+
+class AdmissionControl:
+    """Session caps and per-peer token buckets for an SMTP server
+
+    Any limit left as None is not enforced. Rates are per second; a burst
+    defaults to one second's worth of tokens (at least one). The methods
+    take a lock, so listener groups on different event loop threads can
+    share an instance, as the draining group and its replacement do
+    after a restart.
+    """
+    
+    def __init__(self, max_sessions=None, peer_sessions=None,
+                 connection_rate=None, connection_burst=None,
+                 message_rate=None, message_burst=None,
+                 idle_timeout=60.0, clock=time.monotonic):
+        self.clock = clock
+        self.sessions = 0
+        self.refused_sessions = 0
+        self.refused_messages = 0
+        self._peers = {}
+        self._lock = threading.Lock()
+        self.configure(max_sessions, peer_sessions, connection_rate, connection_burst,
+                       message_rate, message_burst, idle_timeout)
+    
+    def configure(self, max_sessions=None, peer_sessions=None,
+                  connection_rate=None, connection_burst=None,
+                  message_rate=None, message_burst=None, idle_timeout=60.0):
+        """Replace the limits, as given to the constructor
+        
+        Open sessions stay counted and peers keep the tokens they have
+        left, up to the new bursts.
+        """
+        with self._lock:
+            self.max_sessions = max_sessions
+            self.peer_sessions = peer_sessions
+            self.connection_rate = connection_rate
+            self.connection_burst = connection_burst or max(1, connection_rate or 0)
+            self.message_rate = message_rate
+            self.message_burst = message_burst or max(1, message_rate or 0)
+            
+            # A peer may only be forgotten once its buckets have refilled
+            refill = max(self.connection_burst / connection_rate if connection_rate else 0,
+                         self.message_burst / message_rate if message_rate else 0)
+            self.idle_timeout = max(idle_timeout, refill)
+            
+            now = self.clock()
+            self._wheel = TimingWheel(self.idle_timeout, now=now)
+            for peer, state in self._peers.items():
+                state.configure(self, now)
+                self._wheel.touch(peer)
+    
+    @property
+    def enabled(self):
+        """True if any limit is configured"""
+        return any((self.max_sessions, self.peer_sessions,
+                    self.connection_rate, self.message_rate))
+    
+    def open_session(self, peer):
+        """Admit a new session from ``peer``
+
+        Returns None if the session may proceed, otherwise the reason it was
+        refused. Every admitted session must be released with close_session.
+        """
+        with self._lock:
+            state = self._state(peer)
+            if self.max_sessions and self.sessions >= self.max_sessions:
+                reason = "Too many connections"
+            elif self.peer_sessions and state.sessions >= self.peer_sessions:
+                reason = "Too many connections from your address"
+            elif state.connections and not state.connections.take(self.clock()):
+                reason = "Connection rate limit exceeded"
+            else:
+                self.sessions += 1
+                state.sessions += 1
+                return None
+            self.refused_sessions += 1
+            return reason
+    
+    def close_session(self, peer):
+        """Release a session admitted by open_session"""
+        with self._lock:
+            self.sessions -= 1
+            self._expire()
+            state = self._peers.get(peer)
+            if state is not None:
+                state.sessions -= 1
+                self._wheel.touch(peer)
+    
+    def allow_message(self, peer):
+        """Take a message token for ``peer``, return whether one was left"""
+        with self._lock:
+            state = self._state(peer)
+            if state.messages and not state.messages.take(self.clock()):
+                self.refused_messages += 1
+                return False
+            return True
+    
+    def stats(self):
+        """Current counters, e.g. for status displays"""
+        with self._lock:
+            return {
+                'sessions': self.sessions,
+                'peers': len(self._peers),
+                'refused_sessions': self.refused_sessions,
+                'refused_messages': self.refused_messages,
+            }
+    
+    def _state(self, peer):
+        """The PeerState of ``peer``, created if need be; lock held"""
+        self._expire()
+        state = self._peers.get(peer)
+        if state is None:
+            state = self._peers[peer] = PeerState(self, self.clock())
+        self._wheel.touch(peer)
+        return state
+    
+    def _expire(self):
+        for key in self._wheel.advance(self.clock()):
+            state = self._peers[key]
+            if state.sessions:
+                # Still connected; check again after another timeout
+                self._wheel.touch(key)
+            else:
+                del self._peers[key]
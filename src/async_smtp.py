@@ -0,0 +1,415 @@
+"""Asyncio SMTP client and a background loop to run sends on
+
+AsyncSMTP speaks SMTP over asyncio streams: EHLO, STARTTLS, AUTH PLAIN
+and LOGIN, and transactions whose DATA is streamed from a FlatMessage
+and whose envelope is built and read by mime_writer.Envelope, as in
+mime_writer.sendmail(). Failures raise the smtplib exception types, so
+callers tell temporary from permanent errors the same way on either
+path. STARTTLS needs StreamWriter.start_tls(), new in Python 3.11.
+AsyncSMTPPool is SMTPPool's session reuse on asyncio.
+
+SendLoop runs an event loop in a daemon thread, so code without one,
+such as the Tk main loop, can submit sends and keep running while they
+proceed.
+"""
+
+import asyncio
+import base64
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from src.mime_writer import Envelope, FlatMessage, data_blocks
+from src.smtp_pool import TRANSACTION_ERRORS, PooledSession, SessionPool
+
+
+DEFAULT_TIMEOUT = 10.0
+STOP_TIMEOUT = 5.0
+
+
+class AsyncSMTP:
+    """One SMTP client session on asyncio streams"""
+    
+    def __init__(self, local_hostname=None, timeout=DEFAULT_TIMEOUT):
+        self.local_hostname = local_hostname
+        self.timeout = timeout
+        self.host = None
+        self.reader = None
+        self.writer = None
+        self.esmtp_features = {}
+        self.greeted = False
+    
+    async def connect(self, host, port=25):
+        """Open the connection and read the greeting"""
+        if self.local_hostname is None:
+            loop = asyncio.get_running_loop()
+            self.local_hostname = await loop.run_in_executor(None, socket.getfqdn)
+        self.host = host
+        self.reader, self.writer = await self._wait(asyncio.open_connection(host, port),
+                                                    f"Connecting to {host}:{port}")
+        code, msg = await self.getreply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        return code, msg
+    
+    async def command(self, line):
+        """Send one command line and return its (code, message) reply"""
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected("Not connected")
+        self.writer.write(line.encode('ascii') + b'\r\n')
+        return await self.getreply()
+    
+    async def getreply(self):
+        """Read a possibly multi-line reply as (code, message)"""
+        lines = []
+        while True:
+            line = await self._wait(self.reader.readline(), "Waiting for a reply")
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip(b' \t\r\n'))
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+                break
+            if line[3:4] != b'-':
+                break
+        return code, b'\n'.join(lines)
+    
+    async def ehlo(self, name=None):
+        """Greet with EHLO, or HELO if the server does not speak ESMTP"""
+        self.esmtp_features = {}
+        code, msg = await self.command(f"EHLO {name or self.local_hostname}")
+        if code != 250:
+            code, msg = await self.command(f"HELO {name or self.local_hostname}")
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, msg)
+            self.greeted = True
+            return code, msg
+        self.greeted = True
+        for line in msg.decode('latin-1').split('\n')[1:]:
+            feature, _, params = line.partition(' ')
+            feature = feature.lower()
+            if feature == 'auth':
+                self.esmtp_features['auth'] = (self.esmtp_features.get('auth', '')
+                                               + ' ' + params).strip()
+            elif feature:
+                self.esmtp_features[feature] = params.strip()
+        return code, msg
+    
+    def has_extn(self, name):
+        return name.lower() in self.esmtp_features
+    
+    async def starttls(self, context=None):
+        """Upgrade the connection to TLS and greet again"""
+        if not self.greeted:
+            await self.ehlo()
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, msg = await self.command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, msg)
+        context = context or ssl.create_default_context()
+        await self._wait(self.writer.start_tls(context, server_hostname=self.host),
+                         "TLS handshake")
+        return await self.ehlo()
+    
+    async def login(self, user, password):
+        """Authenticate with AUTH PLAIN or LOGIN"""
+        if not self.greeted:
+            await self.ehlo()
+        if not self.has_extn('auth'):
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+        mechanisms = self.esmtp_features['auth'].upper().split()
+        if 'PLAIN' in mechanisms:
+            token = _b64(f"\0{user}\0{password}")
+            code, msg = await self.command(f"AUTH PLAIN {token}")
+        elif 'LOGIN' in mechanisms:
+            code, msg = await self.command(f"AUTH LOGIN {_b64(user)}")
+            if code == 334:
+                code, msg = await self.command(_b64(password))
+        else:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, msg)
+        return code, msg
+    
+    async def noop(self):
+        return await self.command('NOOP')
+    
+    async def rset(self):
+        return await self.command('RSET')
+    
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """Run one transaction like smtplib's sendmail(); returns the refused recipients
+
+        ``msg`` is a FlatMessage, bytes or an ASCII str; its DATA is
+        written a block at a time, waiting for the socket to drain.
+        """
+        if not isinstance(msg, FlatMessage):
+            msg = FlatMessage(msg.encode('ascii') if isinstance(msg, str) else msg)
+        if not self.greeted:
+            await self.ehlo()
+        envelope = Envelope(from_addr, to_addrs, msg.size, self.has_extn)
+        for batch in envelope.batches():
+            if self.writer is None:
+                raise smtplib.SMTPServerDisconnected("Not connected")
+            self.writer.write(batch)
+            while envelope.waiting():
+                envelope.reply(await self.getreply())
+        try:
+            refused = envelope.refused()
+        except smtplib.SMTPException:
+            if envelope.closing:
+                self.close()
+            else:
+                if envelope.data_open:
+                    # DATA was accepted anyway; end it with an empty message
+                    self.writer.write(b'.\r\n')
+                    await self.getreply()
+                await self._abort(0)
+            raise
+        
+        code, resp = envelope.data_reply() or await self.command('DATA')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        with msg.open() as f:
+            for block in data_blocks(f):
+                self.writer.write(block)
+                await self._wait(self.writer.drain(), "Sending the message")
+        code, resp = await self.getreply()
+        if code != 250:
+            await self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+    
+    async def quit(self):
+        """Say QUIT and close; closes regardless if the server is gone"""
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.close()
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+    
+    async def _abort(self, code):
+        """End a refused transaction; a 421 means the server is closing"""
+        if code == 421:
+            self.close()
+            return
+        try:
+            await self.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+    
+    async def _wait(self, awaitable, doing):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            raise TimeoutError(f"{doing} timed out after {self.timeout:g}s") from None
+
+
+class AsyncSMTPPool(SessionPool):
+    """Live AsyncSMTP sessions keyed by (host, port, user)
+
+    SMTPPool's rules and bookkeeping on asyncio: senders over the
+    ``max_connections`` limit wait on a Condition rather than a thread.
+    All calls must come from the one event loop the pool is used on.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Created on first use, on the loop the pool is used on
+        self._available = None
+    
+    @asynccontextmanager
+    async def session(self, host, port, user=None, password=None, starttls=False):
+        """Yield a connected, logged in AsyncSMTP, as SMTPPool.session() does"""
+        pooled = await self._acquire((host, port, user), password, starttls)
+        try:
+            yield pooled.smtp
+        except TRANSACTION_ERRORS:
+            await self._release(pooled, reset=True)
+            raise
+        except BaseException:
+            pooled.smtp.close()
+            await self._drop(pooled.key, discarded=1)
+            raise
+        else:
+            await self._release(pooled)
+    
+    async def sendmail(self, host, port, from_addr, to_addrs, msg, user=None, password=None,
+                       starttls=False):
+        """Send one message over a pooled session, retrying once on a new one if it was closed"""
+        for attempt in range(2):
+            try:
+                async with self.session(host, port, user, password, starttls) as smtp:
+                    return await smtp.sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+    
+    async def prune(self):
+        """Close sessions that have been idle for longer than idle_timeout"""
+        available = self._condition()
+        async with available:
+            stale = self._take_stale(time.monotonic())
+            if stale:
+                available.notify_all()
+        for pooled in stale:
+            await pooled.smtp.quit()
+    
+    async def close(self):
+        """Close every idle session; sessions in use are closed when returned"""
+        available = self._condition()
+        async with available:
+            idle = self._take_idle()
+            available.notify_all()
+        for pooled in idle:
+            await pooled.smtp.quit()
+    
+    def _condition(self):
+        if self._available is None:
+            self._available = asyncio.Condition()
+        return self._available
+    
+    async def _acquire(self, key, password, starttls):
+        await self.prune()
+        while True:
+            pooled = await self._checkout(key)
+            if pooled is None:
+                # A slot has been reserved for a new session
+                try:
+                    return await self._connect(key, password, starttls)
+                except BaseException:
+                    await self._drop(key)
+                    raise
+            if self._fresh(pooled) or await self._healthy(pooled):
+                self.reused += 1
+                return pooled
+            await self._discard(pooled)
+    
+    async def _checkout(self, key):
+        """Return an idle session for ``key``, or None with a slot reserved"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        available = self._condition()
+        async with available:
+            while True:
+                pooled = self._claim(key)
+                if pooled is not False:
+                    return pooled
+                now = loop.time()
+                if now >= deadline:
+                    raise self._busy(key)
+                try:
+                    await asyncio.wait_for(available.wait(), deadline - now)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def _connect(self, key, password, starttls):
+        host, port, user = key
+        smtp = AsyncSMTP(timeout=self.timeout)
+        await smtp.connect(host, port)
+        try:
+            if starttls:
+                await smtp.starttls()
+            if user:
+                await smtp.login(user, password)
+        except BaseException:
+            smtp.close()
+            raise
+        self.created += 1
+        return PooledSession(key, smtp)
+    
+    async def _healthy(self, pooled):
+        try:
+            return (await pooled.smtp.noop())[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+    
+    async def _release(self, pooled, reset=False):
+        pooled.messages += 1
+        if reset:
+            try:
+                await pooled.smtp.rset()
+            except (smtplib.SMTPException, OSError):
+                pooled.smtp.close()
+                await self._drop(pooled.key, discarded=1)
+                return
+        if not self._retired(pooled):
+            available = self._condition()
+            async with available:
+                if self._park(pooled):
+                    available.notify()
+                    return
+        await self._discard(pooled)
+    
+    async def _discard(self, pooled):
+        await self._drop(pooled.key, discarded=1)
+        await pooled.smtp.quit()
+    
+    async def _drop(self, key, discarded=0):
+        available = self._condition()
+        async with available:
+            self._forget(key, discarded)
+            available.notify()
+
+
+class SendLoop:
+    """An event loop in a daemon thread that runs sends for other threads
+
+    submit() schedules a coroutine on the loop and returns a
+    concurrent.futures.Future for it; cancelling that future cancels the
+    send.
+    """
+    
+    def __init__(self):
+        self.loop = None
+        self._thread = None
+    
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='smtp-send', daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Cancel the sends still running and end the loop thread"""
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def submit(self, coro):
+        """Run ``coro`` on the loop; returns a concurrent.futures.Future"""
+        if self._thread is None:
+            coro.close()
+            raise RuntimeError("Send loop is not running")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            # Let cancelled sends close their connections
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            self.loop.close()
+
+
+def _b64(text):
+    return base64.b64encode(text.encode('utf-8')).decode('ascii')
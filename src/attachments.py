@@ -0,0 +1,598 @@
+"""Content-addressed attachment storage
+
+Attachments are cut out of multipart messages when they are stored. Each
+decoded attachment is written once to a blob file named by its SHA-256
+digest, and the message keeps a stub part that points at the digest. The
+same report or binary received a thousand times therefore takes the disk
+space of one copy.
+
+Extraction streams: the message is read once, in chunks, every byte other
+than the attachment bodies is copied to the stored message unchanged, and
+each body is decoded straight into its blob file. Neither the message nor
+an attachment is ever held in memory whole.
+
+Blobs are reference counted by the messages that point at them and are
+deleted when the last such message goes away. The counts are saved on a
+clean shutdown; after a crash the mail store recounts them from its
+records.
+"""
+
+import binascii
+import functools
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from email import errors
+
+from src.parsing import CHUNK_SIZE, MAX_HEADER_SIZE, parse_headers
+
+
+ATTACHMENT_HEADER = 'X-Attachment-SHA256'
+REFCOUNT_FILE = 'refcounts.json'
+# Blobs being written; leftovers of a crash are removed on startup
+TMP_PREFIX = 'incoming-'
+# Longer lines are passed on in pieces rather than buffered whole
+MAX_LINE = 64 * 1024
+MAX_DEPTH = 32
+
+HEAD_END = re.compile(rb'(?m)^\r?\n')
+BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+NOT_BASE64 = bytes(sorted(set(range(256)) - set(BASE64_ALPHABET)))
+
+
+def blob_path(directory, digest):
+    """Path of the blob with ``digest`` under a blob directory"""
+    return os.path.join(directory, digest[:2], digest[2:])
+
+
+class BlobWriter:
+    """Temp file in a blob directory that hashes what is written to it
+    
+    finish() returns ``(digest, size, path, synced)`` for
+    AttachmentStore.add(); the tuple can be handed over from another
+    process.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        fd, self.path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=directory)
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self.size = 0
+    
+    def write(self, data):
+        self._hash.update(data)
+        self._file.write(data)
+        self.size += len(data)
+    
+    def finish(self):
+        """Close the file and return ``(digest, size, path, synced)``
+        
+        The data is flushed to disk unless the blob is stored already, in
+        which case add() only drops the file again.
+        """
+        digest = self._hash.hexdigest()
+        synced = not _intact(blob_path(self.directory, digest), self.size)
+        self._file.flush()
+        if synced:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        return digest, self.size, self.path, synced
+    
+    def discard(self):
+        self._file.close()
+        _remove(self.path)
+
+
+def discard_blobs(blobs):
+    """Delete finished blobs that were not added to a store"""
+    for _, _, path, _ in blobs:
+        _remove(path)
+
+
+class AttachmentStore:
+    """SHA-256 addressed blob files with reference counts"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._refs = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            if name.startswith(TMP_PREFIX):
+                os.remove(os.path.join(self.path, name))
+    
+    def __len__(self):
+        return len(self._refs)
+    
+    def put(self, data):
+        """Store ``data`` (or reference the existing copy), return its digest"""
+        writer = BlobWriter(self.path)
+        try:
+            writer.write(data)
+            blob = writer.finish()
+        except BaseException:
+            writer.discard()
+            raise
+        return self.add(blob)
+    
+    def add(self, blob):
+        """Take over a finished BlobWriter file and reference it, return its digest
+        
+        An existing copy is kept unless its size is wrong, which only a
+        write torn by a crash leaves behind; then it is replaced.
+        """
+        digest, size, tmp_path, synced = blob
+        path = self.blob_path(digest)
+        with self._lock:
+            if _intact(path, size):
+                os.remove(tmp_path)
+            else:
+                if not synced:
+                    _fsync(tmp_path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+        return digest
+    
+    def release(self, digest):
+        """Drop one reference; the blob is deleted with the last one"""
+        with self._lock:
+            count = self._refs.get(digest, 0) - 1
+            if count > 0:
+                self._refs[digest] = count
+                return
+            self._refs.pop(digest, None)
+            try:
+                os.remove(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+    
+    def get(self, digest):
+        """Return the content of a blob, or None if it is not stored"""
+        try:
+            with open(self.blob_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    
+    def refcount(self, digest):
+        return self._refs.get(digest, 0)
+    
+    def blob_path(self, digest):
+        return blob_path(self.path, digest)
+    
+    def stats(self):
+        """Number of blobs, references and bytes on disk"""
+        with self._lock:
+            digests = list(self._refs.items())
+        size = 0
+        for digest, _ in digests:
+            try:
+                size += os.path.getsize(self.blob_path(digest))
+            except OSError:
+                pass
+        return {
+            'blobs': len(digests),
+            'references': sum(count for _, count in digests),
+            'bytes': size,
+        }
+    
+    def has_blobs(self):
+        """True if the blob directory holds anything besides saved counts"""
+        return any(len(name) == 2 for name in os.listdir(self.path))
+    
+    def clear(self):
+        """Delete every blob"""
+        with self._lock:
+            for digest in self._refs:
+                try:
+                    os.remove(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+            self._refs = {}
+            self._discard_saved()
+    
+    # Persistence of the counts
+    def load(self, marker):
+        """Load counts saved by save() with the same ``marker``
+
+        The saved file is removed so that a crash before the next save()
+        forces a recount. Returns False if the counts must be rebuilt.
+        """
+        path = os.path.join(self.path, REFCOUNT_FILE)
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        finally:
+            self._discard_saved()
+        if saved.get('marker') != marker:
+            return False
+        self._refs = saved['refs']
+        return True
+    
+    def save(self, marker):
+        """Persist the counts, tagged with a marker of the store state"""
+        with self._lock:
+            state = {'marker': marker, 'refs': self._refs}
+            fd, tmp_path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(self.path, REFCOUNT_FILE))
+    
+    def rebuild(self, refs):
+        """Adopt recounted references and delete blobs nobody points at"""
+        with self._lock:
+            self._refs = dict(refs)
+            for prefix in os.listdir(self.path):
+                folder = os.path.join(self.path, prefix)
+                if len(prefix) != 2 or not os.path.isdir(folder):
+                    continue
+                for name in os.listdir(folder):
+                    if prefix + name not in self._refs:
+                        os.remove(os.path.join(folder, name))
+    
+    def _discard_saved(self):
+        try:
+            os.remove(os.path.join(self.path, REFCOUNT_FILE))
+        except FileNotFoundError:
+            pass
+
+
+def is_attachment(part):
+    """True for leaf parts that are files rather than message text"""
+    if part.is_multipart() or part.get_content_maintype() == 'message':
+        return False
+    if part.get_content_disposition() == 'attachment':
+        return True
+    return bool(part.get_filename()) and part.get_content_maintype() != 'text'
+
+
+def extract_attachments(raw, blob_dir, spool_dir=None):
+    """Cut the attachments of a raw message out into blob files in ``blob_dir``
+    
+    ``raw`` is bytes, a readable binary file or the path of one. Each
+    attachment is replaced by an empty stub part carrying its digest.
+    Returns ``(message, attachments, blobs)``: the message to store (bytes
+    for bytes input, otherwise the path of a new file in ``spool_dir`` that
+    the caller deletes), a list describing the attachments, and the
+    finished blobs for AttachmentStore.add(). The message is None and the
+    lists are empty when the original should be stored unchanged: it is not
+    multipart, has no attachments or is too malformed to cut up safely.
+    """
+    if isinstance(raw, str):
+        with open(raw, 'rb') as f:
+            return extract_attachments(f, blob_dir, spool_dir)
+    in_memory = isinstance(raw, (bytes, bytearray))
+    if not in_memory:
+        raw.seek(0)
+    multipart = parse_headers(raw).get_content_maintype() == 'multipart'
+    if not in_memory:
+        raw.seek(0)
+    if not multipart:
+        return None, [], []
+    
+    if in_memory:
+        pieces = []
+        out = None
+        write = pieces.append
+    else:
+        fd, path = tempfile.mkstemp(prefix='spliced-', suffix='.eml', dir=spool_dir)
+        out = os.fdopen(fd, 'wb')
+        write = out.write
+    splicer = _Splicer(_Source(raw), write, blob_dir)
+    try:
+        try:
+            splicer.entity(())
+            spliced = bool(splicer.attachments)
+        except (_Unsplittable, binascii.Error):
+            spliced = False
+        finally:
+            if out is not None:
+                out.close()
+        if not spliced:
+            splicer.discard()
+            if out is not None:
+                _remove(path)
+                raw.seek(0)
+            return None, [], []
+    except BaseException:
+        splicer.discard()
+        if out is not None:
+            _remove(path)
+        raise
+    message = b''.join(pieces) if in_memory else path
+    return message, splicer.attachments, splicer.blobs
+
+
+class _Unsplittable(Exception):
+    """The message structure is too broken to cut attachments out of"""
+
+
+@functools.lru_cache(maxsize=256)
+def _delimiter(boundaries):
+    """Regex for a delimiter line of any of ``boundaries``, innermost last"""
+    if not boundaries:
+        return None
+    alternatives = b'|'.join(re.escape(boundary) for boundary in boundaries)
+    return re.compile(rb'--(' + alternatives + rb')(--)?[ \t]*\r?\n?')
+
+
+class _Source:
+    """Buffered reader over a raw message given as bytes or a binary file"""
+    
+    def __init__(self, raw):
+        if isinstance(raw, (bytes, bytearray)):
+            self._file = None
+            self.buf = bytes(raw)
+            self.eof = True
+        else:
+            self._file = raw
+            self.buf = b''
+            self.eof = False
+        self.pos = 0
+        # True while pos is at the start of a line
+        self.bol = True
+    
+    def read_head(self):
+        """Return the header block at the current position and its blank line"""
+        while True:
+            match = HEAD_END.search(self.buf, self.pos)
+            if match:
+                head = self.buf[self.pos:match.end()]
+                self.pos = match.end()
+                self.bol = True
+                return head, match.group()
+            if len(self.buf) - self.pos > MAX_HEADER_SIZE or not self._fill():
+                raise _Unsplittable()
+    
+    def copy_until(self, delimiter, write):
+        """Pass bytes to ``write`` up to the next line matching ``delimiter``
+        
+        Returns the match and moves past that line, or returns None at the
+        end of the input. A ``delimiter`` of None copies everything left.
+        """
+        while True:
+            buf, start = self.buf, self.pos
+            match = self._find(delimiter, start) if delimiter is not None else None
+            if match is not None:
+                if match.start() > start:
+                    write(buf[start:match.start()])
+                self.pos = match.end()
+                self.bol = True
+                return match
+            if self.eof:
+                if len(buf) > start:
+                    write(buf[start:])
+                self.pos = len(buf)
+                return None
+            # Hold back the last, incomplete line: it may be a delimiter
+            keep = buf.rfind(b'\n', start) + 1
+            if not keep:
+                keep = start if self.bol else len(buf)
+            if len(buf) - keep > MAX_LINE:
+                keep = len(buf)
+            if keep > start:
+                write(buf[start:keep])
+                self.bol = buf[keep - 1:keep] == b'\n'
+            self.pos = keep
+            self._fill()
+    
+    def _find(self, delimiter, start):
+        """Return the first complete delimiter line at or after ``start``"""
+        buf = self.buf
+        line = start if self.bol and buf.startswith(b'--', start) else None
+        search = start
+        while True:
+            if line is None:
+                found = buf.find(b'\n--', search)
+                if found < 0:
+                    return None
+                line = found + 1
+            end = buf.find(b'\n', line)
+            if end < 0:
+                if not self.eof:
+                    return None
+                end = len(buf)
+            else:
+                end += 1
+            match = delimiter.fullmatch(buf, line, end)
+            if match:
+                return match
+            # The line break ending this line may start the next candidate
+            search = end - 1
+            line = None
+    
+    def _fill(self):
+        """Drop what was consumed and read more; False at the end of input"""
+        if self.eof:
+            return False
+        chunk = self._file.read(CHUNK_SIZE)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+
+class _Decoder:
+    """Decodes a part body written in pieces into ``write``
+    
+    The line break before the next delimiter belongs to the delimiter, so
+    a trailing line break is held back until more data follows.
+    """
+    
+    def __init__(self, write):
+        self.out = write
+        self._held = b''
+    
+    def write(self, data):
+        if self._held:
+            data = self._held + data
+        if data.endswith(b'\n'):
+            cut = len(data) - (2 if data.endswith(b'\r\n') else 1)
+            data, self._held = data[:cut], data[cut:]
+        else:
+            self._held = b''
+        if data:
+            self.decode(data)
+    
+    def decode(self, data):
+        self.out(data)
+    
+    def finish(self):
+        pass
+
+
+class _Base64(_Decoder):
+    
+    def __init__(self, write):
+        super().__init__(write)
+        self._pending = b''
+    
+    def decode(self, data):
+        data = self._pending + data.translate(None, NOT_BASE64)
+        cut = len(data) - len(data) % 4
+        self._pending = data[cut:]
+        if cut:
+            self.out(binascii.a2b_base64(data[:cut]))
+    
+    def finish(self):
+        if self._pending:
+            # Like the email package, tolerate missing padding
+            self.out(binascii.a2b_base64(self._pending + b'=' * (-len(self._pending) % 4)))
+
+
+class _QuotedPrintable(_Decoder):
+    
+    def __init__(self, write):
+        super().__init__(write)
+        self._pending = b''
+    
+    def decode(self, data):
+        # Decode whole lines only, so soft line breaks stay in one piece
+        data = self._pending + data
+        cut = data.rfind(b'\n') + 1
+        self._pending = data[cut:]
+        if cut:
+            self.out(binascii.a2b_qp(data[:cut]))
+    
+    def finish(self):
+        if self._pending:
+            self.out(binascii.a2b_qp(self._pending))
+
+
+DECODERS = {
+    '7bit': _Decoder,
+    '8bit': _Decoder,
+    'binary': _Decoder,
+    'base64': _Base64,
+    'quoted-printable': _QuotedPrintable,
+}
+
+
+class _Splicer:
+    """Copies a message to ``write``, cutting attachment bodies into blobs"""
+    
+    def __init__(self, source, write, blob_dir):
+        self.source = source
+        self.out = write
+        self.blob_dir = blob_dir
+        self.attachments = []
+        self.blobs = []
+        self._writer = None
+    
+    def entity(self, boundaries, depth=0):
+        """Copy one entity; return the delimiter match that ends it, or None"""
+        if depth > MAX_DEPTH:
+            raise _Unsplittable()
+        head, eol = self.source.read_head()
+        part = parse_headers(head)
+        if any(isinstance(defect, errors.MissingHeaderBodySeparatorDefect)
+               for defect in part.defects):
+            raise _Unsplittable()
+        encoding = str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        maintype = part.get_content_maintype()
+        if maintype == 'multipart' and part.get_boundary():
+            self.out(head)
+            return self.multipart(part.get_boundary(), boundaries, depth)
+        if part.get_content_type() == 'message/rfc822' and encoding in ('7bit', '8bit', 'binary'):
+            self.out(head)
+            return self.entity(boundaries, depth + 1)
+        if encoding in DECODERS and is_attachment(part):
+            return self.attachment(head, eol, part, DECODERS[encoding], boundaries)
+        self.out(head)
+        return self.source.copy_until(_delimiter(boundaries), self.out)
+    
+    def multipart(self, boundary, boundaries, depth):
+        try:
+            boundary = boundary.encode('ascii', 'surrogateescape')
+        except UnicodeError:
+            raise _Unsplittable()
+        inner = boundaries + (boundary,)
+        match = self.source.copy_until(_delimiter(inner), self.out)
+        while match is not None:
+            if match.group(1) != boundary:
+                # An enclosing part ended before this one was closed
+                raise _Unsplittable()
+            self.out(match.group())
+            if match.group(2):
+                # The epilogue runs up to the enclosing delimiter
+                return self.source.copy_until(_delimiter(boundaries), self.out)
+            match = self.entity(inner, depth + 1)
+        return None
+    
+    def attachment(self, head, eol, part, decoder, boundaries):
+        self._writer = BlobWriter(self.blob_dir)
+        body = decoder(self._writer.write)
+        match = self.source.copy_until(_delimiter(boundaries), body.write)
+        body.finish()
+        blob = self._writer.finish()
+        self._writer = None
+        self.blobs.append(blob)
+        digest, size = blob[:2]
+        self.attachments.append({
+            'sha256': digest,
+            'filename': part.get_filename() or '',
+            'content_type': part.get_content_type(),
+            'size': size,
+        })
+        # The stub keeps the original headers and an empty body
+        header = f'{ATTACHMENT_HEADER}: {digest}'.encode('ascii')
+        self.out(head[:-len(eol)] + header + eol + eol + eol)
+        return match
+    
+    def discard(self):
+        """Delete every blob written so far"""
+        if self._writer is not None:
+            self._writer.discard()
+            self._writer = None
+        discard_blobs(self.blobs)
+        self.blobs = []
+
+
+def _intact(path, size):
+    """True if ``path`` holds a blob of ``size`` bytes"""
+    try:
+        return os.path.getsize(path) == size
+    except OSError:
+        return False
+
+
+def _fsync(path):
+    with open(path, 'r+b') as f:
+        os.fsync(f.fileno())
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
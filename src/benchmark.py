@@ -0,0 +1,422 @@
+"""SMTP receive benchmark
+
+Drives concurrent asyncio SMTP clients against the receiver and reports
+throughput, acceptance latency, errors and peak memory as JSON:
+
+    python -m src.benchmark --concurrency 50 --messages 20000
+    python -m src.benchmark --target mail.example.test:1025 --duration 30
+
+Without ``--target`` a server is started in this process on a free port
+with a throwaway mail store, so results include the cost of storing.
+Acceptance latency is measured per message from MAIL FROM to the reply
+after the final dot.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+
+from src.metrics import REGISTRY
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+DEFAULT_MIX = 'plain=80,multipart=15,attachment=5'
+
+
+def parse_mix(value):
+    """Parse ``kind=weight,...`` into a dict of weights"""
+    mix = {}
+    for part in value.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in MESSAGE_KINDS:
+            raise ValueError(f"Unknown message kind: {kind}")
+        mix[kind] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("Message mix has no weight")
+    return mix
+
+
+def _text(size):
+    line = 'The quick brown fox jumps over the lazy dog. ' * 2
+    text = (line.strip() + '\n') * (size // len(line) + 1)
+    return text[:size]
+
+
+def build_plain(size, attachment_size):
+    msg = EmailMessage()
+    msg.set_content(_text(size))
+    return msg
+
+
+def build_multipart(size, attachment_size):
+    msg = EmailMessage()
+    msg.set_content(_text(size))
+    msg.add_alternative(f"<html><body><pre>{_text(size)}</pre></body></html>", subtype='html')
+    return msg
+
+
+def build_attachment(size, attachment_size):
+    msg = EmailMessage()
+    msg.set_content(_text(size))
+    msg.add_attachment(os.urandom(attachment_size), maintype='application',
+                       subtype='octet-stream', filename='payload.bin')
+    return msg
+
+
+MESSAGE_KINDS = {
+    'plain': build_plain,
+    'multipart': build_multipart,
+    'attachment': build_attachment,
+}
+
+
+def render_message(kind, size, attachment_size):
+    """Return the DATA payload for a kind: CRLF lines, dot-stuffed, terminated"""
+    msg = MESSAGE_KINDS[kind](size, attachment_size)
+    msg['From'] = 'bench@example.test'
+    msg['To'] = 'inbox@example.test'
+    msg['Subject'] = f'Benchmark {kind} message'
+    raw = msg.as_bytes().replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    if not raw.endswith(b'\r\n'):
+        raw += b'\r\n'
+    raw = raw.replace(b'\r\n.', b'\r\n..')
+    if raw.startswith(b'.'):
+        raw = b'.' + raw
+    return raw + b'.\r\n'
+
+
+class SMTPError(Exception):
+    """Unexpected SMTP reply"""
+    
+    def __init__(self, code, text):
+        super().__init__(f"{code} {text}")
+        self.code = code
+
+
+class BenchClient:
+    """Minimal asyncio SMTP client for sending test messages"""
+    
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+    
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        await self._expect(220)
+        await self.command(b'EHLO bench.example.test', 250)
+    
+    async def send(self, payload):
+        await self.command(b'MAIL FROM:<bench@example.test>', 250)
+        await self.command(b'RCPT TO:<inbox@example.test>', 250)
+        await self.command(b'DATA', 354)
+        self.writer.write(payload)
+        await self._expect(250)
+    
+    async def command(self, line, expected):
+        self.writer.write(line + b'\r\n')
+        return await self._expect(expected)
+    
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self.command(b'QUIT', 221)
+        except (OSError, SMTPError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        self.writer = None
+    
+    async def _expect(self, expected):
+        await self.writer.drain()
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise asyncio.IncompleteReadError(b'', None)
+            lines.append(line.decode('utf-8', 'replace').rstrip())
+            if line[3:4] != b'-':
+                break
+        code = int(lines[-1][:3])
+        if code != expected:
+            raise SMTPError(code, lines[-1][4:])
+        return code
+
+
+class Benchmark:
+    """Runs one load test and collects its results"""
+    
+    def __init__(self, host, port, concurrency=10, messages=1000, duration=None,
+                 mix=None, size=2048, attachment_size=256 * 1024,
+                 per_connection=100, timeout=30.0, seed=None):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.messages = messages
+        self.duration = duration
+        self.mix = mix or parse_mix(DEFAULT_MIX)
+        self.size = size
+        self.attachment_size = attachment_size
+        self.per_connection = per_connection
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        
+        self.payloads = {kind: render_message(kind, size, attachment_size)
+                         for kind, weight in self.mix.items() if weight}
+        self.kinds = list(self.payloads)
+        self.weights = [self.mix[kind] for kind in self.kinds]
+        
+        self.latencies = {kind: [] for kind in self.kinds}
+        self.errors = {}
+        self.bytes_sent = 0
+        self._remaining = messages
+        self._deadline = None
+    
+    def run(self):
+        """Run the load test and return the results dict"""
+        return asyncio.run(self._run())
+    
+    async def _run(self):
+        start = time.perf_counter()
+        if self.duration:
+            self._deadline = start + self.duration
+        await asyncio.gather(*(self._client() for _ in range(self.concurrency)))
+        elapsed = time.perf_counter() - start
+        return self._results(elapsed)
+    
+    def _take(self):
+        """Claim the next message to send, or None when done"""
+        if self._deadline is not None:
+            if time.perf_counter() >= self._deadline:
+                return None
+        else:
+            if self._remaining <= 0:
+                return None
+            self._remaining -= 1
+        return self.random.choices(self.kinds, self.weights)[0]
+    
+    async def _client(self):
+        client = None
+        sent_on_connection = 0
+        while True:
+            kind = self._take()
+            if kind is None:
+                break
+            try:
+                if client is None:
+                    client = BenchClient(self.host, self.port, self.timeout)
+                    await client.connect()
+                    sent_on_connection = 0
+                payload = self.payloads[kind]
+                begin = time.perf_counter()
+                await client.send(payload)
+                self.latencies[kind].append(time.perf_counter() - begin)
+                self.bytes_sent += len(payload)
+                sent_on_connection += 1
+                if sent_on_connection >= self.per_connection:
+                    await client.close()
+                    client = None
+            except SMTPError as e:
+                self._error(str(e.code))
+                # Reset the transaction, or drop the connection if that fails
+                try:
+                    await client.command(b'RSET', 250)
+                except Exception:
+                    await self._discard(client)
+                    client = None
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self._error(type(e).__name__)
+                await self._discard(client)
+                client = None
+        if client is not None:
+            await client.close()
+    
+    async def _discard(self, client):
+        if client is not None and client.writer is not None:
+            client.writer.close()
+            client.writer = None
+    
+    def _error(self, key):
+        self.errors[key] = self.errors.get(key, 0) + 1
+    
+    def _results(self, elapsed):
+        latencies = sorted(x for values in self.latencies.values() for x in values)
+        accepted = len(latencies)
+        failed = sum(self.errors.values())
+        
+        return {
+            'config': {
+                'target': f"{self.host}:{self.port}",
+                'concurrency': self.concurrency,
+                'messages': self.messages if not self.duration else None,
+                'duration': self.duration,
+                'mix': self.mix,
+                'size': self.size,
+                'attachment_size': self.attachment_size,
+                'per_connection': self.per_connection,
+            },
+            'elapsed': elapsed,
+            'accepted': accepted,
+            'accepted_by_kind': {kind: len(values) for kind, values in self.latencies.items()},
+            'failed': failed,
+            'errors': self.errors,
+            'error_rate': failed / (accepted + failed) if accepted + failed else 0.0,
+            'throughput': accepted / elapsed if elapsed else 0.0,
+            'bytes_per_second': self.bytes_sent / elapsed if elapsed else 0.0,
+            'latency': summarize(latencies),
+            'latency_by_kind': {kind: summarize(sorted(values))
+                                for kind, values in self.latencies.items()},
+        }
+
+
+def summarize(latencies):
+    """Mean, percentiles and maximum of a sorted list of latencies"""
+    if not latencies:
+        return None
+    count = len(latencies)
+    
+    def pick(q):
+        return latencies[min(count - 1, int(q * count))]
+    
+    return {
+        'mean': sum(latencies) / count,
+        'p50': pick(0.50),
+        'p90': pick(0.90),
+        'p99': pick(0.99),
+        'max': latencies[-1],
+    }
+
+
+def peak_rss():
+    """Peak resident set size of this process and its reaped children, in bytes"""
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_stages():
+    """Server-side per-stage latency percentiles from the metrics registry"""
+    histograms = REGISTRY.snapshot()['histograms']
+    return {name: {key: value for key, value in stats.items() if key != 'sum'}
+            for name, stats in histograms.items() if stats['count']}
+
+
+def parse_args(argv=None):
+    """Parse command line flags"""
+    parser = argparse.ArgumentParser(prog='python -m src.benchmark',
+                                     description='Load test the SMTP receiver')
+    parser.add_argument('--target', help='host:port of a running server '
+                                         '(default: start one in this process)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='receive workers for the in-process server')
+    parser.add_argument('--offload', choices=('off', 'process', 'thread'), default='off',
+                        help='offload mode for the in-process server (default: off)')
+    parser.add_argument('--store', help='mail store directory for the in-process '
+                                        'server (default: temporary, removed afterwards)')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='concurrent SMTP connections (default: 10)')
+    parser.add_argument('-n', '--messages', type=int, default=1000,
+                        help='messages to send in total (default: 1000)')
+    parser.add_argument('-d', '--duration', type=float,
+                        help='send for this many seconds instead of a fixed count')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'message kinds and weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='text body size in bytes (default: 2048)')
+    parser.add_argument('--attachment-size', dest='attachment_size', type=int,
+                        default=256 * 1024, help='attachment size in bytes (default: 256 KiB)')
+    parser.add_argument('--per-connection', dest='per_connection', type=int, default=100,
+                        help='messages per connection before reconnecting (default: 100)')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='per reply timeout in seconds (default: 30)')
+    parser.add_argument('--seed', type=int, help='seed for the message mix')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Command line entry point"""
+    args = parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    
+    manager = store = store_dir = None
+    if args.target:
+        host, _, port = args.target.rpartition(':')
+        host, port = host or 'localhost', int(port)
+    else:
+        # Imported here so benchmarking a remote server needs no store
+        from src.mail_store import MailStore
+        from src.server_manager import ServerManager
+        from src.sink import MessageSink
+        
+        host, port = '127.0.0.1', free_port()
+        store_dir = args.store or tempfile.mkdtemp(prefix='smtp-bench-')
+        store = MailStore(store_dir)
+        offload = None if args.offload == 'off' else {'mode': args.offload}
+        manager = ServerManager(store, MessageSink(), offload=offload)
+        success, message = manager.start(host, port, args.workers)
+        if not success:
+            print(f"Error: failed to start server: {message}", file=sys.stderr)
+            store.close()
+            return 1
+    
+    try:
+        bench = Benchmark(host, port, args.concurrency, args.messages, args.duration,
+                          mix, args.size, args.attachment_size, args.per_connection,
+                          args.timeout, args.seed)
+        results = bench.run()
+    finally:
+        if manager is not None:
+            manager.stop()
+            store.close()
+            if not args.store:
+                shutil.rmtree(store_dir, ignore_errors=True)
+    
+    results['peak_rss'] = peak_rss()
+    if manager is not None:
+        results['server'] = server_stages()
+    
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    print(report)
+    return 0 if results['accepted'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Codecs for compressing message records at rest
+
+A compressed record starts with a small frame header naming the codec,
+the shared dictionary it was compressed against (0 for none) and the
+uncompressed size. Codecs are looked up by their id when a record is
+read, so stores written with one codec stay readable after switching
+to another.
+
+zlib is built in. Other codecs can be added with register_codec(); a
+codec class needs an ``id`` byte, a ``name``, a constructor taking
+``level`` and ``dictionary`` and compressobj()/decompressobj() methods
+with the zlib object interface.
+
+Mail from the same senders and lists repeats the same headers and
+boilerplate, which a small message alone cannot exploit. A dictionary
+built from past mail with build_dictionary() gives the compressor that
+history up front.
+"""
+
+import struct
+import zlib
+from collections import Counter
+
+
+# codec id, dictionary id, uncompressed size
+FRAME_HEADER = struct.Struct('<BIQ')
+
+DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SAMPLE_SIZE = 8 * 1024
+
+_CODECS = {}
+
+
+def register_codec(cls):
+    """Make a codec class available by its id and name"""
+    if cls.id in _CODECS and _CODECS[cls.id] is not cls:
+        raise ValueError(f"Codec id {cls.id} is already taken by {_CODECS[cls.id].name}")
+    _CODECS[cls.id] = cls
+    return cls
+
+
+def get_codec(key):
+    """Return the codec class for an id or a name"""
+    for cls in _CODECS.values():
+        if key in (cls.id, cls.name):
+            return cls
+    raise ValueError(f"Unknown codec: {key}")
+
+
+def codec_names():
+    return sorted(cls.name for cls in _CODECS.values())
+
+
+@register_codec
+class ZlibCodec:
+    """Raw deflate; the record CRC already covers integrity"""
+    
+    id = 1
+    name = 'zlib'
+    
+    def __init__(self, level=6, dictionary=None):
+        self.level = level
+        self.dictionary = dictionary
+    
+    def compressobj(self):
+        if self.dictionary:
+            return zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=self.dictionary)
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+    
+    def decompressobj(self):
+        if self.dictionary:
+            return zlib.decompressobj(-15, zdict=self.dictionary)
+        return zlib.decompressobj(-15)
+
+
+def build_dictionary(samples, size=DICTIONARY_SIZE):
+    """Build a shared dictionary from sample messages (bytes)
+
+    Lines that occur in more than one sample are ranked by the bytes they
+    would save. zlib matches nearer data more cheaply, so the most
+    valuable lines go at the end.
+    """
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(sample[:DICTIONARY_SAMPLE_SIZE].splitlines(keepends=True)))
+    ranked = sorted((line for line, n in counts.items() if n > 1 and len(line) > 3),
+                    key=lambda line: counts[line] * len(line), reverse=True)
+    chosen = []
+    total = 0
+    for line in ranked:
+        if total + len(line) > size:
+            continue
+        chosen.append(line)
+        total += len(line)
+    return b''.join(reversed(chosen))
@@ -1,57 +1,149 @@
 """Email handler for incoming SMTP messages"""
 
-from datetime import datetime
-from email import message_from_bytes
+import logging
+import os
+import time
+
+from src.attachments import discard_blobs, extract_attachments
+from src.message_record import MessageRecord
+from src.metrics import (ATTACHMENT_SECONDS, DISPATCH_SECONDS, HANDLER_SECONDS,
+                         MESSAGES_ACCEPTED, MESSAGES_REJECTED, PARSE_SECONDS, STORE_SECONDS)
+from src.offload import OffloadBusy
+from src.parsing import parse_headers
+from src.spooling import declared_size, message_size, message_source
+
+
+class DeliveryDeferred(Exception):
+    """A message could not be stored now but may be later"""
 
 
 class EmailHandler:
     """Handler for incoming SMTP messages"""
     
-    def __init__(self, gui):
-        self.gui = gui
+    def __init__(self, store, sink, offload=None, blob_dir=None):
+        self.store = store
+        self.sink = sink
+        # Optional OffloadStage that processes large messages off the loop
+        self.offload = offload
+        # Where attachments are cut out to before the store adds them
+        self.blob_dir = blob_dir or store.attachments.path
     
     async def handle_DATA(self, server, session, envelope):
         """Process incoming email"""
+        start = time.perf_counter()
+        offloaded = False
+        extracted = None
         try:
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            timestamp = time.time()
+            # Large messages arrive spooled to disk rather than in memory
+            raw = message_source(envelope)
             
-            # Parse email
-            msg = message_from_bytes(envelope.content)
-            subject = msg.get('Subject', 'No Subject')
+            # Only the headers are parsed here; the body is parsed
+            # when the message is opened
+            if self.offload is not None and self.offload.wants(message_size(envelope)):
+                await self.offload.acquire()
+                offloaded = True
+                # Attachment extraction happens in the pool too
+                subject, *extracted = await self.offload.process(raw, self.blob_dir)
+            else:
+                msg = parse_headers(raw)
+                subject = msg.get('Subject', 'No Subject')
+            PARSE_SECONDS.observe(time.perf_counter() - start)
             
-            # Get body
-            body = self._extract_body(msg)
-            
-            # Store email
-            email_data = {
-                'time': timestamp,
+            meta = {
                 'from': envelope.mail_from,
-                'to': ', '.join(envelope.rcpt_tos),
-                'subject': subject,
-                'body': body,
+                'to': envelope.rcpt_tos,
+                'subject': str(subject),
                 'peer': session.peer
             }
+            await self.save(raw, meta, timestamp, extracted)
             
-            self.gui.received_emails.append(email_data)
-            
-            # Update GUI (thread-safe)
-            self.gui.root.after(0, self.gui.add_email_to_inbox, email_data)
-            self.gui.root.after(0, self.gui.log, 
-                f"Received email from {envelope.mail_from} - Subject: {subject}")
-            
+            MESSAGES_ACCEPTED.inc()
             return '250 Message accepted for delivery'
+        except OffloadBusy:
+            MESSAGES_REJECTED.inc()
+            return '451 4.3.2 Server busy, try again later'
+        except DeliveryDeferred as e:
+            MESSAGES_REJECTED.inc()
+            self.sink.log(f"Deferred email: {str(e)}", logging.WARNING)
+            return '451 4.3.0 Temporary failure, try again later'
         except Exception as e:
-            self.gui.root.after(0, self.gui.log, f"Error processing email: {str(e)}")
+            MESSAGES_REJECTED.inc()
+            self.sink.log(f"Error processing email: {str(e)}", logging.ERROR)
             return '550 Error processing message'
+        finally:
+            if offloaded:
+                self.offload.release()
+            HANDLER_SECONDS.observe(time.perf_counter() - start)
+    
+    def overloaded(self, envelope):
+        """True if DATA should be refused because large messages are backed up
+        
+        Only clients that announce a large SIZE are turned away early; the
+        rest are accepted and wait for a processing slot.
+        """
+        if self.offload is None or not self.offload.full():
+            return False
+        size = declared_size(envelope)
+        return size is not None and self.offload.wants(size)
     
-    def _extract_body(self, msg):
-        """Extract email body from message"""
-        if msg.is_multipart():
-            body = ''
-            for part in msg.walk():
-                if part.get_content_type() == 'text/plain':
-                    body = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                    break
+    async def save(self, raw, meta, timestamp, extracted=None):
+        """Store a message accepted by handle_DATA
+        
+        ``extracted`` is the extract_attachments() result for messages the
+        offload stage processed; the others go through deliver().
+        """
+        if extracted is None:
+            self.deliver(raw, meta, timestamp)
         else:
-            body = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
-        return body
+            message, attachments, blobs = extracted
+            await self.offload.call(self.commit, raw if message is None else message,
+                                    meta, timestamp, attachments, blobs)
+    
+    def deliver(self, raw, meta, timestamp):
+        """Store a parsed message and notify the sink
+        
+        ``raw`` is the message as bytes or as a readable spool file.
+        Attachments are moved to the store's attachment blobs first.
+        """
+        start = time.perf_counter()
+        message, attachments, blobs = extract_attachments(raw, self.blob_dir)
+        ATTACHMENT_SECONDS.observe(time.perf_counter() - start)
+        self.commit(raw if message is None else message, meta, timestamp, attachments, blobs)
+    
+    def commit(self, raw, meta, timestamp, attachments=(), blobs=()):
+        """Store a message whose attachments were cut out already, notify the sink
+        
+        ``raw`` is bytes, a readable file or the path of a file, which is
+        deleted afterwards. ``attachments`` and ``blobs`` come from
+        extract_attachments(); the blobs are added to the store's.
+        """
+        start = time.perf_counter()
+        if attachments:
+            meta = dict(meta, attachments=attachments)
+        added = []
+        try:
+            for blob in blobs:
+                added.append(self.store.attachments.add(blob))
+            if isinstance(raw, str):
+                with open(raw, 'rb') as f:
+                    msg_id = self.store.append(f, meta, timestamp)
+            else:
+                msg_id = self.store.append(raw, meta, timestamp)
+        except Exception:
+            for digest in added:
+                self.store.attachments.release(digest)
+            discard_blobs(blobs[len(added):])
+            raise
+        finally:
+            if isinstance(raw, str):
+                os.remove(raw)
+        stored = time.perf_counter()
+        STORE_SECONDS.observe(stored - start)
+        
+        record = MessageRecord(msg_id, timestamp, meta['from'], meta['to'], meta['subject'],
+                               meta['peer'], attachments, store=self.store)
+        
+        self.sink.message_received(record)
+        self.sink.log(f"Received email from {meta['from']} - Subject: {meta['subject']}")
+        DISPATCH_SECONDS.observe(time.perf_counter() - stored)
@@ -0,0 +1,71 @@
+"""Sink that forwards server events to the GUI"""
+
+import threading
+from collections import deque
+
+from src.sink import MessageSink
+
+
+class GUISink(MessageSink):
+    """Queues newly stored messages and shows them in the GUI in batches
+    
+    Log lines go to the GUI's ServerLog instead. The SMTP thread only
+    appends to a bounded queue. The Tk main loop
+    drains it every ``interval`` milliseconds, handing at most
+    ``max_batch`` events to the GUI at once. When more than
+    ``max_pending`` events are waiting the oldest are dropped and counted
+    so the window can show that it is lagging.
+    
+    Other threads hand work for the Tk thread to call(), which runs it on
+    the next drain. Unlike root.after() it never touches Tk off the Tk
+    thread, so it is safe while the window is being torn down.
+    """
+    
+    def __init__(self, gui, interval=75, max_batch=500, max_pending=20000):
+        self.gui = gui
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._events = deque()
+        # Never dropped, unlike the events
+        self._calls = deque()
+        self._lock = threading.Lock()
+    
+    def message_received(self, record):
+        self._put(('message', record))
+    
+    def call(self, func, *args):
+        """Have the Tk main loop run ``func(*args)``; callable from any thread"""
+        with self._lock:
+            self._calls.append((func, args))
+    
+    def start(self):
+        """Begin draining the queue on the Tk main loop"""
+        self.gui.root.after(self.interval, self._drain)
+    
+    def _put(self, event):
+        with self._lock:
+            if len(self._events) >= self.max_pending:
+                self._events.popleft()
+                self.dropped += 1
+            self._events.append(event)
+    
+    def _drain(self):
+        with self._lock:
+            count = min(len(self._events), self.max_batch)
+            batch = [self._events.popleft() for _ in range(count)]
+            pending = len(self._events)
+            dropped = self.dropped
+            calls = list(self._calls)
+            self._calls.clear()
+        
+        messages = [data for kind, data in batch if kind == 'message']
+        try:
+            for func, args in calls:
+                func(*args)
+            if messages:
+                self.gui.add_emails_to_inbox(messages)
+            self.gui.update_queue_status(pending, dropped)
+        finally:
+            self.gui.root.after(self.interval, self._drain)
@@ -3,6 +3,8 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext
 
+from src.gui.virtual_tree import VirtualTreeview
+
 
 class InboxTab:
     """Inbox tab for viewing received emails"""
@@ -37,19 +39,34 @@ class InboxTab:
         self.gui.email_count_label = ttk.Label(toolbar, text="Emails: 0")
         self.gui.email_count_label.pack(side='left', padx=5)
         
+        self.gui.queue_status_label = ttk.Label(toolbar, text="", foreground="orange")
+        self.gui.queue_status_label.pack(side='left', padx=5)
+        
         ttk.Button(toolbar, text="Clear Inbox", 
                   command=self.gui.clear_inbox).pack(side='right', padx=5)
         ttk.Button(toolbar, text="Refresh", 
                   command=self.gui.refresh_inbox).pack(side='right', padx=5)
+        
+        # Search box; see SearchIndex for the query syntax
+        ttk.Button(toolbar, text="Show All", 
+                  command=self.gui.clear_search).pack(side='right', padx=5)
+        ttk.Button(toolbar, text="Search", 
+                  command=self.gui.search_inbox).pack(side='right', padx=5)
+        self.gui.search_entry = ttk.Entry(toolbar, width=30)
+        self.gui.search_entry.pack(side='right', padx=5)
+        self.gui.search_entry.bind('<Return>', lambda e: self.gui.search_inbox())
     
     def _create_email_list(self, parent):
-        """Create email list treeview"""
-        columns = ('Time', 'From', 'To', 'Subject')
-        self.gui.email_tree = ttk.Treeview(parent, columns=columns, 
-                                           show='tree headings', height=10)
+        """Create virtualized email list backed by the mail store"""
+        columns = ('Time', 'From', 'To', 'Subject', 'Files')
+        self.gui.email_list = VirtualTreeview(parent, columns, 
+                                              row_count=self.gui.inbox_row_count, 
+                                              load_row=self.gui.inbox_row, 
+                                              show='tree headings', height=10)
+        self.gui.email_tree = self.gui.email_list.tree
         
         self.gui.email_tree.heading('#0', text='#')
-        self.gui.email_tree.column('#0', width=40)
+        self.gui.email_tree.column('#0', width=60)
         self.gui.email_tree.heading('Time', text='Time')
         self.gui.email_tree.column('Time', width=150)
         self.gui.email_tree.heading('From', text='From')
@@ -58,21 +75,24 @@ class InboxTab:
         self.gui.email_tree.column('To', width=200)
         self.gui.email_tree.heading('Subject', text='Subject')
         self.gui.email_tree.column('Subject', width=250)
+        self.gui.email_tree.heading('Files', text='Files')
+        self.gui.email_tree.column('Files', width=50, anchor='center')
         
-        scrollbar = ttk.Scrollbar(parent, orient='vertical', 
-                                 command=self.gui.email_tree.yview)
-        self.gui.email_tree.configure(yscrollcommand=scrollbar.set)
-        
-        self.gui.email_tree.pack(side='left', fill='both', expand=True)
-        scrollbar.pack(side='right', fill='y')
-        
-        self.gui.email_tree.bind('<<TreeviewSelect>>', self.gui.on_email_select)
+        self.gui.email_list.pack()
+        self.gui.email_list.bind_select(self.gui.on_email_select)
     
     def _create_content_viewer(self, parent):
         """Create email content viewer"""
         content_frame = ttk.LabelFrame(parent, text="Email Content", padding=5)
         content_frame.pack(fill='both', expand=True, pady=10)
         
+        content_toolbar = ttk.Frame(content_frame)
+        content_toolbar.pack(fill='x', pady=(0, 5))
+        self.gui.save_attachments_button = ttk.Button(content_toolbar, text="Save Attachments...", 
+                                                      command=self.gui.save_attachments, 
+                                                      state='disabled')
+        self.gui.save_attachments_button.pack(side='right', padx=5)
+        
         self.gui.content_text = scrolledtext.ScrolledText(content_frame, 
                                                           height=10, wrap=tk.WORD)
         self.gui.content_text.pack(fill='both', expand=True)
@@ -0,0 +1,92 @@
+"""Batched view of the server log"""
+
+import logging
+import tkinter as tk
+from datetime import datetime
+from tkinter import scrolledtext
+
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+class LogView:
+    """ScrolledText that shows the tail of a ServerLog
+
+    New records are fetched every ``interval`` milliseconds and inserted
+    with a single call, and the widget never holds more than
+    ``max_lines`` records, so a burst of events costs one redraw and the
+    widget does not grow with the session. Records below ``level`` are
+    hidden. The view only follows new lines while scrolled to the end.
+    """
+    
+    def __init__(self, parent, server_log, max_lines=2000, interval=200,
+                 level=logging.INFO, **kwargs):
+        self.server_log = server_log
+        self.max_lines = max_lines
+        self.interval = interval
+        self.level = level
+        self.text = scrolledtext.ScrolledText(parent, **kwargs)
+        self._seq = 0
+        self._lines = 0
+        self._job = None
+    
+    def pack(self, **kwargs):
+        self.text.pack(**kwargs)
+    
+    def start(self):
+        """Begin polling the log on the Tk main loop"""
+        self._poll()
+    
+    def stop(self):
+        if self._job is not None:
+            self.text.after_cancel(self._job)
+            self._job = None
+    
+    def set_level(self, level):
+        """Show only records at ``level`` (a number or name) and above"""
+        if isinstance(level, str):
+            level = logging.getLevelName(level)
+        self.level = level
+        self.text.delete('1.0', tk.END)
+        self._lines = 0
+        self._seq = 0
+        self._update()
+    
+    def clear(self):
+        """Empty the view; records already logged are not shown again"""
+        self.text.delete('1.0', tk.END)
+        self._lines = 0
+        self._seq = self.server_log.last_seq
+    
+    def _poll(self):
+        try:
+            self._update()
+        finally:
+            self._job = self.text.after(self.interval, self._poll)
+    
+    def _update(self):
+        last = self.server_log.last_seq
+        records = self.server_log.since(self._seq, self.level, self.max_lines)
+        self._seq = max(last, records[-1][0]) if records else last
+        if not records:
+            return
+        
+        at_end = self.text.yview()[1] >= 0.999
+        self.text.insert(tk.END, ''.join(self._format(record) for record in records))
+        self._lines += len(records)
+        if self._lines > self.max_lines:
+            excess = self._lines - self.max_lines
+            # Approximate for messages that span several lines
+            end = self.text.index(f'1.0 + {excess} lines')
+            self.text.delete('1.0', end)
+            self._lines = self.max_lines
+        if at_end:
+            self.text.see(tk.END)
+    
+    @staticmethod
+    def _format(record):
+        _, created, level, message = record
+        timestamp = datetime.fromtimestamp(created).strftime('%H:%M:%S')
+        if level >= logging.WARNING:
+            return f"[{timestamp}] {logging.getLevelName(level)}: {message}\n"
+        return f"[{timestamp}] {message}\n"
@@ -1,20 +1,37 @@
 """Main GUI window for Email Server"""
 
+import asyncio
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-from datetime import datetime
+import logging
 import threading
+import time
 import os
 import smtplib
 
 from src.gui.server_tab import ServerTab
 from src.gui.send_tab import SendTab
 from src.gui.inbox_tab import InboxTab
+from src.gui.gui_sink import GUISink
+from src.listeners import parse_address
+from src.email_handler import EmailHandler
 from src.server_manager import ServerManager
+from src.mail_store import MailStore
+from src.search_index import SearchIndex
+from src.server_log import DEFAULT_LOG_FILE, ServerLog
+from src.sink import FanoutSink
 from src.validators import EmailValidator
+from src.async_smtp import AsyncSMTPPool, SendLoop
+from src.outbound_queue import OutboundQueue, is_permanent
 from src.smtp_sender import SMTPSender
 
 
+# Seconds open sessions get to finish when "Stop Server" is clicked
+STOP_DRAIN_TIMEOUT = 10
+# Milliseconds between checks whether the last email sent has left the queue
+SEND_STATUS_INTERVAL = 500
+
+
 class EmailServerGUI:
     """Main GUI application"""
     
@@ -23,12 +40,54 @@ class EmailServerGUI:
         self.root.title("Python Email Server")
         self.root.geometry("950x750")
         
-        self.received_emails = []
+        self.received_emails = MailStore()
+        self.search_index = SearchIndex(self.received_emails)
+        self.inbox_filter = None
+        self.selected_email_id = None
         self.attachments = []
-        self.server_manager = ServerManager(self)
+        self.server_log = ServerLog(DEFAULT_LOG_FILE)
+        # Network I/O for sending runs here, never on the Tk thread
+        self.send_loop = SendLoop()
+        # Keeps relay sessions open between sends
+        self.smtp_pool = AsyncSMTPPool()
+        # Sends in the background and retries; bounces land in the inbox
+        self.outbound = OutboundQueue(sink=self.server_log, pool=self.smtp_pool,
+                                      bounce=self.deliver_bounce, send_loop=self.send_loop,
+                                      progress=self.on_send_progress)
+        # Recipient states of the last email sent, for the Send tab
+        self.send_batch = None
+        self.sink = GUISink(self)
+        self.server_manager = ServerManager(self.received_emails, 
+                                            FanoutSink(self.search_index, self.sink,
+                                                       self.server_log))
         
         self.create_widgets()
-        
+        self.refresh_inbox()
+        self.sink.start()
+        self.log_view.start()
+        self.refresh_listeners()
+        self.send_loop.start()
+        self.outbound.start()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+    
+    def on_close(self):
+        """Stop the server and flush the mail store before exiting"""
+        if self.server_manager.is_running():
+            self.server_manager.stop()
+        self.search_index.close()
+        # First, so no attempt runs into the send loop stopping; sends still
+        # running are cancelled and the queue makes them again next time
+        self.outbound.stop()
+        try:
+            self.send_loop.submit(self.smtp_pool.close()).result(STOP_DRAIN_TIMEOUT)
+        except Exception:
+            pass
+        self.send_loop.stop()
+        self.received_emails.close()
+        self.log_view.stop()
+        self.server_log.close()
+        self.root.destroy()
+    
     def create_widgets(self):
         """Create main notebook with tabs"""
         notebook = ttk.Notebook(self.root)
@@ -49,11 +108,9 @@ class EmailServerGUI:
         InboxTab(inbox_frame, self)
     
     # Server methods
-    def log(self, message):
-        """Log message with timestamp"""
-        timestamp = datetime.now().strftime('%H:%M:%S')
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text.see(tk.END)
+    def log(self, message, level=logging.INFO):
+        """Add a line to the server log; the log view shows it on its next update"""
+        self.server_log.log(message, level)
     
     def start_server(self):
         """Start SMTP server"""
@@ -84,11 +141,17 @@ class EmailServerGUI:
                                 foreground="green")
     
     def stop_server(self):
-        """Stop SMTP server"""
-        self.log("Stopping server...")
-        success, message = self.server_manager.stop()
-        self.log(message)
-        self.reset_server_ui()
+        """Stop SMTP server, letting open sessions finish first"""
+        self.log("Stopping server, waiting for open sessions...")
+        self.stop_btn.config(state='disabled')
+        self.status_label.config(text="Status: Stopping", foreground="orange")
+        
+        def run_stop():
+            success, message = self.server_manager.stop(STOP_DRAIN_TIMEOUT)
+            self.root.after(0, self.log, message)
+            self.root.after(0, self.reset_server_ui)
+        
+        threading.Thread(target=run_stop, daemon=True).start()
     
     def reset_server_ui(self):
         """Reset server UI controls"""
@@ -98,6 +161,42 @@ class EmailServerGUI:
         self.port_entry.config(state='normal')
         self.status_label.config(text="Status: Stopped", foreground="red")
     
+    def add_listener(self):
+        """Listen on the address in the listener entry as well"""
+        try:
+            host, port = parse_address(self.listener_entry.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        success, message = self.server_manager.add_listener(host, port)
+        if not success:
+            messagebox.showerror("Listener Error", message)
+        self.log(message, logging.INFO if success else logging.ERROR)
+        self.refresh_listeners(schedule=False)
+    
+    def remove_listener(self):
+        """Stop listening on the selected addresses; open sessions finish"""
+        for address in self.listeners_tree.selection():
+            success, message = self.server_manager.remove_listener(address)
+            self.log(message)
+        self.refresh_listeners(schedule=False)
+    
+    def refresh_listeners(self, schedule=True):
+        """Show current per-listener counters, once a second"""
+        stats = self.server_manager.listener_stats()
+        for address in self.listeners_tree.get_children():
+            if address not in stats:
+                self.listeners_tree.delete(address)
+        for address, counters in stats.items():
+            values = (counters['sessions'], counters['active'], counters['refused'],
+                      counters['messages'])
+            if self.listeners_tree.exists(address):
+                self.listeners_tree.item(address, values=values)
+            else:
+                self.listeners_tree.insert('', 'end', iid=address, text=address, values=values)
+        if schedule:
+            self.root.after(1000, self.refresh_listeners)
+    
     # Send email methods
     def toggle_smtp_config(self):
         """Toggle SMTP configuration visibility"""
@@ -124,21 +223,29 @@ class EmailServerGUI:
         
         try:
             port = int(port)
-            self.log(f"Testing connection to {server}:{port}...")
-            
-            smtp = smtplib.SMTP(server, port, timeout=10)
-            smtp.starttls()
-            smtp.login(email, password)
-            smtp.quit()
-            
+        except ValueError:
+            messagebox.showerror("Error", f"Invalid port: {port}")
+            return
+        self.log(f"Testing connection to {server}:{port}...")
+        future = self.send_loop.submit(SMTPSender.check_login_async(server, port, email, password))
+        route = {'mode': 'external', 'host': server, 'port': port, 'user': email}
+        future.add_done_callback(
+            lambda future: self.sink.call(self.connection_tested, future, route, password))
+    
+    def connection_tested(self, future, route, password):
+        """Report the outcome of test_smtp_connection()"""
+        try:
+            future.result()
+            # Releases emails held for this relay since a restart
+            self.outbound.set_password(route, password)
             messagebox.showinfo("Success", "SMTP connection successful!")
             self.log("SMTP connection test successful")
         except smtplib.SMTPAuthenticationError:
             messagebox.showerror("Error", "Authentication failed. Check your email and password.\nFor Gmail, use an App Password.")
-            self.log("SMTP authentication failed")
+            self.log("SMTP authentication failed", logging.ERROR)
         except Exception as e:
             messagebox.showerror("Error", f"Connection failed: {str(e)}")
-            self.log(f"SMTP connection failed: {str(e)}")
+            self.log(f"SMTP connection failed: {str(e)}", logging.ERROR)
     
     def add_attachment(self):
         """Add file attachment"""
@@ -225,63 +332,198 @@ class EmailServerGUI:
             
             all_recipients = recipients + cc_list + bcc_list
             
-            # Send based on mode
+            # Route based on mode; the outbound queue does the sending
+            password = None
             if self.smtp_mode.get() == "local":
-                host = self.host_entry.get()
-                port = int(self.port_entry.get())
-                success, message = SMTPSender.send_local(sender, all_recipients, 
-                                                        msg, host, port)
-                messagebox.showinfo("Success", message)
-                
+                route = {'mode': 'local', 'host': self.host_entry.get(),
+                         'port': int(self.port_entry.get())}
+            
             elif self.smtp_mode.get() == "direct":
-                sent_count, failed = SMTPSender.send_direct(sender, all_recipients, 
-                                                           msg, self.log)
-                if sent_count > 0:
-                    msg_text = f"Sent to {sent_count} recipient(s)!\n\n"
-                    msg_text += "Note: Email may be in spam folder."
-                    if failed:
-                        msg_text += f"\n\nFailed: {len(failed)}"
-                    messagebox.showinfo("Success", msg_text)
-                else:
-                    error_summary = "\n".join(failed[:3])
-                    messagebox.showerror("Failed", f"Could not send:\n\n{error_summary}")
-                    
+                route = {'mode': 'direct'}
+            
             else:  # external
                 smtp_server = self.smtp_server_entry.get().strip()
                 smtp_port = int(self.smtp_port_entry.get())
                 smtp_email = self.smtp_email_entry.get().strip()
-                smtp_password = self.smtp_password_entry.get()
+                password = self.smtp_password_entry.get()
                 
-                if not all([smtp_server, smtp_email, smtp_password]):
+                if not all([smtp_server, smtp_email, password]):
                     messagebox.showerror("Error", "Please configure SMTP settings")
                     return
-                
-                success, message = SMTPSender.send_authenticated(
-                    sender, all_recipients, msg, smtp_server, smtp_port, 
-                    smtp_email, smtp_password)
-                messagebox.showinfo("Success", message)
+                route = {'mode': 'external', 'host': smtp_server, 'port': smtp_port,
+                         'user': smtp_email}
             
-            self.log(f"Sent email to {recipient} - Subject: {subject}")
-            if self.attachments:
-                self.log(f"  with {len(self.attachments)} attachment(s)")
-                
+            # Writing the queue file streams the attachments and fsyncs it,
+            # so it runs on the send loop's executor rather than the Tk thread
+            future = self.send_loop.submit(asyncio.to_thread(
+                self.outbound.enqueue, sender, all_recipients, msg, route, password))
+            description = f"{recipient} - Subject: {subject}"
+            attachments = len(self.attachments)
+            future.add_done_callback(
+                lambda future: self.sink.call(self.email_queued, future, all_recipients,
+                                              description, attachments))
+        
+        except Exception as e:
+            self.send_failed(e)
+    
+    def email_queued(self, future, recipients, description, attachments):
+        """Track the email send_email() handed to the outbound queue"""
+        try:
+            msg_id = future.result()
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to send email: {str(e)}")
-            self.log(f"Error sending email: {str(e)}")
+            self.send_failed(e)
+            return
+        self.send_batch = {'id': msg_id, 'cancelled': False,
+                           'states': dict.fromkeys(recipients, 'waiting')}
+        self.cancel_send_btn.config(state='normal')
+        self.update_send_status()
+        self.root.after(SEND_STATUS_INTERVAL, self.refresh_send_status, msg_id)
+        
+        self.log(f"Queued email to {description} ({len(self.outbound)} in outbound queue)")
+        if attachments:
+            self.log(f"  with {attachments} attachment(s)")
+    
+    def send_failed(self, error):
+        """Report an email that could not be queued"""
+        messagebox.showerror("Error", f"Failed to send email: {str(error)}")
+        self.log(f"Error sending email: {str(error)}", logging.ERROR)
+    
+    def cancel_send(self):
+        """Cancel the last email sent, including a delivery in progress"""
+        if self.send_batch is None:
+            return
+        if self.outbound.cancel(self.send_batch['id']):
+            self.send_batch['cancelled'] = True
+            self.log("Sending cancelled")
+        self.cancel_send_btn.config(state='disabled')
+    
+    def on_send_progress(self, msg_id, recipient, error):
+        """Outcome for one recipient from the outbound queue; called off the Tk thread"""
+        self.sink.call(self.record_send_progress, msg_id, recipient, error)
+    
+    def record_send_progress(self, msg_id, recipient, error):
+        """Update the Send tab with the outcome for one recipient"""
+        if self.send_batch is None or self.send_batch['id'] != msg_id:
+            return
+        if error is None:
+            state = 'delivered'
+        else:
+            state = 'failed' if is_permanent(error) else 'retrying'
+        self.send_batch['states'][recipient] = state
+        self.update_send_status()
+    
+    def refresh_send_status(self, msg_id):
+        """Poll until the last email sent has left the outbound queue"""
+        if self.send_batch is None or self.send_batch['id'] != msg_id:
+            return
+        if msg_id in self.outbound:
+            self.root.after(SEND_STATUS_INTERVAL, self.refresh_send_status, msg_id)
+            return
+        # Recipients still retrying were bounced after the last attempt
+        states = self.send_batch['states']
+        for recipient, state in states.items():
+            if state in ('waiting', 'retrying'):
+                states[recipient] = 'cancelled' if self.send_batch['cancelled'] else 'failed'
+        self.cancel_send_btn.config(state='disabled')
+        self.update_send_status(done=True)
+    
+    def update_send_status(self, done=False):
+        """Show how many recipients of the last email are in each state"""
+        states = list(self.send_batch['states'].values())
+        parts = [f"{states.count('delivered')} of {len(states)} delivered"]
+        for state in ('failed', 'retrying', 'cancelled'):
+            if states.count(state):
+                parts.append(f"{states.count(state)} {state}")
+        prefix = "Last email" if done else "Sending"
+        self.send_status_label.config(text=f"{prefix}: {', '.join(parts)}")
+    
+    def deliver_bounce(self, raw, recipient):
+        """Put a bounce from the outbound queue in the inbox; called from its workers"""
+        handler = EmailHandler(self.received_emails,
+                               FanoutSink(self.search_index, self.sink, self.server_log))
+        handler.deliver(raw, {'from': 'MAILER-DAEMON', 'to': [recipient],
+                              'subject': "Undelivered Mail Returned to Sender",
+                              'peer': None}, time.time())
     
     # Inbox methods
-    def add_email_to_inbox(self, email_data):
+    def inbox_row_count(self):
+        """Number of rows in the inbox list"""
+        if self.inbox_filter is not None:
+            return len(self.inbox_filter)
+        return len(self.received_emails)
+    
+    def inbox_row(self, pos):
+        """Return (message id, column values) for an inbox position"""
+        if self.inbox_filter is not None:
+            msg_id = self.inbox_filter[pos]
+            record = self.received_emails.get(msg_id)
+            if record is None:
+                return msg_id, ('', '', '', '(deleted)', '')
+        else:
+            record = self.received_emails[pos]
+        files = len(record.attachments) or ''
+        return record.id, (record.time, record.sender, record.to, record.subject, files)
+    
+    def add_email_to_inbox(self, record):
         """Add email to inbox list"""
-        idx = len(self.received_emails)
-        self.email_tree.insert('', 'end', text=str(idx), 
-                              values=(email_data['time'], email_data['from'], 
-                                     email_data['to'], email_data['subject']))
+        self.add_emails_to_inbox([record])
+    
+    def add_emails_to_inbox(self, emails):
+        """Show a batch of newly stored emails in the inbox list"""
+        # Rows are read from the store, so only the visible window is redrawn
+        self.email_list.refresh()
         self.update_email_count()
     
+    def update_queue_status(self, pending, dropped):
+        """Show whether the inbox is keeping up with the server"""
+        if dropped:
+            text = f"Dropped {dropped} updates - press Refresh"
+        elif pending:
+            text = f"Lagging: {pending} pending"
+        else:
+            text = ""
+        self.queue_status_label.config(text=text)
+    
     def update_email_count(self):
         """Update email count label"""
         count = len(self.received_emails)
-        self.email_count_label.config(text=f"Emails: {count}")
+        if self.inbox_filter is not None:
+            self.email_count_label.config(text=f"Matches: {len(self.inbox_filter)} of {count}")
+        else:
+            self.email_count_label.config(text=f"Emails: {count}")
+    
+    def search_inbox(self):
+        """Show only the emails matching the search box"""
+        query = self.search_entry.get().strip()
+        if not query:
+            self.clear_search()
+            return
+        try:
+            results = self.search_index.search(query)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        # The index returns newest first; the list shows newest at the bottom
+        self.inbox_filter = results[::-1]
+        self.email_list.follow_tail = True
+        self.email_list.refresh(invalidate=True)
+        self.update_email_count()
+        pending = self.search_index.pending()
+        if pending:
+            self.log(f"Search '{query}': {len(results)} match(es), {pending} email(s) not indexed yet")
+        else:
+            self.log(f"Search '{query}': {len(results)} match(es)")
+    
+    def clear_search(self):
+        """Go back to showing every email"""
+        self.search_entry.delete(0, tk.END)
+        if self.inbox_filter is None:
+            return
+        self.inbox_filter = None
+        self.selected_email_id = None
+        self.email_list.follow_tail = True
+        self.email_list.refresh(invalidate=True)
+        self.update_email_count()
     
     def clear_inbox(self):
         """Clear all emails from inbox"""
@@ -291,37 +533,59 @@ class EmailServerGUI:
         
         if messagebox.askyesno("Confirm", "Are you sure you want to clear all emails?"):
             self.received_emails.clear()
-            for item in self.email_tree.get_children():
-                self.email_tree.delete(item)
+            self.search_index.clear()
+            self.selected_email_id = None
+            self.save_attachments_button.config(state='disabled')
+            if self.inbox_filter is not None:
+                self.inbox_filter = []
+            self.email_list.refresh(invalidate=True)
             self.content_text.delete('1.0', tk.END)
             self.update_email_count()
             self.log("Inbox cleared")
     
     def refresh_inbox(self):
         """Refresh inbox display"""
-        for item in self.email_tree.get_children():
-            self.email_tree.delete(item)
-        
-        for idx, email_data in enumerate(self.received_emails, 1):
-            self.email_tree.insert('', 'end', text=str(idx), 
-                                  values=(email_data['time'], email_data['from'], 
-                                         email_data['to'], email_data['subject']))
+        self.sink.dropped = 0
+        self.email_list.refresh(invalidate=True)
         self.update_email_count()
         self.log("Inbox refreshed")
     
-    def on_email_select(self, event):
+    def on_email_select(self, msg_id):
         """Handle email selection"""
-        selection = self.email_tree.selection()
-        if selection:
-            item = self.email_tree.item(selection[0])
-            idx = int(item['text']) - 1
-            if 0 <= idx < len(self.received_emails):
-                email_data = self.received_emails[idx]
-                content = f"From: {email_data['from']}\n"
-                content += f"To: {email_data['to']}\n"
-                content += f"Subject: {email_data['subject']}\n"
-                content += f"Time: {email_data['time']}\n"
-                content += f"\n{email_data['body']}"
-                
-                self.content_text.delete('1.0', tk.END)
-                self.content_text.insert('1.0', content)
+        record = self.received_emails.get(msg_id)
+        self.selected_email_id = msg_id if record is not None else None
+        if record is not None:
+            content = f"From: {record.sender}\n"
+            content += f"To: {record.to}\n"
+            content += f"Subject: {record.subject}\n"
+            content += f"Time: {record.time}\n"
+            for attachment in record.attachments:
+                content += (f"Attachment: {attachment['filename'] or '(unnamed)'} "
+                            f"({attachment['content_type']}, {attachment['size']} bytes)\n")
+            content += f"\n{record.body}"
+            
+            self.content_text.delete('1.0', tk.END)
+            self.content_text.insert('1.0', content)
+            state = 'normal' if record.attachments else 'disabled'
+            self.save_attachments_button.config(state=state)
+    
+    def save_attachments(self):
+        """Save the attachments of the selected email to a folder"""
+        record = self.received_emails.get(self.selected_email_id)
+        if record is None or not record.attachments:
+            return
+        folder = filedialog.askdirectory(title="Save attachments to")
+        if not folder:
+            return
+        saved = 0
+        for attachment in record.attachments:
+            data = self.received_emails.attachments.get(attachment['sha256'])
+            if data is None:
+                self.log(f"Attachment {attachment['filename']} is missing from the store")
+                continue
+            # Never let a sender-chosen name escape the chosen folder
+            name = os.path.basename(attachment['filename']) or attachment['sha256'][:16]
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(data)
+            saved += 1
+        self.log(f"Saved {saved} attachment(s) to {folder}")
@@ -150,10 +150,17 @@ class SendTab:
         
         ttk.Button(button_frame, text="Clear Form", 
                   command=self.gui.clear_send_form).pack(side='left', padx=5)
+        self.gui.cancel_send_btn = ttk.Button(button_frame, text="Cancel Sending",
+                                              command=self.gui.cancel_send, state='disabled')
+        self.gui.cancel_send_btn.pack(side='left', padx=5)
         self.gui.send_btn = ttk.Button(button_frame, text="Send Email", 
                                        command=self.gui.send_email)
         self.gui.send_btn.pack(side='left', padx=5)
         
+        # Progress of the last email sent
+        self.gui.send_status_label = ttk.Label(fields_frame, text="")
+        self.gui.send_status_label.grid(row=8, column=1, sticky='w', padx=5)
+        
         fields_frame.columnconfigure(1, weight=1)
         fields_frame.rowconfigure(6, weight=1)
     
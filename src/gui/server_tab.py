@@ -1,7 +1,9 @@
 """Server tab UI components"""
 
 import tkinter as tk
-from tkinter import ttk, scrolledtext
+from tkinter import ttk
+
+from src.gui.log_view import LEVELS, LogView
 
 
 class ServerTab:
@@ -39,9 +41,45 @@ class ServerTab:
                                           foreground="red")
         self.gui.status_label.grid(row=1, column=0, columnspan=6, pady=5)
         
+        # Extra listeners on the running server
+        listeners_frame = ttk.LabelFrame(parent, text="Listeners", padding=10)
+        listeners_frame.pack(fill='x', padx=10)
+        
+        entry_frame = ttk.Frame(listeners_frame)
+        entry_frame.pack(fill='x', pady=(0, 5))
+        ttk.Label(entry_frame, text="Address:").pack(side='left', padx=(0, 5))
+        self.gui.listener_entry = ttk.Entry(entry_frame, width=25)
+        self.gui.listener_entry.insert(0, "0.0.0.0:587")
+        self.gui.listener_entry.pack(side='left', padx=5)
+        ttk.Button(entry_frame, text="Add",
+                   command=self.gui.add_listener).pack(side='left', padx=5)
+        ttk.Button(entry_frame, text="Remove Selected",
+                   command=self.gui.remove_listener).pack(side='left', padx=5)
+        
+        columns = ('sessions', 'active', 'refused', 'messages')
+        self.gui.listeners_tree = ttk.Treeview(listeners_frame, columns=columns, height=4)
+        self.gui.listeners_tree.heading('#0', text='Address')
+        self.gui.listeners_tree.column('#0', width=200)
+        for column in columns:
+            self.gui.listeners_tree.heading(column, text=column.capitalize())
+            self.gui.listeners_tree.column(column, width=90, anchor='e')
+        self.gui.listeners_tree.pack(fill='x')
+        
         # Server log
         log_frame = ttk.LabelFrame(parent, text="Server Log", padding=10)
         log_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        self.gui.log_text = scrolledtext.ScrolledText(log_frame, height=20, wrap=tk.WORD)
-        self.gui.log_text.pack(fill='both', expand=True)
+        filter_frame = ttk.Frame(log_frame)
+        filter_frame.pack(fill='x', pady=(0, 5))
+        ttk.Label(filter_frame, text="Show:").pack(side='left', padx=(0, 5))
+        level_combo = ttk.Combobox(filter_frame, values=LEVELS, state='readonly', width=10)
+        level_combo.set('INFO')
+        level_combo.pack(side='left')
+        level_combo.bind('<<ComboboxSelected>>',
+                         lambda e: self.gui.log_view.set_level(level_combo.get()))
+        ttk.Button(filter_frame, text="Clear",
+                   command=lambda: self.gui.log_view.clear()).pack(side='right')
+        
+        self.gui.log_view = LogView(log_frame, self.gui.server_log, height=20, wrap=tk.WORD)
+        self.gui.log_view.pack(fill='both', expand=True)
+        self.gui.log_text = self.gui.log_view.text
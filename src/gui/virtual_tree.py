@@ -0,0 +1,160 @@
+"""Virtualized Treeview for very large lists"""
+
+from tkinter import ttk
+
+
+class VirtualTreeview:
+    """Treeview that only materializes the rows currently on screen
+
+    Rows are identified by their position in a backing store. The widget
+    holds one item per visible row and rewrites their values as the view
+    scrolls, so refresh, scrolling and selection cost O(visible rows)
+    regardless of how many rows exist. A few rows above and below the
+    window are kept in a small cache to make short scrolls cheap.
+
+    ``row_count()`` returns the number of rows and ``load_row(pos)``
+    returns ``(row_id, values)`` for a position.
+    """
+    
+    def __init__(self, parent, columns, row_count, load_row, overscan=20, **kwargs):
+        self.row_count = row_count
+        self.load_row = load_row
+        self.overscan = overscan
+        
+        self.tree = ttk.Treeview(parent, columns=columns, selectmode='browse', **kwargs)
+        self.scrollbar = ttk.Scrollbar(parent, orient='vertical', command=self.yview)
+        
+        self.top = 0
+        self.visible = int(kwargs.get('height', 10))
+        self.selected_id = None
+        self.follow_tail = True
+        self._slots = []
+        self._cache = {}
+        self._on_select = None
+        
+        self.tree.bind('<<TreeviewSelect>>', self._handle_select)
+        self.tree.bind('<Configure>', self._handle_configure)
+        self.tree.bind('<MouseWheel>', self._handle_wheel)
+        self.tree.bind('<Button-4>', lambda e: self._scroll_by(-3))
+        self.tree.bind('<Button-5>', lambda e: self._scroll_by(3))
+        self.tree.bind('<Up>', lambda e: self._move_selection(-1))
+        self.tree.bind('<Down>', lambda e: self._move_selection(1))
+        self.tree.bind('<Prior>', lambda e: self._scroll_by(-self.visible))
+        self.tree.bind('<Next>', lambda e: self._scroll_by(self.visible))
+    
+    def pack(self):
+        """Pack the tree and its scrollbar side by side"""
+        self.tree.pack(side='left', fill='both', expand=True)
+        self.scrollbar.pack(side='right', fill='y')
+    
+    def bind_select(self, callback):
+        """Call ``callback(row_id)`` when the user selects a different row"""
+        self._on_select = callback
+    
+    def refresh(self, invalidate=False):
+        """Redraw the visible window, e.g. after rows were appended
+
+        Pass ``invalidate=True`` when existing rows changed or were
+        removed, not just appended.
+        """
+        if invalidate:
+            self._cache.clear()
+        count = self.row_count()
+        if self.follow_tail:
+            self.top = max(0, count - self.visible)
+        else:
+            self.top = max(0, min(self.top, count - self.visible))
+        self._render(count)
+    
+    def yview(self, *args):
+        """Scrollbar command handler"""
+        count = self.row_count()
+        if args[0] == 'moveto':
+            self._scroll_to(int(float(args[1]) * count), count)
+        elif args[0] == 'scroll':
+            step = int(args[1]) * (self.visible if args[2] == 'pages' else 1)
+            self._scroll_to(self.top + step, count)
+    
+    def _scroll_by(self, step):
+        self._scroll_to(self.top + step, self.row_count())
+        return 'break'
+    
+    def _scroll_to(self, top, count):
+        self.top = max(0, min(top, count - self.visible))
+        self.follow_tail = self.top + self.visible >= count
+        self._render(count)
+    
+    def _render(self, count):
+        rows = min(self.visible, max(0, count - self.top))
+        
+        # Grow or shrink the pool of widget items to the visible row count
+        while len(self._slots) < rows:
+            iid = self.tree.insert('', 'end')
+            self._slots.append([iid, None])
+        while len(self._slots) > rows:
+            iid, _ = self._slots.pop()
+            self.tree.delete(iid)
+        
+        selected_slot = None
+        for offset, slot in enumerate(self._slots):
+            pos = self.top + offset
+            row = self._cache.get(pos)
+            if row is None:
+                row = self.load_row(pos)
+                self._cache[pos] = row
+            row_id, values = row
+            slot[1] = row_id
+            self.tree.item(slot[0], text=str(pos + 1), values=values)
+            if row_id == self.selected_id:
+                selected_slot = slot[0]
+        
+        low, high = self.top - self.overscan, self.top + self.visible + self.overscan
+        for pos in [p for p in self._cache if p < low or p >= high]:
+            del self._cache[pos]
+        
+        current = self.tree.selection()
+        if selected_slot is None and current:
+            self.tree.selection_remove(*current)
+        elif selected_slot is not None and current != (selected_slot,):
+            self.tree.selection_set(selected_slot)
+        
+        if count:
+            self.scrollbar.set(self.top / count, (self.top + rows) / count)
+        else:
+            self.scrollbar.set(0, 1)
+    
+    def _move_selection(self, step):
+        selection = self.tree.selection()
+        count = self.row_count()
+        if not selection or not count:
+            return 'break'
+        offset = [slot[0] for slot in self._slots].index(selection[0])
+        pos = max(0, min(self.top + offset + step, count - 1))
+        if pos < self.top or pos >= self.top + self.visible:
+            self._scroll_to(pos if step < 0 else pos - self.visible + 1, count)
+        self.tree.selection_set(self._slots[pos - self.top][0])
+        return 'break'
+    
+    def _handle_select(self, event):
+        selection = self.tree.selection()
+        if not selection:
+            return
+        for iid, row_id in self._slots:
+            if iid == selection[0]:
+                if row_id != self.selected_id:
+                    self.selected_id = row_id
+                    if self._on_select:
+                        self._on_select(row_id)
+                return
+    
+    def _handle_configure(self, event):
+        rowheight = ttk.Style().lookup('Treeview', 'rowheight') or 20
+        visible = max(1, (event.height - int(rowheight)) // int(rowheight))
+        if visible != self.visible:
+            self.visible = visible
+            self.refresh()
+    
+    def _handle_wheel(self, event):
+        # Windows reports multiples of 120, macOS small deltas
+        step = -event.delta // 120 if abs(event.delta) >= 120 else -event.delta
+        return self._scroll_by(step * 3)
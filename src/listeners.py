@@ -0,0 +1,240 @@
+"""Several SMTP listeners served from one event loop
+
+ListenerGroup runs one asyncio event loop in a single thread and binds
+any number of addresses on it, so listening on ports 25, 587, 1025 and
+an IPv6 address costs one thread rather than four. Listeners can be
+added and removed while the others keep serving. Removing one stops new
+connections on it; sessions already open on it run to completion.
+
+Stopping can be graceful: drain() answers new connections with 421 and
+waits for open sessions to finish. A new group can take_over() the
+listening sockets of a running one, so a restart never refuses a
+connection attempt while the old group drains.
+"""
+
+import asyncio
+import socket
+import threading
+import time
+
+from src.spooling import DEFAULT_SPOOL_THRESHOLD, SpoolingSMTP
+
+
+START_TIMEOUT = 10.0
+DRAIN_TIMEOUT = 30.0
+DRAIN_POLL = 0.05
+
+
+def format_address(host, port):
+    """Return ``host:port``, bracketing IPv6 hosts"""
+    if ':' in host:
+        return f"[{host}]:{port}"
+    return f"{host}:{port}"
+
+
+def parse_address(text, default_host='localhost'):
+    """Parse ``host:port``, ``[v6]:port`` or a bare port into (host, port)"""
+    text = text.strip()
+    if text.startswith('['):
+        host, sep, port = text[1:].partition(']:')
+        if not sep:
+            raise ValueError(f"Invalid address: {text}")
+    elif text.count(':') == 1:
+        host, _, port = text.partition(':')
+    else:
+        host, port = '', text
+    try:
+        port = int(port)
+    except ValueError:
+        raise ValueError(f"Invalid port in address: {text}")
+    if not 0 <= port <= 65535:
+        raise ValueError(f"Port out of range in address: {text}")
+    return host or default_host, port
+
+
+class Listener:
+    """A bound address and the sessions and messages it has seen"""
+    
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.servers = []
+        self.draining = False
+        self.sessions = 0
+        self.active = 0
+        self.refused = 0
+        self.messages = 0
+    
+    @property
+    def address(self):
+        return format_address(self.host, self.port)
+    
+    def stats(self):
+        return {
+            'sessions': self.sessions,
+            'active': self.active,
+            'refused': self.refused,
+            'messages': self.messages,
+        }
+
+
+class ListenerGroup:
+    """SpoolingSMTP listeners sharing one event loop thread
+
+    Every listener uses the same handler and AdmissionControl, so session
+    limits apply across all of them. Listeners are keyed by their
+    ``host:port`` address; binding port 0 picks a free port.
+    """
+    
+    def __init__(self, handler, spool_threshold=DEFAULT_SPOOL_THRESHOLD, spool_dir=None,
+                 admission=None, **smtp_kwargs):
+        self.handler = handler
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.admission = admission
+        self.smtp_kwargs = dict(smtp_kwargs)
+        self.smtp_kwargs.setdefault('enable_SMTPUTF8', True)
+        self.loop = None
+        self._listeners = {}
+        # Removed listeners whose sessions may still be open
+        self._retired = []
+        self._lock = threading.Lock()
+        self._stop_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Start the event loop thread; listeners are bound with add()"""
+        # Resolve once instead of once per connection
+        self.smtp_kwargs.setdefault('hostname', socket.getfqdn())
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name='smtp-listeners', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Close every listener, cancel open sessions and end the loop thread"""
+        self._stopped.set()
+        with self._stop_lock:
+            if self._thread is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+            self.loop = None
+            with self._lock:
+                self._listeners = {}
+                self._retired = []
+    
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Refuse new sessions with 421 and wait up to ``timeout`` seconds for open ones
+
+        Returns the number of sessions still open when it gave up; stop()
+        cancels those. Returns early if the group is stopped meanwhile.
+        """
+        for listener in self.listeners():
+            listener.draining = True
+        deadline = time.monotonic() + timeout
+        while self.active() and time.monotonic() < deadline:
+            if self._stopped.wait(DRAIN_POLL):
+                break
+        return self.active()
+    
+    def take_over(self, other):
+        """Serve the listeners of running group ``other`` on the same sockets
+
+        This group starts accepting on duplicates of ``other``'s listening
+        sockets before ``other`` closes its own, so the sockets stay bound
+        throughout. Sessions already open stay with ``other``, which should
+        then be drained and stopped.
+        """
+        for old in other.listeners():
+            listener = Listener(old.host, old.port)
+            # Counters carry on; sessions still open on ``other`` are not
+            # counted here
+            listener.sessions, listener.refused, listener.messages = (
+                old.sessions, old.refused, old.messages)
+            socks = [socket.fromfd(sock.fileno(), sock.family, sock.type)
+                     for server in old.servers for sock in server.sockets]
+            future = asyncio.run_coroutine_threadsafe(self._adopt(listener, socks), self.loop)
+            future.result(START_TIMEOUT)
+            with self._lock:
+                self._listeners[listener.address] = listener
+            other.remove(old.address)
+    
+    def active(self):
+        """Number of sessions open on this group, including removed listeners"""
+        with self._lock:
+            self._retired = [listener for listener in self._retired if listener.active]
+            return (sum(listener.active for listener in self._listeners.values())
+                    + sum(listener.active for listener in self._retired))
+    
+    def add(self, host, port):
+        """Bind a new listener and return it; raises OSError if binding fails"""
+        listener = Listener(host, port)
+        with self._lock:
+            if listener.address in self._listeners:
+                raise ValueError(f"Already listening on {listener.address}")
+        future = asyncio.run_coroutine_threadsafe(self._bind(listener), self.loop)
+        future.result(START_TIMEOUT)
+        with self._lock:
+            self._listeners[listener.address] = listener
+        return listener
+    
+    def remove(self, address):
+        """Stop accepting on ``address``; returns False if it is not bound"""
+        with self._lock:
+            listener = self._listeners.pop(address, None)
+            if listener is not None:
+                self._retired.append(listener)
+        if listener is None:
+            return False
+        future = asyncio.run_coroutine_threadsafe(self._unbind(listener), self.loop)
+        future.result(START_TIMEOUT)
+        return True
+    
+    def listeners(self):
+        """The bound listeners, in the order they were added"""
+        with self._lock:
+            return list(self._listeners.values())
+    
+    def stats(self):
+        """Per-listener counters keyed by address"""
+        return {listener.address: listener.stats() for listener in self.listeners()}
+    
+    def _factory(self, listener):
+        return SpoolingSMTP(self.handler, spool_threshold=self.spool_threshold,
+                            spool_dir=self.spool_dir, admission=self.admission,
+                            listener=listener, **self.smtp_kwargs)
+    
+    async def _bind(self, listener):
+        server = await self.loop.create_server(
+            lambda: self._factory(listener), listener.host, listener.port)
+        listener.servers = [server]
+        if listener.port == 0:
+            listener.port = server.sockets[0].getsockname()[1]
+    
+    async def _adopt(self, listener, socks):
+        for sock in socks:
+            listener.servers.append(await self.loop.create_server(
+                lambda: self._factory(listener), sock=sock))
+    
+    async def _unbind(self, listener):
+        # Closes the listening sockets only; wait_closed() would also wait
+        # for the sessions still running on them
+        for server in listener.servers:
+            server.close()
+    
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            for listener in self.listeners():
+                for server in listener.servers:
+                    server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            # Let cancelled sessions run their cleanup, e.g. closing spools
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            self.loop.close()
@@ -0,0 +1,930 @@
+"""Durable append-only store for received messages"""
+
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+from src.attachments import AttachmentStore
+from src.compression import (DICTIONARY_SAMPLE_SIZE, DICTIONARY_SIZE, FRAME_HEADER,
+                             build_dictionary, get_codec)
+from src.message_record import MessageRecord
+from src.metrics import BODY_PARSE_SECONDS
+from src.parsing import parse_body
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser('~'), '.email_server', 'mailstore')
+
+# magic, message id, timestamp, meta length, raw length, crc32(meta + raw)
+RECORD_HEADER = struct.Struct('<4sQdIQI')
+RECORD_MAGIC = b'EMR1'
+# Same layout, with the raw message stored as a compressed frame
+FRAME_MAGIC = b'EMZ1'
+
+# message id, segment number, offset, record length, timestamp
+INDEX_ENTRY = struct.Struct('<QIQQd')
+TOMBSTONE = struct.Struct('<Q')
+
+INDEX_FILE = 'index.dat'
+TOMBSTONE_FILE = 'tombstones.dat'
+SEGMENT_PREFIX = 'seg-'
+SEGMENT_SUFFIX = '.log'
+COMPACT_SUFFIX = '.compact'
+LOCK_FILE = 'lock'
+BLOB_DIR = 'blobs'
+DICTIONARY_PREFIX = 'dict-'
+DICTIONARY_SUFFIX = '.bin'
+CHUNK_SIZE = 64 * 1024
+# Compressed copies of larger messages are built in a temporary file
+SPOOL_IN_MEMORY = 1024 * 1024
+
+DEFAULT_CODEC = 'zlib'
+DICTIONARY_SAMPLES = 2000
+MIN_DICTIONARY_SAMPLES = 200
+
+
+class StoreLocked(Exception):
+    """Another process has the mail store open"""
+
+
+class EntryTable:
+    """Index entries kept column-wise in typed arrays
+
+    Behaves like a list of INDEX_ENTRY tuples, which are built on access.
+    A list of tuples costs around 200 bytes per message in object
+    overhead; the columns take 36.
+    """
+    
+    __slots__ = ('ids', 'segments', 'offsets', 'lengths', 'timestamps')
+    
+    def __init__(self, entries=()):
+        self.ids = array('Q')
+        self.segments = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('Q')
+        self.timestamps = array('d')
+        for entry in entries:
+            self.append(entry)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return (self.ids[idx], self.segments[idx], self.offsets[idx],
+                self.lengths[idx], self.timestamps[idx])
+    
+    def __delitem__(self, idx):
+        for column in self._columns():
+            del column[idx]
+    
+    def __iter__(self):
+        return zip(*self._columns())
+    
+    def append(self, entry):
+        for column, value in zip(self._columns(), entry):
+            column.append(value)
+    
+    def _columns(self):
+        return self.ids, self.segments, self.offsets, self.lengths, self.timestamps
+
+
+class MailStore:
+    """Segment-file message store with a compact offset index
+
+    Raw messages are appended to segment files together with a small JSON
+    header block (from, to, subject, peer). Every append also writes a
+    fixed-size entry to the index file. Writes are fsynced in batches by a
+    background thread, so a crash loses at most one ``fsync_interval``
+    worth of messages. Reads go through memory-mapped segments.
+
+    The store behaves like a read-only sequence of MessageRecords, oldest
+    first, so it can stand in for the old ``received_emails`` list. Only
+    the index is held in memory, in an EntryTable.
+
+    Attachments cut out of messages live in ``attachments``, an
+    AttachmentStore under the same directory. A message's ``attachments``
+    metadata holds the blobs it references; they are released when the
+    message is deleted.
+
+    Raw messages are compressed with ``codec`` (None stores them as they
+    are) unless that would not make them smaller. train_dictionary(), or
+    ``auto_dictionary`` once enough mail has arrived, builds a shared
+    dictionary from stored mail for compressing new messages.
+    
+    One process at a time may open a store directory; opening it again
+    while it is open raises StoreLocked.
+    """
+    
+    def __init__(self, path=DEFAULT_STORE_DIR, segment_size=64 * 1024 * 1024,
+                 fsync_interval=0.05, fsync_batch=256, retention=None,
+                 compact_ratio=0.5, maintenance_interval=60.0, body_cache_size=128,
+                 body_parse_limit=16 * 1024 * 1024, codec=DEFAULT_CODEC,
+                 compress_level=6, auto_dictionary=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.retention = retention
+        self.compact_ratio = compact_ratio
+        self.maintenance_interval = maintenance_interval
+        self.body_cache_size = body_cache_size
+        self.body_parse_limit = body_parse_limit
+        self.codec = codec
+        self.compress_level = compress_level
+        self.auto_dictionary = auto_dictionary
+        
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        # Held for a whole compaction, which copies without _lock
+        self._compact_lock = threading.Lock()
+        self._compacting = set()
+        self._closing = False
+        self._wakeup = threading.Event()
+        self._closed = False
+        
+        self._entries = EntryTable()
+        self._dead = {}  # segment number -> {msg_id: index entry}
+        self._maps = {}
+        self._bodies = OrderedDict()
+        self._pending = 0
+        self._segment = None
+        self._segment_no = 0
+        self._index = None
+        self._tombstones = None
+        self._next_id = 1
+        self._dictionaries = {}
+        self._codecs = {}
+        self._encoder = None
+        self._lock_file = None
+        
+        os.makedirs(self.path, exist_ok=True)
+        self._acquire_lock()
+        self._recover()
+        self._open_files()
+        self._load_dictionaries()
+        
+        self.attachments = AttachmentStore(os.path.join(self.path, BLOB_DIR))
+        if not self.attachments.load(self._state_marker()) and self.attachments.has_blobs():
+            self.attachments.rebuild(self._count_attachments())
+        
+        self._flusher = threading.Thread(target=self._run_flusher,
+                                         name='mailstore-flusher', daemon=True)
+        self._flusher.start()
+    
+    # Sequence interface
+    def __len__(self):
+        return len(self._entries)
+    
+    def __bool__(self):
+        return bool(self._entries)
+    
+    def __getitem__(self, idx):
+        with self._lock:
+            entry = self._entries[idx]
+        return self._load_email(entry)
+    
+    def __iter__(self):
+        for idx in range(len(self._entries)):
+            try:
+                yield self[idx]
+            except IndexError:
+                return
+    
+    # Writing
+    def append(self, raw, meta, timestamp=None):
+        """Append a raw message with its metadata, return the message id
+        
+        ``raw`` is either bytes or a readable binary file, which is copied
+        into the segment in chunks without loading it into memory.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+        magic, payload, size, crc = self._encode(raw, zlib.crc32(meta_bytes))
+        try:
+            return self._append_record(magic, payload, size, crc, meta_bytes, timestamp)
+        finally:
+            if payload is not raw and not isinstance(payload, bytes):
+                payload.close()
+    
+    def _append_record(self, magic, payload, size, crc, meta_bytes, timestamp):
+        with self._lock:
+            if self._closed:
+                raise ValueError("Mail store is closed")
+            if self._segment.tell() >= self.segment_size:
+                self._roll_segment()
+            
+            msg_id = self._next_id
+            self._next_id += 1
+            header = RECORD_HEADER.pack(magic, msg_id, timestamp,
+                                        len(meta_bytes), size, crc)
+            offset = self._segment.tell()
+            self._segment.write(header)
+            self._segment.write(meta_bytes)
+            if isinstance(payload, (bytes, bytearray)):
+                self._segment.write(payload)
+            else:
+                shutil.copyfileobj(payload, self._segment, CHUNK_SIZE)
+            
+            entry = (msg_id, self._segment_no, offset,
+                     RECORD_HEADER.size + len(meta_bytes) + size, timestamp)
+            self._index.write(INDEX_ENTRY.pack(*entry))
+            self._entries.append(entry)
+            
+            self._pending += 1
+            if self._pending >= self.fsync_batch:
+                self._wakeup.set()
+        return msg_id
+    
+    def delete(self, msg_id):
+        """Mark a message as deleted; space is reclaimed by compact()"""
+        with self._lock:
+            pos = self._position(msg_id)
+            if pos is None:
+                return False
+            self._remove_positions([pos])
+            self._pending += 1
+        return True
+    
+    def clear(self):
+        """Delete every stored message and its files"""
+        with self._compact_lock, self._lock, self._sync_lock:
+            self._close_files()
+            for name in os.listdir(self.path):
+                if (name.startswith((SEGMENT_PREFIX, DICTIONARY_PREFIX))
+                        or name in (INDEX_FILE, TOMBSTONE_FILE)):
+                    os.remove(os.path.join(self.path, name))
+            self._entries = EntryTable()
+            self._dead = {}
+            self._bodies.clear()
+            self._segment_no = 0
+            self._open_files()
+            self._load_dictionaries()
+            self.attachments.clear()
+    
+    # Reading
+    def get(self, msg_id):
+        """Return the MessageRecord for a message id, or None"""
+        with self._lock:
+            pos = self._position(msg_id)
+            if pos is None:
+                return None
+            entry = self._entries[pos]
+        return self._load_email(entry)
+    
+    def get_position(self, msg_id):
+        """Return the position of a message id, or None if it is not stored"""
+        with self._lock:
+            return self._position(msg_id)
+    
+    def ids_after(self, msg_id):
+        """Return the ids of stored messages newer than ``msg_id``"""
+        with self._lock:
+            ids = self._entries.ids
+            return ids[bisect.bisect_right(ids, msg_id):].tolist()
+    
+    def get_raw(self, msg_id):
+        """Return the raw RFC 5322 bytes of a message, or None"""
+        with self._lock:
+            pos = self._position(msg_id)
+            if pos is None:
+                return None
+            entry = self._entries[pos]
+        header, _, raw = self._read_record(entry)
+        if header[0] == FRAME_MAGIC:
+            codec_id, dict_id, _ = FRAME_HEADER.unpack_from(raw)
+            decompressor = self._codec(codec_id, dict_id).decompressobj()
+            raw = decompressor.decompress(memoryview(raw)[FRAME_HEADER.size:])
+            raw += decompressor.flush()
+        return raw
+    
+    def iter_raw(self, msg_id, chunk_size=CHUNK_SIZE):
+        """Yield the raw bytes of a message in chunks"""
+        done = 0
+        decompressor = None
+        while True:
+            with self._lock:
+                # Look the entry up again each time; compaction may move it
+                pos = self._position(msg_id)
+                if pos is None:
+                    return
+                _, segment_no, offset, length, _ = self._entries[pos]
+                buf = self._map(segment_no, offset + length)
+                header = RECORD_HEADER.unpack_from(buf, offset)
+                start = offset + RECORD_HEADER.size + header[3]
+                if header[0] == FRAME_MAGIC and not done:
+                    codec_id, dict_id, _ = FRAME_HEADER.unpack_from(buf, start)
+                    decompressor = self._codec(codec_id, dict_id).decompressobj()
+                    done = FRAME_HEADER.size
+                start += done
+                chunk = buf[start:start + min(chunk_size, header[4] - done)]
+            if not chunk:
+                if decompressor is not None:
+                    tail = decompressor.flush()
+                    if tail:
+                        yield tail
+                return
+            done += len(chunk)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+    
+    def body(self, msg_id):
+        """Return the text/plain body of a stored message
+        
+        Bodies are only parsed when first requested and the most recently
+        used ones are memoized.
+        """
+        with self._lock:
+            body = self._bodies.get(msg_id)
+            if body is not None:
+                self._bodies.move_to_end(msg_id)
+                return body
+            if self._position(msg_id) is None:
+                return ''
+        start = time.perf_counter()
+        body = parse_body(self.iter_raw(msg_id), self.body_parse_limit)
+        BODY_PARSE_SECONDS.observe(time.perf_counter() - start)
+        with self._lock:
+            self._bodies[msg_id] = body
+            if len(self._bodies) > self.body_cache_size:
+                self._bodies.popitem(last=False)
+        return body
+    
+    # Compression
+    def train_dictionary(self, samples=DICTIONARY_SAMPLES, size=DICTIONARY_SIZE):
+        """Build a dictionary from recent mail and compress new messages with it
+
+        Returns the new dictionary id, or None if compression is off or
+        there is too little mail to learn from. Older dictionaries are kept
+        for the records compressed with them.
+        """
+        if self.codec is None:
+            return None
+        with self._lock:
+            entries = self._entries[-samples:]
+        if len(entries) < MIN_DICTIONARY_SAMPLES:
+            return None
+        heads = [next(self.iter_raw(entry[0], DICTIONARY_SAMPLE_SIZE), b'')
+                 for entry in entries]
+        dictionary = build_dictionary(heads, size)
+        if not dictionary:
+            return None
+        with self._lock:
+            dict_id = max(self._dictionaries, default=0) + 1
+            path = self._dictionary_path(dict_id)
+            # Durable before any record that needs it can be synced
+            with open(path + '.tmp', 'wb') as f:
+                f.write(dictionary)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            self._dictionaries[dict_id] = dictionary
+            self._set_encoder()
+        return dict_id
+    
+    def _encode(self, raw, crc):
+        """Compress a raw message into a frame if that makes it smaller
+
+        ``crc`` is the checksum of the metadata. Returns the record magic,
+        the payload (bytes, or a file positioned at its start), its size
+        and the record checksum.
+        """
+        encoder = self._encoder
+        if isinstance(raw, (bytes, bytearray)):
+            if encoder is not None:
+                codec_id, dict_id, codec = encoder
+                compressor = codec.compressobj()
+                payload = (FRAME_HEADER.pack(codec_id, dict_id, len(raw))
+                           + compressor.compress(raw) + compressor.flush())
+                if len(payload) < len(raw):
+                    return FRAME_MAGIC, payload, len(payload), zlib.crc32(payload, crc)
+            return RECORD_MAGIC, raw, len(raw), zlib.crc32(raw, crc)
+        
+        raw.seek(0)
+        size = 0
+        raw_crc = crc
+        if encoder is None:
+            for chunk in iter(lambda: raw.read(CHUNK_SIZE), b''):
+                raw_crc = zlib.crc32(chunk, raw_crc)
+                size += len(chunk)
+            raw.seek(0)
+            return RECORD_MAGIC, raw, size, raw_crc
+        
+        codec_id, dict_id, codec = encoder
+        compressor = codec.compressobj()
+        payload = tempfile.SpooledTemporaryFile(max_size=SPOOL_IN_MEMORY)
+        try:
+            # The uncompressed size is patched in once it is known
+            payload.write(FRAME_HEADER.pack(codec_id, dict_id, 0))
+            for chunk in iter(lambda: raw.read(CHUNK_SIZE), b''):
+                raw_crc = zlib.crc32(chunk, raw_crc)
+                size += len(chunk)
+                payload.write(compressor.compress(chunk))
+            payload.write(compressor.flush())
+            stored = payload.tell()
+            raw.seek(0)
+            if stored >= size:
+                payload.close()
+                return RECORD_MAGIC, raw, size, raw_crc
+            payload.seek(0)
+            payload.write(FRAME_HEADER.pack(codec_id, dict_id, size))
+            payload.seek(0)
+            for chunk in iter(lambda: payload.read(CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+            payload.seek(0)
+        except BaseException:
+            payload.close()
+            raise
+        return FRAME_MAGIC, payload, stored, crc
+    
+    def _codec(self, codec_id, dict_id):
+        """Return a codec instance for reading or writing frames"""
+        with self._lock:
+            codec = self._codecs.get((codec_id, dict_id))
+            if codec is None:
+                dictionary = None
+                if dict_id:
+                    dictionary = self._dictionaries.get(dict_id)
+                    if dictionary is None:
+                        raise IOError(f"Missing compression dictionary {dict_id}")
+                codec = get_codec(codec_id)(self.compress_level, dictionary)
+                self._codecs[(codec_id, dict_id)] = codec
+            return codec
+    
+    def _set_encoder(self):
+        if self.codec is None:
+            self._encoder = None
+            return
+        codec_id = get_codec(self.codec).id
+        dict_id = max(self._dictionaries, default=0)
+        self._encoder = (codec_id, dict_id, self._codec(codec_id, dict_id))
+    
+    def _load_dictionaries(self):
+        self._dictionaries = {}
+        self._codecs = {}
+        for name in os.listdir(self.path):
+            if name.startswith(DICTIONARY_PREFIX) and name.endswith(DICTIONARY_SUFFIX):
+                with open(os.path.join(self.path, name), 'rb') as f:
+                    dict_id = int(name[len(DICTIONARY_PREFIX):-len(DICTIONARY_SUFFIX)])
+                    self._dictionaries[dict_id] = f.read()
+        self._set_encoder()
+    
+    def _dictionary_path(self, dict_id):
+        return os.path.join(self.path, f'{DICTIONARY_PREFIX}{dict_id:06d}{DICTIONARY_SUFFIX}')
+    
+    # Durability
+    def flush(self, sync=True):
+        """Write buffered records to disk, optionally fsyncing them"""
+        with self._lock:
+            if self._closed:
+                return
+            self._segment.flush()
+            self._index.flush()
+            self._tombstones.flush()
+            if not sync or not self._pending:
+                return
+            self._pending = 0
+            files = (self._segment, self._index, self._tombstones)
+            # Hold the sync lock before releasing the write lock so the
+            # files cannot be closed or rolled while fsync is running.
+            self._sync_lock.acquire()
+        try:
+            for f in files:
+                os.fsync(f.fileno())
+        finally:
+            self._sync_lock.release()
+    
+    def close(self):
+        """Flush pending writes and release all files"""
+        with self._lock:
+            if self._closed:
+                return
+            # Makes a running compaction give up at its next record
+            self._closing = True
+        with self._compact_lock:
+            self.flush()
+            with self._lock, self._sync_lock:
+                self._closed = True
+                self._close_files()
+                self.attachments.save(self._state_marker())
+                self._release_lock()
+        self._wakeup.set()
+    
+    # Maintenance
+    def purge_expired(self, now=None):
+        """Drop messages older than the retention period"""
+        if not self.retention:
+            return 0
+        cutoff = (now if now is not None else time.time()) - self.retention
+        with self._lock:
+            expired = 0
+            timestamps = self._entries.timestamps
+            while expired < len(timestamps) and timestamps[expired] < cutoff:
+                expired += 1
+            if expired:
+                self._remove_positions(range(expired))
+                self._pending += 1
+            self._drop_dead_segments()
+        return expired
+    
+    def compact(self):
+        """Rewrite sealed segments that are mostly deleted records
+
+        Live records are copied and synced without the store lock, so
+        appends and reads carry on meanwhile; the lock is only taken to
+        pick the segments and to swap the rewritten ones in.
+        """
+        with self._compact_lock:
+            with self._lock:
+                if self._closed:
+                    return 0
+                self._drop_dead_segments()
+                candidates = []
+                for segment_no, dead in self._dead.items():
+                    if segment_no == self._segment_no:
+                        continue
+                    size = os.path.getsize(self._segment_path(segment_no))
+                    dead_bytes = sum(entry[3] for entry in dead.values())
+                    if size and dead_bytes / size >= self.compact_ratio:
+                        candidates.append(segment_no)
+                if not candidates:
+                    return 0
+                
+                self._index.flush()
+                moves = {n: self._plan_rewrite(n) for n in candidates}
+                staged = [moves[e[1]][e[0]][1] if e[1] in moves else e
+                          for e in self._entries]
+                staged += [entry for segment_no, dead in self._dead.items()
+                           if segment_no not in moves for entry in dead.values()]
+                index_end = self._index.tell()
+                self._compacting.update(candidates)
+            
+            # The new index is staged before the .compact segments and
+            # committed by renaming it into place; _recover() rolls back
+            # anything staged before that point and forward after it.
+            index_path = os.path.join(self.path, INDEX_FILE)
+            try:
+                self._write_entries(index_path + '.tmp', sorted(staged))
+                for segment_no in candidates:
+                    self._write_compacted(segment_no, moves[segment_no].values())
+                with self._lock:
+                    if self._closed:
+                        raise ValueError("Mail store is closed")
+                    self._swap_compacted(moves, index_end)
+            except BaseException:
+                self._discard_compacted(candidates)
+                raise
+            finally:
+                with self._lock:
+                    self._compacting.difference_update(candidates)
+        return len(candidates)
+    
+    # Internals
+    def _acquire_lock(self):
+        """Lock the directory against other writers; raise StoreLocked"""
+        f = open(os.path.join(self.path, LOCK_FILE), 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            raise StoreLocked(f"Mail store {self.path} is in use by another program")
+        self._lock_file = f
+    
+    def _release_lock(self):
+        if self._lock_file is not None:
+            # Closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+    
+    def _segment_path(self, segment_no):
+        return os.path.join(self.path, f'{SEGMENT_PREFIX}{segment_no:06d}{SEGMENT_SUFFIX}')
+    
+    def _segment_numbers(self):
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(numbers)
+    
+    def _position(self, msg_id):
+        ids = self._entries.ids
+        pos = bisect.bisect_left(ids, msg_id)
+        if pos < len(ids) and ids[pos] == msg_id:
+            return pos
+        return None
+    
+    def _remove_positions(self, positions):
+        positions = sorted(set(positions), reverse=True)
+        for pos in positions:
+            entry = self._entries[pos]
+            if len(self.attachments):
+                for digest in self._attachment_digests(entry):
+                    self.attachments.release(digest)
+            self._bodies.pop(entry[0], None)
+            self._tombstones.write(TOMBSTONE.pack(entry[0]))
+            self._dead.setdefault(entry[1], {})[entry[0]] = entry
+        if len(positions) == len(self._entries):
+            self._entries = EntryTable()
+            return
+        for pos in positions:
+            del self._entries[pos]
+    
+    def _drop_dead_segments(self):
+        live = set(self._entries.segments)
+        for segment_no in list(self._dead):
+            if (segment_no == self._segment_no or segment_no in live
+                    or segment_no in self._compacting):
+                continue
+            self._unmap(segment_no)
+            try:
+                os.remove(self._segment_path(segment_no))
+            except FileNotFoundError:
+                pass
+            del self._dead[segment_no]
+    
+    def _attachment_digests(self, entry):
+        _, meta, _ = self._read_record(entry, with_raw=False)
+        return [a['sha256'] for a in json.loads(meta).get('attachments', ())]
+    
+    def _count_attachments(self):
+        """Recount blob references from the live records"""
+        refs = {}
+        for entry in self._entries:
+            for digest in self._attachment_digests(entry):
+                refs[digest] = refs.get(digest, 0) + 1
+        return refs
+    
+    def _state_marker(self):
+        return [self._next_id, len(self._entries)]
+    
+    def _load_email(self, entry):
+        _, meta, _ = self._read_record(entry, with_raw=False)
+        meta = json.loads(meta)
+        return MessageRecord(entry[0], entry[4], meta.get('from', ''), meta.get('to', ()),
+                             meta.get('subject', ''), meta.get('peer'),
+                             meta.get('attachments', ()), store=self)
+    
+    def _read_record(self, entry, with_raw=True):
+        msg_id, segment_no, offset, length, _ = entry
+        with self._lock:
+            buf = self._map(segment_no, offset + length)
+            header = RECORD_HEADER.unpack_from(buf, offset)
+            if header[0] not in (RECORD_MAGIC, FRAME_MAGIC) or header[1] != msg_id:
+                raise IOError(f"Corrupt record {msg_id} in segment {segment_no}")
+            meta_start = offset + RECORD_HEADER.size
+            raw_start = meta_start + header[3]
+            meta = buf[meta_start:raw_start]
+            raw = buf[raw_start:raw_start + header[4]] if with_raw else None
+        return header, meta, raw
+    
+    def _map(self, segment_no, needed):
+        with self._lock:
+            mapped = self._maps.get(segment_no)
+            if mapped is not None and len(mapped) >= needed:
+                return mapped
+            if segment_no == self._segment_no and not self._closed:
+                self._segment.flush()
+            if mapped is not None:
+                self._unmap(segment_no)
+            with open(self._segment_path(segment_no), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment_no] = mapped
+            return mapped
+    
+    def _unmap(self, segment_no):
+        mapped = self._maps.pop(segment_no, None)
+        if mapped is not None:
+            mapped.close()
+    
+    def _open_files(self):
+        numbers = self._segment_numbers()
+        self._segment_no = numbers[-1] if numbers else 1
+        self._segment = open(self._segment_path(self._segment_no), 'ab')
+        self._index = open(os.path.join(self.path, INDEX_FILE), 'ab')
+        self._tombstones = open(os.path.join(self.path, TOMBSTONE_FILE), 'ab')
+    
+    def _close_files(self):
+        for segment_no in list(self._maps):
+            self._unmap(segment_no)
+        for f in (self._segment, self._index, self._tombstones):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+        self._segment = self._index = self._tombstones = None
+    
+    def _roll_segment(self):
+        with self._sync_lock:
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._segment.close()
+            self._segment_no += 1
+            self._segment = open(self._segment_path(self._segment_no), 'ab')
+    
+    def _plan_rewrite(self, segment_no):
+        """Map each live record of a segment to its compacted entry"""
+        moves = {}
+        offset = 0
+        for entry in self._entries:
+            if entry[1] == segment_no:
+                moves[entry[0]] = (entry, (entry[0], segment_no, offset, entry[3], entry[4]))
+                offset += entry[3]
+        return moves
+    
+    def _write_compacted(self, segment_no, moves):
+        """Copy the live records of a sealed segment to its .compact file; lock not held"""
+        with open(self._segment_path(segment_no), 'rb') as src, \
+                open(self._segment_path(segment_no) + COMPACT_SUFFIX, 'wb') as out:
+            for old, _ in moves:
+                if self._closing:
+                    raise ValueError("Mail store is closed")
+                src.seek(old[2])
+                remaining = old[3]
+                while remaining:
+                    chunk = src.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError(f"Segment {segment_no} ends inside record {old[0]}")
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+    
+    def _swap_compacted(self, moves, index_end):
+        """Commit the staged index and segments; lock held
+
+        Records appended during the copy are added to the staged index,
+        and records deleted during it stay tombstoned at their new place.
+        """
+        index_path = os.path.join(self.path, INDEX_FILE)
+        self._index.flush()
+        with open(index_path, 'rb') as f:
+            f.seek(index_end)
+            appended = f.read()
+        with open(index_path + '.tmp', 'ab') as f:
+            f.write(appended)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._sync_lock:
+            self._index.close()
+            os.replace(index_path + '.tmp', index_path)
+            self._index = open(index_path, 'ab')
+        for segment_no, moved in moves.items():
+            self._unmap(segment_no)
+            os.replace(self._segment_path(segment_no) + COMPACT_SUFFIX,
+                       self._segment_path(segment_no))
+            dead = {msg_id: moved[msg_id][1] for msg_id in self._dead.get(segment_no, ())
+                    if msg_id in moved}
+            if dead:
+                self._dead[segment_no] = dead
+            else:
+                self._dead.pop(segment_no, None)
+        self._entries = EntryTable([moves[e[1]][e[0]][1] if e[1] in moves else e
+                                    for e in self._entries])
+    
+    def _discard_compacted(self, candidates):
+        paths = [os.path.join(self.path, INDEX_FILE) + '.tmp']
+        paths += [self._segment_path(n) + COMPACT_SUFFIX for n in candidates]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    @staticmethod
+    def _write_entries(path, entries):
+        with open(path, 'wb') as f:
+            f.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def _run_flusher(self):
+        last_maintenance = time.monotonic()
+        while not self._closed:
+            self._wakeup.wait(self.fsync_interval)
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self.flush()
+                if time.monotonic() - last_maintenance >= self.maintenance_interval:
+                    last_maintenance = time.monotonic()
+                    self.purge_expired()
+                    self.compact()
+                    if self.auto_dictionary and not self._dictionaries:
+                        self.train_dictionary()
+            except (OSError, ValueError):
+                # Closed underneath us; the next loop iteration exits.
+                pass
+    
+    # Recovery
+    def _recover(self):
+        """Load the index and repair it against the segment files"""
+        index_path = os.path.join(self.path, INDEX_FILE)
+        
+        # An interrupted compaction either never committed its index
+        # (index.tmp still present: discard the .compact files) or did
+        # (finish the segment swap).
+        if os.path.exists(index_path + '.tmp'):
+            os.remove(index_path + '.tmp')
+            for name in os.listdir(self.path):
+                if name.endswith(COMPACT_SUFFIX):
+                    os.remove(os.path.join(self.path, name))
+        for name in os.listdir(self.path):
+            if name.endswith(COMPACT_SUFFIX):
+                os.replace(os.path.join(self.path, name),
+                           os.path.join(self.path, name[:-len(COMPACT_SUFFIX)]))
+        
+        deleted = set()
+        tombstone_path = os.path.join(self.path, TOMBSTONE_FILE)
+        if os.path.exists(tombstone_path):
+            with open(tombstone_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % TOMBSTONE.size
+            deleted = {msg_id for (msg_id,) in TOMBSTONE.iter_unpack(data[:usable])}
+        
+        numbers = self._segment_numbers()
+        sizes = {n: os.path.getsize(self._segment_path(n)) for n in numbers}
+        
+        entries = {}
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            for entry in INDEX_ENTRY.iter_unpack(data[:usable]):
+                # Entries past the end of a segment were never synced.
+                if entry[2] + entry[3] <= sizes.get(entry[1], -1):
+                    entries[entry[0]] = entry
+        
+        # Scan segment tails the index does not cover, rebuilding any
+        # missing entries and truncating torn writes.
+        ends = {}
+        for entry in entries.values():
+            ends[entry[1]] = max(ends.get(entry[1], 0), entry[2] + entry[3])
+        for segment_no in numbers:
+            valid_end = self._scan_segment(segment_no, ends.get(segment_no, 0), entries)
+            if valid_end < sizes[segment_no]:
+                with open(self._segment_path(segment_no), 'r+b') as f:
+                    f.truncate(valid_end)
+        
+        ordered = sorted(entries.values())
+        self._next_id = ordered[-1][0] + 1 if ordered else 1
+        if deleted:
+            self._next_id = max(self._next_id, max(deleted) + 1)
+        for entry in ordered:
+            if entry[0] in deleted:
+                self._dead.setdefault(entry[1], {})[entry[0]] = entry
+            else:
+                self._entries.append(entry)
+        
+        self._write_entries(index_path + '.tmp', ordered)
+        os.replace(index_path + '.tmp', index_path)
+        
+        # Tombstones are only needed while the record is still on disk.
+        with open(tombstone_path + '.tmp', 'wb') as f:
+            f.write(b''.join(TOMBSTONE.pack(msg_id) for msg_id in sorted(deleted)
+                             if msg_id in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tombstone_path + '.tmp', tombstone_path)
+    
+    def _scan_segment(self, segment_no, start, entries):
+        """Index records from ``start``; return the end of the valid data"""
+        with open(self._segment_path(segment_no), 'rb') as f:
+            f.seek(start)
+            offset = start
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return offset
+                magic, msg_id, timestamp, meta_len, raw_len, crc = RECORD_HEADER.unpack(header)
+                if magic not in (RECORD_MAGIC, FRAME_MAGIC):
+                    return offset
+                payload = f.read(meta_len + raw_len)
+                if len(payload) < meta_len + raw_len or zlib.crc32(payload) != crc:
+                    return offset
+                length = RECORD_HEADER.size + meta_len + raw_len
+                entries.setdefault(msg_id, (msg_id, segment_no, offset, length, timestamp))
+                offset += length
+
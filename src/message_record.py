@@ -0,0 +1,55 @@
+"""Compact in-memory representation of a received message"""
+
+import sys
+from datetime import datetime
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class MessageRecord:
+    """Summary of a stored message, with the body loaded on first access
+
+    Sender, recipient and peer host strings are interned, so an address
+    seen on many messages is held once. The timestamp is kept as a number
+    and only formatted by ``time`` for display.
+    """
+    
+    __slots__ = ('id', 'timestamp', 'sender', 'recipients', 'subject', 'peer',
+                 'attachments', '_store', '_body')
+    
+    def __init__(self, msg_id, timestamp, sender, recipients, subject,
+                 peer=None, attachments=(), store=None):
+        self.id = msg_id
+        self.timestamp = timestamp
+        self.sender = _intern(sender or '')
+        self.recipients = tuple(_intern(r) for r in recipients)
+        self.subject = subject
+        self.peer = (_intern(peer[0]),) + tuple(peer[1:]) if peer else None
+        self.attachments = tuple(attachments)
+        self._store = store
+        self._body = None
+    
+    def __repr__(self):
+        return f"<MessageRecord {self.id} from {self.sender!r}>"
+    
+    @property
+    def time(self):
+        """Local receive time as display text"""
+        return datetime.fromtimestamp(self.timestamp).strftime(TIME_FORMAT)
+    
+    @property
+    def to(self):
+        """Recipients as display text"""
+        return ', '.join(self.recipients)
+    
+    @property
+    def body(self):
+        """The text/plain body, read from the store when first needed"""
+        if self._body is None:
+            self._body = self._store.body(self.id) if self._store is not None else ''
+        return self._body
@@ -0,0 +1,276 @@
+"""Lightweight metrics for the receive path
+
+Counters, gauges and latency histograms live in a MetricsRegistry. Recording a
+value is a bisect and an increment under a lock, cheap enough to leave on
+for every message. The registry can be read as a snapshot dict or as
+Prometheus text, which MetricsServer serves on a local HTTP port.
+
+Worker processes keep their own registry and periodically send its state
+to the parent, which merges it into what it reports.
+"""
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Bucket upper bounds in seconds: 10us to ~100s, four buckets per doubling
+LATENCY_BUCKETS = tuple(1e-5 * 2 ** (i / 4) for i in range(94))
+
+DEFAULT_METRICS_PORT = 9101
+
+
+class Counter:
+    """Monotonically increasing value"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+    
+    def state(self):
+        return self.value
+    
+    @staticmethod
+    def merge(states):
+        return sum(states)
+
+
+class Gauge:
+    """Value that goes up and down, such as work in progress"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+    
+    def set(self, value):
+        with self._lock:
+            self.value = value
+    
+    def state(self):
+        return self.value
+    
+    @staticmethod
+    def merge(states):
+        return sum(states)
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        # One extra bucket for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+    
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+    
+    def state(self):
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+    
+    @staticmethod
+    def merge(states):
+        counts, count, total = None, 0, 0.0
+        for state_counts, state_count, state_sum in states:
+            if counts is None:
+                counts = list(state_counts)
+            else:
+                counts = [a + b for a, b in zip(counts, state_counts)]
+            count += state_count
+            total += state_sum
+        return counts, count, total
+
+
+def quantile(buckets, counts, count, q):
+    """Estimate the ``q`` quantile from bucket counts by interpolation"""
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for i, n in enumerate(counts):
+        if n and seen + n >= rank:
+            lower = buckets[i - 1] if i > 0 else 0.0
+            upper = buckets[i] if i < len(buckets) else buckets[-1]
+            return lower + (upper - lower) * (rank - seen) / n
+        seen += n
+    return buckets[-1]
+
+
+class MetricsRegistry:
+    """Named counters and histograms, plus state merged from workers"""
+    
+    def __init__(self, prefix='email_server'):
+        self.prefix = prefix
+        self._metrics = {}
+        self._remote = {}
+        self._lock = threading.Lock()
+    
+    def counter(self, name, help_text=''):
+        """Return the counter called ``name``, creating it on first use"""
+        return self._get(Counter, name, help_text)
+    
+    def gauge(self, name, help_text=''):
+        """Return the gauge called ``name``, creating it on first use"""
+        return self._get(Gauge, name, help_text)
+    
+    def histogram(self, name, help_text=''):
+        """Return the histogram called ``name``, creating it on first use"""
+        return self._get(Histogram, name, help_text)
+    
+    def state(self):
+        """Raw state of every local metric, for sending to another process"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.state() for metric in metrics}
+    
+    def absorb(self, source, state):
+        """Replace the state last reported by ``source`` (e.g. a worker pid)"""
+        with self._lock:
+            self._remote[source] = state
+    
+    def snapshot(self):
+        """Return counters, gauges and histogram summaries as a plain dict"""
+        result = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        for metric, merged in self._merged():
+            if metric.kind in ('counter', 'gauge'):
+                result[metric.kind + 's'][metric.name] = merged
+                continue
+            counts, count, total = merged
+            result['histograms'][metric.name] = {
+                'count': count,
+                'sum': total,
+                'p50': quantile(metric.buckets, counts, count, 0.50),
+                'p95': quantile(metric.buckets, counts, count, 0.95),
+                'p99': quantile(metric.buckets, counts, count, 0.99),
+            }
+        return result
+    
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric, merged in self._merged():
+            name = f"{self.prefix}_{metric.name}"
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind in ('counter', 'gauge'):
+                lines.append(f"{name} {merged}")
+                continue
+            counts, count, total = merged
+            cumulative = 0
+            for bound, n in zip(metric.buckets, counts):
+                cumulative += n
+                # Skip empty stretches to keep the output readable
+                if n:
+                    lines.append(f'{name}_bucket{{le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {count}')
+            lines.append(f"{name}_sum {total}")
+            lines.append(f"{name}_count {count}")
+        return '\n'.join(lines) + '\n'
+    
+    def _get(self, cls, name, help_text):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text)
+            return metric
+    
+    def _merged(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+            remote = list(self._remote.values())
+        for metric in metrics:
+            states = [metric.state()] + [r[metric.name] for r in remote if metric.name in r]
+            yield metric, metric.merge(states)
+
+
+REGISTRY = MetricsRegistry()
+
+# Receive path metrics shared by the modules that record them
+SESSIONS = REGISTRY.counter('smtp_sessions_total', 'SMTP sessions accepted')
+SESSIONS_REFUSED = REGISTRY.counter('smtp_sessions_refused_total',
+                                    'SMTP sessions refused by admission control')
+MESSAGES_ACCEPTED = REGISTRY.counter('messages_accepted_total', 'Messages accepted for delivery')
+MESSAGES_REJECTED = REGISTRY.counter('messages_rejected_total',
+                                     'Messages rejected with a 4xx or 5xx reply')
+BYTES_RECEIVED = REGISTRY.counter('bytes_received_total', 'Message bytes received in DATA')
+OFFLOAD_RUNNING = REGISTRY.gauge('offload_running', 'Large messages holding a processing slot')
+OFFLOAD_WAITING = REGISTRY.gauge('offload_waiting',
+                                 'Large messages waiting for a processing slot')
+
+SESSION_SECONDS = REGISTRY.histogram('smtp_session_seconds', 'Duration of SMTP sessions')
+DATA_RECEIVE_SECONDS = REGISTRY.histogram('smtp_data_receive_seconds',
+                                          'Time spent reading the DATA phase')
+HANDLER_SECONDS = REGISTRY.histogram('handler_seconds', 'Total time in handle_DATA')
+PARSE_SECONDS = REGISTRY.histogram('parse_seconds', 'Header parsing in handle_DATA')
+ATTACHMENT_SECONDS = REGISTRY.histogram('attachment_seconds',
+                                        'Moving attachments into the blob store')
+STORE_SECONDS = REGISTRY.histogram('store_seconds', 'Appending a message to the mail store')
+DISPATCH_SECONDS = REGISTRY.histogram('dispatch_seconds', 'Notifying sinks of a new message')
+BODY_PARSE_SECONDS = REGISTRY.histogram('body_parse_seconds',
+                                        'Deferred body extraction for viewing or indexing')
+
+
+class MetricsServer:
+    """Serves a registry as Prometheus text over HTTP on a local port"""
+    
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=DEFAULT_METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+    
+    def start(self):
+        registry = self.registry
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='metrics-server', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread.join(timeout=5)
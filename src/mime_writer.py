@@ -0,0 +1,357 @@
+"""Streaming writer for outgoing MIME messages
+
+email.mime builds the whole message in memory: each attachment is read
+with one read() and base64 encoded into a string, and every as_string()
+flattens the tree again. StreamingMessage instead keeps attachments as
+file paths and encodes them in chunks while writing, so memory is
+bounded by the chunk size rather than the attachment size.
+
+A message is flattened once with flatten(). The FlatMessage it returns,
+in memory for small messages and in a temporary file for large ones, is
+read by every delivery of the message, and sendmail() feeds it to the
+DATA phase a chunk at a time.
+
+When the server offers PIPELINING (RFC 2920), sendmail() writes MAIL,
+the RCPTs and DATA together and then reads their replies, so a message
+to many recipients costs a round trip per PIPELINE_BATCH commands rather
+than one per recipient.
+"""
+
+import base64
+import os
+import re
+import smtplib
+import uuid
+from email import policy
+from email.message import Message
+from email.mime.text import MIMEText
+from io import BytesIO
+
+from src.parsing import header_block
+from src.spooling import DEFAULT_SPOOL_THRESHOLD, MessageSpool
+
+
+# A multiple of 57 bytes, which base64 encodes to one full 76 character line
+CHUNK_SIZE = 57 * 1024
+CRLF = b'\r\n'
+# Commands written before reading their replies, so neither side's
+# buffers fill up with replies nobody reads
+PIPELINE_BATCH = 100
+# How email.mime messages are written, with SMTP line endings
+POLICY = policy.compat32.clone(linesep='\r\n')
+_BARE_LF = re.compile(rb'(?<!\r)\n')
+
+
+class Attachment:
+    """A file to attach, read from disk only while the message is written"""
+    
+    def __init__(self, path, content_type='application/octet-stream', filename=None):
+        self.path = path
+        self.headers = Message()
+        self.headers['Content-Type'] = content_type
+        self.headers['Content-Transfer-Encoding'] = 'base64'
+        self.headers.add_header('Content-Disposition', 'attachment',
+                                filename=filename or os.path.basename(path))
+    
+    def write_to(self, out):
+        write_headers(self.headers, out)
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(base64.encodebytes(chunk).replace(b'\n', CRLF))
+
+
+class StreamingMessage:
+    """A multipart/mixed message whose attachments stay on disk until written
+
+    Headers are set like on an email.message.Message. Parts are written in
+    the order they were added.
+    """
+    
+    def __init__(self):
+        self.headers = Message()
+        self.headers['MIME-Version'] = '1.0'
+        self.boundary = '=' * 15 + uuid.uuid4().hex
+        self.headers['Content-Type'] = f'multipart/mixed; boundary="{self.boundary}"'
+        self.parts = []
+    
+    def __getitem__(self, name):
+        return self.headers[name]
+    
+    def __setitem__(self, name, value):
+        self.headers[name] = value
+    
+    def attach_text(self, text, subtype='plain'):
+        self.parts.append(MIMEText(text, subtype))
+    
+    def attach_file(self, path, content_type='application/octet-stream'):
+        self.parts.append(Attachment(path, content_type))
+    
+    def write_to(self, out):
+        """Write the message with CRLF line endings to binary file ``out``"""
+        write_headers(self.headers, out)
+        delimiter = b'--' + self.boundary.encode('ascii')
+        for part in self.parts:
+            out.write(delimiter + CRLF)
+            if isinstance(part, Attachment):
+                part.write_to(out)
+            else:
+                out.write(part.as_bytes(policy=POLICY))
+                out.write(CRLF)
+        out.write(delimiter + b'--' + CRLF)
+    
+    def flatten(self, threshold=DEFAULT_SPOOL_THRESHOLD, directory=None):
+        """Write the message once and return it as a FlatMessage
+
+        Messages over ``threshold`` bytes go to a temporary file, which is
+        deleted when the FlatMessage is closed.
+        """
+        spool = MessageSpool(threshold, directory)
+        try:
+            self.write_to(spool)
+        except BaseException:
+            spool.close()
+            raise
+        if spool.in_memory:
+            return FlatMessage(spool.getvalue())
+        size = spool.size
+        return FlatMessage(path=spool.detach(), size=size, delete=True)
+
+
+class FlatMessage:
+    """Serialized message data, in memory or in a file, for any number of sends
+
+    open() returns a new reader each time, so concurrent deliveries do not
+    share a file position.
+    """
+    
+    def __init__(self, data=None, path=None, size=None, delete=False):
+        self.data = data
+        self.path = path
+        self.delete = delete
+        if size is None:
+            size = len(data) if data is not None else os.path.getsize(path)
+        self.size = size
+    
+    def open(self):
+        if self.data is not None:
+            return BytesIO(self.data)
+        return open(self.path, 'rb')
+    
+    def headers(self):
+        """The raw header block"""
+        with self.open() as f:
+            return header_block(f)
+    
+    def close(self):
+        """Delete the temporary file, if this message owns one"""
+        if self.delete and self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_headers(headers, out):
+    """Write the header fields of ``headers`` and the blank line after them"""
+    for name, value in headers.items():
+        out.write(POLICY.fold_binary(name, value))
+    out.write(CRLF)
+
+
+def flatten(msg):
+    """Return ``msg`` (a StreamingMessage or email Message) as a FlatMessage"""
+    if isinstance(msg, StreamingMessage):
+        return msg.flatten()
+    return FlatMessage(msg.as_bytes())
+
+
+def sendmail(smtp, from_addr, to_addrs, msg):
+    """Send ``msg`` over connected smtplib.SMTP ``smtp`` like smtp.sendmail()
+
+    ``msg`` is a FlatMessage, bytes or an ASCII str. It is fed to DATA a
+    chunk at a time and its size is given to servers that support SIZE.
+    Returns the refused recipients and raises the same errors as
+    smtp.sendmail().
+    """
+    if not isinstance(msg, FlatMessage):
+        msg = FlatMessage(msg.encode('ascii') if isinstance(msg, str) else msg)
+    
+    smtp.ehlo_or_helo_if_needed()
+    envelope = Envelope(from_addr, to_addrs, msg.size, smtp.has_extn)
+    for batch in envelope.batches():
+        smtp.send(batch)
+        while envelope.waiting():
+            envelope.reply(smtp.getreply())
+    try:
+        refused = envelope.refused()
+    except smtplib.SMTPException:
+        if envelope.closing:
+            smtp.close()
+        else:
+            if envelope.data_open:
+                # DATA was accepted anyway; end it with an empty message
+                smtp.send(b'.' + CRLF)
+                smtp.getreply()
+            _abort(smtp, 0)
+        raise
+    
+    code, resp = envelope.data_reply() or smtp.docmd('data')
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    with msg.open() as f:
+        for block in data_blocks(f):
+            smtp.send(block)
+    code, resp = smtp.getreply()
+    if code != 250:
+        _abort(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class Envelope:
+    """The MAIL and RCPT commands of one transaction and their replies
+
+    Builds the commands, with DATA appended when the server pipelines,
+    and reads the replies for sendmail() and AsyncSMTP.sendmail(), which
+    only move the bytes:
+
+        for batch in envelope.batches():
+            write(batch)
+            while envelope.waiting():
+                envelope.reply(read_reply())
+    """
+    
+    def __init__(self, from_addr, to_addrs, size, has_extn):
+        self.from_addr = from_addr
+        self.to_addrs = to_addrs
+        self.pipelining = has_extn('pipelining')
+        size = f' SIZE={size}' if has_extn('size') else ''
+        self.commands = [f'MAIL FROM:{smtplib.quoteaddr(from_addr)}{size}']
+        self.commands += [f'RCPT TO:{smtplib.quoteaddr(recipient)}' for recipient in to_addrs]
+        if self.pipelining:
+            self.commands.append('DATA')
+        self.replies = []
+        self._pending = 0
+    
+    @property
+    def closing(self):
+        """True once the server replied 421 and is closing the connection"""
+        return bool(self.replies) and self.replies[-1][0] == 421
+    
+    @property
+    def data_open(self):
+        """True if the server accepted a pipelined DATA"""
+        return len(self.replies) > len(self.to_addrs) + 1 and self.replies[-1][0] == 354
+    
+    def batches(self):
+        """Yield the command lines written before reading replies, as bytes
+
+        Stops early after a refused MAIL or a 421.
+        """
+        size = PIPELINE_BATCH if self.pipelining else 1
+        for start in range(0, len(self.commands), size):
+            batch = self.commands[start:start + size]
+            self._pending = len(batch)
+            yield ''.join(command + '\r\n' for command in batch).encode('ascii')
+            if self.replies[0][0] != 250 or self.closing:
+                return
+    
+    def waiting(self):
+        """True while a reply to the last batch is still to be read"""
+        return self._pending > 0 and not self.closing
+    
+    def reply(self, reply):
+        """Record the (code, message) reply to the next command"""
+        self.replies.append(reply)
+        self._pending -= 1
+    
+    def refused(self):
+        """Return the refused recipients
+
+        Raises SMTPSenderRefused or SMTPRecipientsRefused like smtplib when
+        the transaction cannot go on to DATA.
+        """
+        code, resp = self.replies[0]
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, self.from_addr)
+        refused = {}
+        for recipient, (code, resp) in zip(self.to_addrs, self.replies[1:]):
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+            if code == 421:
+                raise smtplib.SMTPRecipientsRefused(refused)
+        if len(refused) == len(self.to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+    
+    def data_reply(self):
+        """The reply to a pipelined DATA, or None if DATA is still to be sent"""
+        return self.replies[-1] if self.pipelining else None
+
+
+def data_blocks(f):
+    """Yield the message in ``f`` dot-stuffed with CRLF line endings, ending with the final dot
+
+    Blocks are about CHUNK_SIZE bytes. The last one carries the final
+    dot: sent on its own, the dot would wait for the ACK of the block
+    before it (Nagle).
+    """
+    carry = b''
+    at_line_start = True
+    held = b''
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        block = carry + chunk
+        # Send whole lines; the rest waits for the next chunk unless it is
+        # a line too long to hold back
+        end = block.rfind(b'\n') + 1
+        if not end:
+            if len(block) < CHUNK_SIZE:
+                carry = block
+                continue
+            end = len(block) - 1 if block.endswith(b'\r') else len(block)
+        block, carry = block[:end], block[end:]
+        if held:
+            yield held
+        held = _escape(block, at_line_start)
+        at_line_start = block.endswith(b'\n')
+    if carry:
+        held += _escape(carry, at_line_start)
+        at_line_start = carry.endswith(b'\n')
+    if not at_line_start:
+        held += CRLF
+    yield held + b'.' + CRLF
+
+
+def _escape(block, at_line_start):
+    """Normalize line endings to CRLF and double dots that start a line"""
+    if block.count(b'\n') != block.count(CRLF):
+        # Checking first is far cheaper than the regex on CRLF text
+        block = _BARE_LF.sub(CRLF, block)
+    block = block.replace(b'\n.', b'\n..')
+    if at_line_start and block.startswith(b'.'):
+        block = b'.' + block
+    return block
+
+
+def _abort(smtp, code):
+    """End a refused transaction; a 421 means the server is closing"""
+    if code == 421:
+        smtp.close()
+        return
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
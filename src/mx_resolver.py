@@ -0,0 +1,127 @@
+"""Cached MX lookups for direct delivery
+
+MXResolver answers "which hosts accept mail for this domain" in the order
+they should be tried: MX hosts by preference, equal preferences in random
+order, or the domain itself when it has no MX records (RFC 5321 5.1).
+Answers are cached for their DNS TTL and failures such as NXDOMAIN for a
+short negative TTL. Concurrent lookups of the same domain share one
+query.
+
+Pass ``nameservers`` (and ``port``) to query a specific resolver instead
+of the system one, e.g. a stub server in tests.
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import dns.resolver
+
+
+DEFAULT_NEGATIVE_TTL = 60.0
+DEFAULT_MAX_TTL = 3600.0
+DEFAULT_LIFETIME = 10.0
+
+
+class NoMailHost(Exception):
+    """The domain does not exist or publishes no usable mail host"""
+
+
+class MXResolver:
+    """MX lookups with a TTL-honouring cache, shared between threads"""
+    
+    _shared = None
+    _shared_lock = threading.Lock()
+    
+    def __init__(self, nameservers=None, port=53, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_ttl=DEFAULT_MAX_TTL, lifetime=DEFAULT_LIFETIME):
+        if nameservers:
+            self.resolver = dns.resolver.Resolver(configure=False)
+            self.resolver.nameservers = list(nameservers)
+            self.resolver.port = port
+        else:
+            self.resolver = dns.resolver.Resolver()
+        self.resolver.lifetime = lifetime
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.queries = 0
+        self._cache = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def shared(cls):
+        """The process-wide resolver using the system configuration"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+    
+    def lookup(self, domain):
+        """Return the mail hosts for ``domain`` in the order to try them
+
+        Raises NoMailHost if the domain does not exist or refuses mail, and
+        dns.exception.DNSException if it could not be resolved.
+        """
+        domain = domain.lower().rstrip('.')
+        with self._lock:
+            entry = self._cache.get(domain)
+            if entry is not None and entry[0] > time.monotonic():
+                return self._result(entry[1])
+            future = self._pending.get(domain)
+            owner = future is None
+            if owner:
+                future = self._pending[domain] = Future()
+        
+        if not owner:
+            return self._result(future.result())
+        
+        try:
+            outcome, ttl = self._query(domain)
+        except BaseException as e:
+            outcome, ttl = e, 0
+        with self._lock:
+            if ttl > 0:
+                self._cache[domain] = (time.monotonic() + ttl, outcome)
+            del self._pending[domain]
+        future.set_result(outcome)
+        return self._result(outcome)
+    
+    def clear(self):
+        """Forget every cached answer"""
+        with self._lock:
+            self._cache.clear()
+    
+    def _query(self, domain):
+        """Return (hosts or exception, seconds to cache it)"""
+        self.queries += 1
+        try:
+            answer = self.resolver.resolve(domain, 'MX')
+        except dns.resolver.NXDOMAIN:
+            return NoMailHost(f"Domain {domain} does not exist"), self.negative_ttl
+        except dns.resolver.NoAnswer:
+            # No MX records: the domain's own address is the mail host
+            return [(0, domain)], self.negative_ttl
+        except dns.resolver.NoNameservers as e:
+            # SERVFAIL and the like; worth asking again soon but not at once
+            return e, min(self.negative_ttl, 5.0)
+        
+        ttl = min(self.max_ttl, max(0.0, answer.expiration - time.time()))
+        hosts = [(record.preference, str(record.exchange).rstrip('.').lower())
+                 for record in answer]
+        if hosts == [(0, '')]:
+            # Null MX (RFC 7505)
+            return NoMailHost(f"Domain {domain} does not accept mail"), ttl
+        return hosts, ttl
+    
+    @staticmethod
+    def _result(outcome):
+        if isinstance(outcome, BaseException):
+            # The same cached exception is raised again; drop its old traceback
+            raise outcome.with_traceback(None)
+        # Shuffle, then sort: equal preferences end up in random order
+        hosts = list(outcome)
+        random.shuffle(hosts)
+        hosts.sort(key=lambda host: host[0])
+        return [name for _, name in hosts]
@@ -0,0 +1,187 @@
+"""Offloading of message processing from the SMTP event loop
+
+Small messages are cheap to handle inline. For large ones, parsing the
+headers, cutting the attachments out into blobs and copying the message
+into the mail store (with its checksum) takes long enough to stall every
+other session on the same event loop. OffloadStage runs that work in
+executors instead: parsing and attachment extraction in a process pool
+(or a thread pool), and the store append in a thread.
+
+At most ``max_pending`` messages are offloaded at once in the process,
+however many event loops serve sessions. Further messages wait for a
+slot, and the SMTP layer refuses DATA with a 451 up front for clients
+that announce a large SIZE while all slots are taken.
+"""
+
+import asyncio
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from src.attachments import extract_attachments
+from src.metrics import OFFLOAD_RUNNING, OFFLOAD_WAITING
+from src.parsing import parse_headers
+from src.spooling import MessageSpool
+
+
+DEFAULT_OFFLOAD_THRESHOLD = 256 * 1024
+DEFAULT_MAX_PENDING = 32
+DEFAULT_WAIT_TIMEOUT = 30.0
+
+
+class OffloadBusy(Exception):
+    """No processing slot became free in time"""
+
+
+def process_message(raw, blob_dir, spool_dir=None):
+    """Return the subject and extract_attachments() result; runs in a pool process
+    
+    ``raw`` is the message as bytes or the path of its spool file.
+    """
+    if isinstance(raw, str):
+        with open(raw, 'rb') as f:
+            return process_message(f, blob_dir, spool_dir)
+    subject = str(parse_headers(raw).get('Subject', 'No Subject'))
+    return (subject,) + extract_attachments(raw, blob_dir, spool_dir)
+
+
+class OffloadStage:
+    """Executors and admission slots for processing large messages"""
+    
+    def __init__(self, mode='process', workers=None, max_pending=DEFAULT_MAX_PENDING,
+                 threshold=DEFAULT_OFFLOAD_THRESHOLD, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+        if mode not in ('process', 'thread'):
+            raise ValueError(f"Unknown offload mode: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self.threshold = threshold
+        self.wait_timeout = wait_timeout
+        # Messages holding a slot
+        self.running = 0
+        self._threads = None
+        self._processes = None
+        # Slots are shared by every event loop, since the listener groups
+        # old and new both take them during restart(). Waiters are (loop,
+        # future) pairs; a freed slot passes straight to the first one.
+        self._lock = threading.Lock()
+        self._waiters = deque()
+    
+    def start(self):
+        """Create the executors; returns a note if it fell back to threads"""
+        note = None
+        self._threads = ThreadPoolExecutor(max_workers=self.workers,
+                                           thread_name_prefix='offload')
+        if self.mode == 'process':
+            if multiprocessing.current_process().daemon:
+                # Receive worker processes may not start children of their own
+                note = "Process pool unavailable in a worker process, parsing in threads"
+            else:
+                try:
+                    self._processes = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+                    # Start the pool now rather than on the first large message
+                    self._processes.submit(int).result()
+                except (ImportError, NotImplementedError, OSError) as e:
+                    note = f"Process pool unavailable ({e}), parsing in threads"
+        return note
+    
+    def stop(self):
+        """Shut the executors down, waiting for running work"""
+        if self._processes is not None:
+            self._processes.shutdown()
+            self._processes = None
+        if self._threads is not None:
+            self._threads.shutdown()
+            self._threads = None
+    
+    def wants(self, size):
+        """True if a message of ``size`` bytes should be offloaded"""
+        return size >= self.threshold
+    
+    @property
+    def waiting(self):
+        """Messages waiting for a slot"""
+        with self._lock:
+            return len(self._waiters)
+    
+    def full(self):
+        """True while every processing slot is taken"""
+        return self.running >= self.max_pending
+    
+    async def process(self, raw, blob_dir):
+        """Parse a message and cut out its attachments without blocking the loop
+        
+        Returns ``(subject, message, attachments, blobs)`` as described for
+        extract_attachments(). Spooled messages are passed to the pool by
+        path; a new message file is written next to the spool file.
+        """
+        loop = asyncio.get_running_loop()
+        executor = self._processes or self._threads
+        spool_dir = None
+        if isinstance(raw, MessageSpool):
+            spool_dir = raw.directory
+            raw = raw.path
+        return await loop.run_in_executor(executor, process_message, raw, blob_dir, spool_dir)
+    
+    async def call(self, func, *args):
+        """Run ``func(*args)`` in the thread pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._threads, func, *args)
+    
+    async def acquire(self):
+        """Take a slot, waiting up to ``wait_timeout``; raise OffloadBusy"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.running < self.max_pending:
+                self.running += 1
+                self._report()
+                return
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+            self._report()
+        try:
+            await asyncio.wait_for(waiter, self.wait_timeout)
+        except BaseException as e:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, waiter))
+                    granted = False
+                except ValueError:
+                    granted = True
+                self._report()
+            if granted:
+                # release() handed us the slot as we gave up
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                raise OffloadBusy()
+            raise
+    
+    def release(self):
+        """Give back a slot taken by acquire(), from any thread or loop"""
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self.running -= 1
+                    self._report()
+                    return
+                loop, waiter = self._waiters.popleft()
+                self._report()
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+                return
+            except RuntimeError:
+                # Its loop has been closed; try the next waiter
+                continue
+    
+    def _report(self):
+        """Update the load gauges; lock held"""
+        OFFLOAD_RUNNING.set(self.running)
+        OFFLOAD_WAITING.set(len(self._waiters))
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,519 @@
+"""Durable outbound mail queue
+
+Messages to send are written to a spool directory and delivered by a pool
+of worker threads. Temporary failures (4xx replies, unreachable servers)
+are retried with exponential backoff and jitter; permanent failures (5xx
+replies, domains without mail hosts) and messages that run out of
+attempts are bounced to the sender.
+
+Each queued message is a ``<id>.eml`` file with the message and a
+``<id>.json`` file with its envelope and retry state, replaced atomically
+after every attempt, so the queue survives a crash or restart. Delivery
+is at least once: a message being sent when the process dies is sent
+again.
+
+Passwords for authenticated relays are only kept in memory. After a
+restart, messages for such a relay are held, without using up attempts
+or bouncing, until a password for it is supplied again with enqueue() or
+set_password().
+
+Given a SendLoop, attempts run as SMTPSender.deliver_async() on its event
+loop. Recipients are then reported as each host answers, and cancel()
+can stop an attempt midway.
+"""
+
+import heapq
+import json
+import logging
+import os
+import random
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError
+from email.message import EmailMessage
+from email.parser import BytesHeaderParser
+from email.utils import formatdate, make_msgid
+
+from src.mime_writer import FlatMessage, StreamingMessage
+from src.mx_resolver import NoMailHost
+from src.smtp_sender import SMTPSender
+
+
+DEFAULT_QUEUE_DIR = os.path.join(os.path.expanduser('~'), '.email_server', 'outbound')
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_BASE_DELAY = 60.0
+DEFAULT_MAX_DELAY = 3600.0
+
+
+def is_permanent(error):
+    """True if retrying cannot help with ``error``"""
+    if isinstance(error, NoMailHost):
+        return True
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        # Fixable by entering the right password; keep the message queued
+        return False
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+def describe(error):
+    """One line description of a delivery error"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        replies = [f"{code} {text.decode('utf-8', 'replace') if isinstance(text, bytes) else text}"
+                   for code, text in error.recipients.values()]
+        return '; '.join(replies)
+    if isinstance(error, smtplib.SMTPResponseException):
+        text = error.smtp_error
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        return f"{error.smtp_code} {text}"
+    return str(error) or type(error).__name__
+
+
+class QueuedMessage:
+    """Envelope and retry state of one queued message"""
+    
+    def __init__(self, msg_id, sender, recipients, route, created=None, attempts=0,
+                 next_attempt=None, last_error=None):
+        self.id = msg_id
+        self.sender = sender
+        self.recipients = list(recipients)
+        self.route = dict(route)
+        self.created = created if created is not None else time.time()
+        self.attempts = attempts
+        self.next_attempt = next_attempt if next_attempt is not None else self.created
+        self.last_error = last_error
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'sender': self.sender,
+            'recipients': self.recipients,
+            'route': self.route,
+            'created': self.created,
+            'attempts': self.attempts,
+            'next_attempt': self.next_attempt,
+            'last_error': self.last_error,
+        }
+    
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['id'], state['sender'], state['recipients'], state['route'],
+                   state['created'], state['attempts'], state['next_attempt'],
+                   state.get('last_error'))
+
+
+class OutboundQueue:
+    """On-disk queue of outgoing messages with retrying delivery workers
+
+    ``deliver(route, sender, recipients, data, password)`` sends one
+    message, given as a FlatMessage over its queue file, and returns the
+    failed recipients mapped to their errors; by default it is
+    SMTPSender.deliver() over ``pool``. ``bounce(raw, recipient)``
+    receives the bounce message for a sender; without it bounces are
+    only logged. Log lines go to ``sink``.
+    
+    With a ``send_loop`` the default delivery is SMTPSender.deliver_async()
+    on it and ``pool`` must be an AsyncSMTPPool. ``progress(msg_id,
+    recipient, error)`` is called with each recipient's outcome of every
+    attempt, ``error`` being None once delivered; it runs on a worker or
+    on the send loop.
+    """
+    
+    def __init__(self, directory=DEFAULT_QUEUE_DIR, workers=DEFAULT_WORKERS, sink=None,
+                 pool=None, resolver=None, bounce=None, deliver=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, send_loop=None, progress=None):
+        self.directory = directory
+        self.workers = workers
+        self.sink = sink
+        self.pool = pool
+        self.resolver = resolver
+        self.bounce = bounce
+        self.deliver = deliver
+        self.send_loop = send_loop
+        self.progress = progress
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._heap = []
+        self._messages = {}
+        self._passwords = {}
+        # Messages due for a relay whose password is not known yet
+        self._held = set()
+        # Messages being attempted, their running deliver_async() futures
+        # and those cancelled meanwhile
+        self._busy = set()
+        self._running = {}
+        self._cancelled = set()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        os.makedirs(directory, exist_ok=True)
+    
+    def start(self):
+        """Load messages left from an earlier run and start the workers"""
+        self._recover()
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._work, name='outbound-worker', daemon=True)
+                         for _ in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+    
+    def stop(self, timeout=10):
+        """Stop the workers; queued messages stay on disk for the next start
+
+        Attempts running on the send loop are cancelled. They do not count
+        as attempts, and the next start makes them again.
+        """
+        with self._cond:
+            self._stopping = True
+            for future in self._running.values():
+                future.cancel()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+    
+    def enqueue(self, sender, recipients, msg, route, password=None):
+        """Queue ``msg`` (a Message, StreamingMessage or bytes) for delivery and return its id"""
+        data = msg if isinstance(msg, (bytes, StreamingMessage)) else msg.as_bytes()
+        entry = QueuedMessage(uuid.uuid4().hex, sender, recipients, route)
+        if password is not None:
+            self.set_password(route, password)
+        # The message first, then the state file that makes it part of the queue
+        self._write(self._path(entry.id, '.eml'), data)
+        self._save(entry)
+        with self._cond:
+            self._messages[entry.id] = entry
+            self._schedule(entry)
+        return entry.id
+    
+    def set_password(self, route, password):
+        """Remember the password for an authenticated relay, in memory only
+        
+        Messages held for want of it are sent right away.
+        """
+        relay = self._relay(route)
+        with self._cond:
+            self._passwords[relay] = password
+            released = [self._messages[msg_id] for msg_id in self._held
+                        if self._relay(self._messages[msg_id].route) == relay]
+            for entry in released:
+                self._held.discard(entry.id)
+                entry.next_attempt = time.time()
+                self._schedule(entry)
+        if released:
+            self._log(f"Password entered, sending {len(released)} held message(s)")
+    
+    def cancel(self, msg_id):
+        """Drop a message from the queue without bouncing it; False if it is not queued
+
+        An attempt in progress is cancelled on the send loop; without one
+        it finishes its transaction first.
+        """
+        with self._cond:
+            entry = self._messages.get(msg_id)
+            if entry is None:
+                return False
+            if msg_id in self._busy:
+                # The worker removes it when the attempt ends
+                self._cancelled.add(msg_id)
+                future = self._running.get(msg_id)
+                if future is not None:
+                    future.cancel()
+                return True
+            del self._messages[msg_id]
+            self._held.discard(msg_id)
+        self._remove(entry)
+        self._log(f"Cancelled message to {', '.join(entry.recipients)}", logging.WARNING)
+        return True
+    
+    def __contains__(self, msg_id):
+        with self._cond:
+            return msg_id in self._messages
+    
+    def __len__(self):
+        """Number of messages queued or being delivered"""
+        with self._cond:
+            return len(self._messages)
+    
+    def held(self):
+        """Ids of the messages waiting for a relay password"""
+        with self._cond:
+            return set(self._held)
+    
+    def pending(self):
+        """The queued messages, soonest attempt first"""
+        with self._cond:
+            return sorted(self._messages.values(), key=lambda entry: entry.next_attempt)
+    
+    # Scheduling
+    def _schedule(self, entry):
+        """Push ``entry`` on the heap; lock held"""
+        heapq.heappush(self._heap, (entry.next_attempt, entry.id))
+        self._cond.notify()
+    
+    def _next_due(self):
+        """Pop the next due message, waiting for it; None when stopping"""
+        with self._cond:
+            while not self._stopping:
+                if self._heap:
+                    due, msg_id = self._heap[0]
+                    entry = self._messages.get(msg_id)
+                    if entry is None or entry.next_attempt != due:
+                        # Removed or rescheduled since it was pushed
+                        heapq.heappop(self._heap)
+                        continue
+                    wait = due - time.time()
+                    if wait <= 0:
+                        heapq.heappop(self._heap)
+                        relay = self._relay(entry.route)
+                        if entry.route.get('user') and relay not in self._passwords:
+                            # No password since restart; set_password() releases it
+                            self._held.add(entry.id)
+                            continue
+                        self._busy.add(entry.id)
+                        return entry
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            return None
+    
+    def _backoff(self, attempts):
+        """Delay before the next attempt: exponential, with half of it random"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+    
+    # Delivery
+    def _work(self):
+        while True:
+            entry = self._next_due()
+            if entry is None:
+                return
+            try:
+                self._attempt(entry)
+            except Exception as e:
+                self._log(f"Outbound queue error on {entry.id}: {e}", logging.ERROR)
+            finally:
+                with self._cond:
+                    self._busy.discard(entry.id)
+                    self._cancelled.discard(entry.id)
+    
+    def _attempt(self, entry):
+        # Read from the queue file by each delivery; never loaded whole
+        data = FlatMessage(path=self._path(entry.id, '.eml'))
+        password = None
+        if entry.route.get('user'):
+            # Set, or the message would have been held by _next_due()
+            with self._cond:
+                password = self._passwords.get(self._relay(entry.route))
+        
+        try:
+            errors = self._deliver(entry, data, password)
+        except CancelledError:
+            # By cancel(), or by stop() or the send loop stopping
+            errors = None
+        except Exception as e:
+            errors = {recipient: e for recipient in entry.recipients}
+            self._report(entry, errors)
+        
+        with self._cond:
+            cancelled = entry.id in self._cancelled
+            if cancelled:
+                self._messages.pop(entry.id, None)
+        if cancelled:
+            self._remove(entry)
+            self._log(f"Cancelled message to {', '.join(entry.recipients)}", logging.WARNING)
+            return
+        if errors is None:
+            # Cut short by shutdown; its files are unchanged, so the next
+            # start makes this attempt again
+            self._log(f"Delivery to {', '.join(entry.recipients)} interrupted by shutdown",
+                      logging.WARNING)
+            return
+        
+        entry.attempts += 1
+        delivered = [recipient for recipient in entry.recipients if recipient not in errors]
+        if delivered:
+            self._log(f"Delivered to {', '.join(delivered)}")
+        permanent = {recipient: describe(error) for recipient, error in errors.items()
+                     if is_permanent(error)}
+        temporary = {recipient: describe(error) for recipient, error in errors.items()
+                     if recipient not in permanent}
+        if temporary and entry.attempts >= self.max_attempts:
+            permanent.update({recipient: f"Gave up after {entry.attempts} attempts: {reason}"
+                              for recipient, reason in temporary.items()})
+            temporary = {}
+        
+        if permanent:
+            self._bounce(entry, data, permanent)
+        if temporary:
+            delay = self._backoff(entry.attempts)
+            entry.recipients = list(temporary)
+            entry.last_error = next(iter(temporary.values()))
+            entry.next_attempt = time.time() + delay
+            self._save(entry)
+            self._log(f"Deferred {', '.join(temporary)}: {entry.last_error}; "
+                      f"retry {entry.attempts + 1} in {delay:.0f}s", logging.WARNING)
+            with self._cond:
+                self._schedule(entry)
+        else:
+            self._remove(entry)
+    
+    def _deliver(self, entry, data, password):
+        """Make one attempt; returns the failed recipients mapped to their errors"""
+        logger = lambda message: self._log(message, logging.DEBUG)
+        if self.deliver is None and self.send_loop is not None:
+            coro = SMTPSender.deliver_async(
+                entry.route, entry.sender, entry.recipients, data, logger, self.pool, password,
+                self.resolver, lambda recipient, error: self._progress(entry.id, recipient, error))
+            with self._cond:
+                if entry.id in self._cancelled or self._stopping:
+                    coro.close()
+                    raise CancelledError()
+                try:
+                    future = self._running[entry.id] = self.send_loop.submit(coro)
+                except RuntimeError:
+                    # The send loop has stopped
+                    raise CancelledError()
+            try:
+                return future.result()
+            finally:
+                with self._cond:
+                    self._running.pop(entry.id, None)
+        
+        if self.deliver is not None:
+            errors = self.deliver(entry.route, entry.sender, entry.recipients, data, password)
+        else:
+            errors = SMTPSender.deliver(entry.route, entry.sender, entry.recipients, data,
+                                        logger, self.pool, password, self.resolver)
+        self._report(entry, errors)
+        return errors
+    
+    def _report(self, entry, errors):
+        for recipient in entry.recipients:
+            self._progress(entry.id, recipient, errors.get(recipient))
+    
+    def _progress(self, msg_id, recipient, error):
+        if self.progress is not None:
+            try:
+                self.progress(msg_id, recipient, error)
+            except Exception as e:
+                self._log(f"Outbound progress callback failed: {e}", logging.ERROR)
+    
+    def _bounce(self, entry, data, failures):
+        for recipient, reason in failures.items():
+            self._log(f"Bounced {recipient}: {reason}", logging.ERROR)
+        if not entry.sender or self.bounce is None:
+            # Never bounce a bounce
+            return
+        try:
+            self.bounce(build_bounce(entry.sender, data.headers(), failures), entry.sender)
+        except Exception as e:
+            self._log(f"Could not deliver bounce to {entry.sender}: {e}", logging.ERROR)
+    
+    # Storage
+    def _recover(self):
+        """Queue the messages found in the spool directory"""
+        names = set(os.listdir(self.directory))
+        loaded = 0
+        for name in names:
+            msg_id, ext = os.path.splitext(name)
+            if ext == '.eml' and msg_id + '.json' not in names:
+                # Crashed between writing the message and its state
+                os.remove(os.path.join(self.directory, name))
+            elif ext == '.json':
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        entry = QueuedMessage.from_dict(json.load(f))
+                except (OSError, ValueError, KeyError):
+                    continue
+                if msg_id + '.eml' not in names:
+                    os.remove(os.path.join(self.directory, name))
+                    continue
+                with self._cond:
+                    if entry.id not in self._messages:
+                        self._messages[entry.id] = entry
+                        self._schedule(entry)
+                        loaded += 1
+            elif name.startswith('tmp'):
+                os.remove(os.path.join(self.directory, name))
+        if loaded:
+            self._log(f"Outbound queue: {loaded} message(s) waiting from last run")
+    
+    def _save(self, entry):
+        self._write(self._path(entry.id, '.json'), json.dumps(entry.to_dict()).encode('utf-8'))
+    
+    def _remove(self, entry):
+        with self._cond:
+            self._messages.pop(entry.id, None)
+        # State first: a message file without state is cleaned up on start
+        for ext in ('.json', '.eml'):
+            try:
+                os.remove(self._path(entry.id, ext))
+            except FileNotFoundError:
+                pass
+    
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            if isinstance(data, StreamingMessage):
+                data.write_to(f)
+            else:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def _path(self, msg_id, ext):
+        return os.path.join(self.directory, msg_id + ext)
+    
+    @staticmethod
+    def _relay(route):
+        return (route.get('host'), route.get('port'), route.get('user'))
+    
+    def _log(self, message, level=logging.INFO):
+        if self.sink is not None:
+            self.sink.log(message, level)
+
+
+def build_bounce(sender, data, failures):
+    """Return a delivery status notification for ``sender`` as bytes
+
+    ``data`` is the original message or just its header block, and
+    ``failures`` maps each failed recipient to the reason. The original
+    headers are attached, not the whole message.
+    """
+    hostname = socket.getfqdn()
+    original = BytesHeaderParser().parsebytes(data)
+    lines = [
+        "This is the mail system. Your message could not be delivered to",
+        "one or more recipients:",
+        "",
+    ]
+    for recipient, reason in failures.items():
+        lines.append(f"  <{recipient}>: {reason}")
+    if original.get('Subject'):
+        lines += ["", f"Subject of the original message: {original['Subject']}"]
+    
+    bounce = EmailMessage()
+    bounce['From'] = f"Mail Delivery System <MAILER-DAEMON@{hostname}>"
+    bounce['To'] = sender
+    bounce['Subject'] = "Undelivered Mail Returned to Sender"
+    bounce['Date'] = formatdate(localtime=True)
+    bounce['Message-ID'] = make_msgid(domain=hostname)
+    bounce['Auto-Submitted'] = 'auto-replied'
+    bounce.set_content('\n'.join(lines) + '\n')
+    headers = data.split(b'\r\n\r\n', 1)[0] if b'\r\n\r\n' in data else data.split(b'\n\n', 1)[0]
+    bounce.add_attachment(headers, maintype='text', subtype='rfc822-headers',
+                          disposition='inline')
+    return bounce.as_bytes()
@@ -0,0 +1,76 @@
+"""Message parsing helpers for the receive path"""
+
+import re
+from email.parser import BytesFeedParser, BytesHeaderParser
+
+
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+MAX_HEADER_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+_header_parser = BytesHeaderParser()
+
+
+def parse_headers(raw):
+    """Parse only the header block of a raw message
+    
+    ``raw`` may be bytes or a readable binary file positioned at the start
+    of the message. The body is never scanned or decoded, so the cost does
+    not depend on message size or MIME structure.
+    """
+    return _header_parser.parsebytes(header_block(raw))
+
+
+def header_block(raw):
+    """Return the raw header block of a message given as bytes or a file"""
+    if not isinstance(raw, (bytes, bytearray)):
+        raw = read_head(raw)
+    match = HEADER_END.search(raw)
+    return raw[:match.end()] if match else raw
+
+
+def read_head(f, limit=MAX_HEADER_SIZE):
+    """Read from a file until the end of the header block"""
+    head = b''
+    while len(head) < limit:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        head += chunk
+        # Search the seam as well in case the separator spans two chunks
+        if HEADER_END.search(head, max(0, len(head) - len(chunk) - 3)):
+            break
+    return head
+
+
+def parse_body(chunks, limit=None):
+    """Parse a message fed in chunks and return its text/plain body
+    
+    At most ``limit`` bytes are fed to the parser. The text part normally
+    comes first, so trailing attachments of huge messages are skipped
+    instead of being decoded into memory.
+    """
+    parser = BytesFeedParser()
+    fed = 0
+    for chunk in chunks:
+        if limit is not None and fed + len(chunk) > limit:
+            parser.feed(chunk[:limit - fed])
+            break
+        parser.feed(chunk)
+        fed += len(chunk)
+    return extract_body(parser.close())
+
+
+def extract_body(msg):
+    """Extract the text/plain body from a parsed message"""
+    if msg.is_multipart():
+        body = ''
+        for part in msg.walk():
+            if part.get_content_type() == 'text/plain':
+                payload = part.get_payload(decode=True) or b''
+                body = payload.decode('utf-8', errors='ignore')
+                break
+    else:
+        payload = msg.get_payload(decode=True)
+        body = payload.decode('utf-8', errors='ignore') if payload else ''
+    return body
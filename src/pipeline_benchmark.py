@@ -0,0 +1,232 @@
+"""SMTP PIPELINING benchmark over a link with injected latency
+
+Sends messages with many recipients each to a local aiosmtpd stand-in
+reached through a proxy that delays traffic by half of ``--latency`` in
+each direction, once with the stand-in offering PIPELINING and once
+without, and reports per-message transaction latency as JSON:
+
+    python -m src.pipeline_benchmark --recipients 500 --latency 20
+
+Messages go through mime_writer.sendmail() on one smtplib session, or
+through AsyncSMTP with ``--client async``.
+"""
+
+import argparse
+import asyncio
+import json
+import smtplib
+import sys
+import time
+
+from aiosmtpd.controller import Controller
+
+from src.async_smtp import AsyncSMTP, SendLoop
+from src.benchmark import _text, free_port, summarize
+from src.mime_writer import flatten, sendmail
+from src.smtp_sender import SMTPSender
+
+
+MODES = ('serial', 'pipelined')
+CLIENTS = ('sync', 'async')
+SENDER = 'bench@example.test'
+TIMEOUT = 60
+
+
+class CountingHandler:
+    """Accepts every recipient and drops the messages; offers PIPELINING when asked"""
+    
+    def __init__(self):
+        self.pipelining = False
+        self.received = 0
+    
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        if self.pipelining:
+            responses.insert(-1, '250-PIPELINING')
+        return responses
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return '250 OK'
+
+
+class LatencyProxy:
+    """Forwards connections to a local port, delaying data each way by ``delay`` seconds"""
+    
+    def __init__(self, target_port, delay):
+        self.target_port = target_port
+        self.delay = delay
+        self.server = None
+        self.port = None
+        self.connections = set()
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+    
+    async def stop(self):
+        """Stop accepting and wait for connections still delivering their last data"""
+        self.server.close()
+        await self.server.wait_closed()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+    
+    async def _handle(self, client_reader, client_writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            server_reader, server_writer = await asyncio.open_connection('127.0.0.1',
+                                                                         self.target_port)
+            await asyncio.gather(self._pump(client_reader, server_writer),
+                                 self._pump(server_reader, client_writer))
+        finally:
+            self.connections.discard(task)
+    
+    async def _pump(self, reader, writer):
+        """Copy ``reader`` to ``writer``, each chunk ``delay`` seconds after it arrived"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        
+        async def forward():
+            while True:
+                due, data = await queue.get()
+                wait = due - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if not data:
+                    writer.close()
+                    return
+                writer.write(data)
+                await writer.drain()
+        
+        task = asyncio.ensure_future(forward())
+        try:
+            while True:
+                try:
+                    data = await reader.read(65536)
+                except ConnectionError:
+                    data = b''
+                queue.put_nowait((loop.time() + self.delay, data))
+                if not data:
+                    break
+            await task
+        except ConnectionError:
+            pass
+        finally:
+            task.cancel()
+
+
+def send_sync(port, recipients, data, messages):
+    """Send ``messages`` transactions over one smtplib session; returns their latencies"""
+    latencies = []
+    smtp = smtplib.SMTP('127.0.0.1', port, timeout=TIMEOUT)
+    try:
+        smtp.ehlo()
+        for _ in range(messages):
+            start = time.perf_counter()
+            sendmail(smtp, SENDER, recipients, data)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        smtp.quit()
+    return latencies
+
+
+async def send_async(port, recipients, data, messages):
+    """Coroutine doing what send_sync() does with AsyncSMTP"""
+    latencies = []
+    smtp = AsyncSMTP(local_hostname='localhost', timeout=TIMEOUT)
+    await smtp.connect('127.0.0.1', port)
+    try:
+        await smtp.ehlo()
+        for _ in range(messages):
+            start = time.perf_counter()
+            await smtp.sendmail(SENDER, recipients, data)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        await smtp.quit()
+    return latencies
+
+
+def run_mode(mode, args, handler, port, data, send_loop):
+    """Send ``args.messages`` messages to ``args.recipients`` recipients each"""
+    handler.pipelining = mode == 'pipelined'
+    recipients = [f'user{i}@example.test' for i in range(args.recipients)]
+    received = handler.received
+    start = time.perf_counter()
+    if args.client == 'async':
+        latencies = send_loop.submit(send_async(port, recipients, data, args.messages)).result()
+    else:
+        latencies = send_sync(port, recipients, data, args.messages)
+    elapsed = time.perf_counter() - start
+    return {
+        'sent': handler.received - received,
+        'elapsed': elapsed,
+        'messages_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'latency': summarize(sorted(latencies)),
+    }
+
+
+def parse_args(argv=None):
+    """Parse command line flags"""
+    parser = argparse.ArgumentParser(prog='python -m src.pipeline_benchmark',
+                                     description='Compare multi-recipient sends with and '
+                                                 'without SMTP PIPELINING over a slow link')
+    parser.add_argument('-n', '--messages', type=int, default=5,
+                        help='messages to send per mode (default: 5)')
+    parser.add_argument('-r', '--recipients', type=int, default=200,
+                        help='recipients per message (default: 200)')
+    parser.add_argument('-l', '--latency', type=float, default=10.0,
+                        help='injected round trip time in milliseconds (default: 10)')
+    parser.add_argument('--client', choices=CLIENTS, default='sync',
+                        help='smtplib or asyncio client (default: sync)')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='message body size in bytes (default: 2048)')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f'comma separated modes to run (default: {",".join(MODES)})')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Command line entry point"""
+    args = parse_args(argv)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        print(f"Error: unknown mode: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    handler = CountingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    send_loop = SendLoop()
+    send_loop.start()
+    proxy = LatencyProxy(controller.port, args.latency / 2000)
+    try:
+        send_loop.submit(proxy.start()).result()
+        msg = SMTPSender.create_message(SENDER, 'list@example.test', '', 'Benchmark',
+                                        _text(args.size), [])
+        with flatten(msg) as data:
+            report = {'client': args.client, 'messages': args.messages,
+                      'recipients': args.recipients, 'latency_ms': args.latency, 'modes': {}}
+            for mode in modes:
+                report['modes'][mode] = run_mode(mode, args, handler, proxy.port, data,
+                                                 send_loop)
+        if len(report['modes']) == len(MODES):
+            pipelined = report['modes']['pipelined']['latency']
+            if pipelined and pipelined['mean']:
+                report['speedup'] = report['modes']['serial']['latency']['mean'] / pipelined['mean']
+        send_loop.submit(proxy.stop()).result()
+    finally:
+        send_loop.stop()
+        controller.stop()
+    
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""Full-text search over received mail"""
+
+import heapq
+import json
+import logging
+import os
+import pickle
+import queue
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+from src.metrics import BODY_PARSE_SECONDS
+from src.parsing import parse_body
+from src.sink import LoggingSink, MessageSink
+
+
+FIELDS = ('from', 'to', 'subject', 'body')
+TOKEN_PATTERN = re.compile(r'\w+')
+QUERY_TERM = re.compile(r'(?:(\w+):)?("[^"]*"|\S+)')
+MAX_TOKEN_LENGTH = 64
+MAX_BODY_TOKENS = 5000
+SNAPSHOT_EVERY = 50000
+
+LOG_FILE = 'postings.log'
+SNAPSHOT_FILE = 'snapshot.pkl'
+SNAPSHOT_VERSION = 1
+
+
+def tokenize(text):
+    """Split text into lowercase index tokens"""
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if len(t) <= MAX_TOKEN_LENGTH]
+
+
+def parse_date(value, end=False):
+    """Parse YYYY-MM-DD (or with HH:MM) into a timestamp"""
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        stamp = parsed.timestamp()
+        # A bare date as an upper bound includes the whole day
+        if end and fmt == '%Y-%m-%d':
+            stamp += 86400
+        return stamp
+    raise ValueError(f"Invalid date: {value}")
+
+
+class SearchIndex(MessageSink):
+    """Incremental inverted index over the mail store
+
+    Stored messages are queued by id and indexed by a background thread,
+    so the SMTP path never tokenizes or parses bodies. Postings are
+    per-field arrays of message ids in ascending order; a separate array
+    pair keeps messages sorted by time for date range queries.
+
+    Index updates are appended to a log next to the mail store and folded
+    into a snapshot from time to time. Anything missing on startup (e.g.
+    mail received while no index was attached) is re-indexed from the
+    store.
+
+    Query syntax: plain words match any field, ``from:``, ``to:``,
+    ``subject:`` and ``body:`` restrict a word to one field, and
+    ``after:``/``before:`` take dates (YYYY-MM-DD). All terms must match.
+    
+    A message that cannot be indexed is reported to ``sink`` and skipped.
+    """
+    
+    def __init__(self, store, path=None, sink=None):
+        self.store = store
+        self.path = path or os.path.join(store.path, 'search')
+        self.sink = sink or LoggingSink()
+        self._lock = threading.RLock()
+        self._pending = queue.Queue()
+        self._stopping = threading.Event()
+        self._log = None
+        self._since_snapshot = 0
+        
+        self._reset()
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+        self._log = open(os.path.join(self.path, LOG_FILE), 'a', encoding='utf-8')
+        
+        # Catch up on mail stored while the index was not running, or whose
+        # notification was overtaken by a later message's
+        for msg_id in self._unindexed():
+            self._pending.put(msg_id)
+        
+        self._worker = threading.Thread(target=self._run, name='search-indexer', daemon=True)
+        self._worker.start()
+    
+    # MessageSink interface
+    def message_received(self, record):
+        self._pending.put(record.id)
+    
+    # Indexing
+    def add(self, msg_id):
+        """Index a stored message now"""
+        with self._lock:
+            if self._indexed(msg_id):
+                return
+        record = self.store.get(msg_id)
+        if record is None:
+            return
+        start = time.perf_counter()
+        try:
+            body = parse_body(self.store.iter_raw(msg_id), self.store.body_parse_limit)
+        except Exception:
+            body = ''
+        BODY_PARSE_SECONDS.observe(time.perf_counter() - start)
+        fields = {
+            'from': tokenize(record.sender),
+            'to': tokenize(record.to),
+            'subject': tokenize(str(record.subject or '')),
+            'body': list(dict.fromkeys(tokenize(body)))[:MAX_BODY_TOKENS],
+        }
+        with self._lock:
+            self._apply(msg_id, record.timestamp, fields)
+            self._log.write(json.dumps({'id': msg_id, 't': record.timestamp,
+                                        'f': fields}, separators=(',', ':')) + '\n')
+            self.mark = max(self.mark, msg_id)
+            self._since_snapshot += 1
+            if self._since_snapshot >= SNAPSHOT_EVERY:
+                self._snapshot()
+    
+    def pending(self):
+        """Number of stored messages not indexed yet"""
+        return self._pending.qsize()
+    
+    def clear(self):
+        """Drop the whole index, e.g. after the store was cleared"""
+        with self._lock:
+            self._reset()
+            self._log.close()
+            for name in (LOG_FILE, SNAPSHOT_FILE):
+                path = os.path.join(self.path, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            self._log = open(os.path.join(self.path, LOG_FILE), 'a', encoding='utf-8')
+    
+    def close(self):
+        """Stop the indexer and write a snapshot
+
+        Messages still queued are picked up again on the next start.
+        """
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._pending.put(None)
+        self._worker.join(timeout=5)
+        with self._lock:
+            self._snapshot()
+            self._log.close()
+    
+    # Searching
+    def search(self, query, limit=500):
+        """Return ids of messages matching ``query``, newest first"""
+        terms, start, end = self._parse_query(query)
+        with self._lock:
+            if terms:
+                lists = []
+                for field, token in terms:
+                    fields = (field,) if field else FIELDS
+                    postings = [self._postings[f][token] for f in fields
+                                if token in self._postings[f]]
+                    if not postings:
+                        return []
+                    lists.append(postings)
+                # Drive from the rarest term, newest first, and probe the others
+                lists.sort(key=lambda postings: sum(len(p) for p in postings))
+                candidates = self._descending(lists[0])
+                others = lists[1:]
+            elif start is not None or end is not None:
+                lo = bisect_left(self._times, start) if start is not None else 0
+                hi = bisect_left(self._times, end) if end is not None else len(self._times)
+                candidates = (self._time_ids[i] for i in range(hi - 1, lo - 1, -1))
+                others = []
+            else:
+                return []
+            
+            results = []
+            for msg_id in candidates:
+                if not all(self._contains(postings, msg_id) for postings in others):
+                    continue
+                if start is not None or end is not None:
+                    stamp = self._timestamp(msg_id)
+                    if stamp is None or (start is not None and stamp < start) \
+                            or (end is not None and stamp >= end):
+                        continue
+                if self.store.get_position(msg_id) is None:
+                    continue
+                results.append(msg_id)
+                if len(results) >= limit:
+                    break
+            return results
+    
+    # Internals
+    def _reset(self):
+        self._postings = {field: {} for field in FIELDS}
+        self._ids = array('I')
+        self._stamps = array('d')
+        self._times = array('d')
+        self._time_ids = array('I')
+        self.mark = 0
+    
+    def _apply(self, msg_id, timestamp, fields):
+        for field, tokens in fields.items():
+            postings = self._postings[field]
+            for token in set(tokens):
+                ids = postings.get(token)
+                if ids is None:
+                    postings[token] = array('I', (msg_id,))
+                elif ids[-1] < msg_id:
+                    ids.append(msg_id)
+                elif ids[bisect_left(ids, msg_id)] != msg_id:
+                    # Out of order only while catching up on old mail
+                    ids.insert(bisect_left(ids, msg_id), msg_id)
+        if not self._ids or self._ids[-1] < msg_id:
+            self._ids.append(msg_id)
+            self._stamps.append(timestamp)
+        else:
+            pos = bisect_left(self._ids, msg_id)
+            if pos < len(self._ids) and self._ids[pos] == msg_id:
+                return
+            self._ids.insert(pos, msg_id)
+            self._stamps.insert(pos, timestamp)
+        if not self._times or self._times[-1] <= timestamp:
+            self._times.append(timestamp)
+            self._time_ids.append(msg_id)
+        else:
+            pos = bisect_right(self._times, timestamp)
+            self._times.insert(pos, timestamp)
+            self._time_ids.insert(pos, msg_id)
+    
+    def _snapshot(self):
+        """Persist the in-memory index and start a fresh log"""
+        self._log.flush()
+        state = {
+            'version': SNAPSHOT_VERSION,
+            'postings': self._postings,
+            'ids': self._ids,
+            'stamps': self._stamps,
+            'times': self._times,
+            'time_ids': self._time_ids,
+            'mark': self.mark,
+        }
+        tmp_path = os.path.join(self.path, SNAPSHOT_FILE + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, SNAPSHOT_FILE))
+        self._log.seek(0)
+        self._log.truncate()
+        self._since_snapshot = 0
+    
+    def _load(self):
+        snapshot_path = os.path.join(self.path, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, 'rb') as f:
+                    state = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                state = None
+            if state and state.get('version') == SNAPSHOT_VERSION:
+                self._postings = state['postings']
+                self._ids = state['ids']
+                self._stamps = state['stamps']
+                self._times = state['times']
+                self._time_ids = state['time_ids']
+                self.mark = state['mark']
+        
+        log_path = os.path.join(self.path, LOG_FILE)
+        if not os.path.exists(log_path):
+            return
+        with open(log_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last line after a crash
+                    break
+                self._apply(record['id'], record['t'], record['f'])
+                self.mark = max(self.mark, record['id'])
+                self._since_snapshot += 1
+    
+    def _run(self):
+        while True:
+            msg_id = self._pending.get()
+            if msg_id is None or self._stopping.is_set():
+                return
+            try:
+                self.add(msg_id)
+            except Exception as e:
+                # Keep indexing the rest; one bad message must not stop the thread
+                self.sink.log(f"Cannot index message {msg_id}: {e}", logging.ERROR)
+    
+    def _parse_query(self, query):
+        terms = []
+        start = end = None
+        for field, value in QUERY_TERM.findall(query):
+            field = field.lower()
+            value = value.strip('"')
+            if field == 'after':
+                start = parse_date(value)
+            elif field == 'before':
+                end = parse_date(value, end=True)
+            else:
+                if field and field not in FIELDS:
+                    value = f"{field}:{value}"
+                    field = ''
+                terms.extend((field or None, token) for token in tokenize(value))
+        return terms, start, end
+    
+    def _indexed(self, msg_id):
+        pos = bisect_left(self._ids, msg_id)
+        return pos < len(self._ids) and self._ids[pos] == msg_id
+    
+    def _unindexed(self):
+        """Ids of stored messages missing from the index, oldest first
+
+        Notifications can arrive out of id order, from several committing
+        threads, so this compares against the indexed ids, not the mark.
+        """
+        return sorted(set(self.store.ids_after(0)).difference(self._ids))
+    
+    def _timestamp(self, msg_id):
+        pos = bisect_left(self._ids, msg_id)
+        if pos < len(self._ids) and self._ids[pos] == msg_id:
+            return self._stamps[pos]
+        return None
+    
+    @staticmethod
+    def _contains(postings, msg_id):
+        for ids in postings:
+            pos = bisect_left(ids, msg_id)
+            if pos < len(ids) and ids[pos] == msg_id:
+                return True
+        return False
+    
+    @staticmethod
+    def _descending(postings):
+        """Merge sorted id arrays into one descending, de-duplicated stream"""
+        last = None
+        for msg_id in heapq.merge(*(reversed(ids) for ids in postings), reverse=True):
+            if msg_id != last:
+                last = msg_id
+                yield msg_id
@@ -0,0 +1,191 @@
+"""SMTP sending benchmark, with and without session pooling
+
+Sends the same messages through SMTPSender to a local aiosmtpd stand-in
+for a relay, once opening a session per message and once through an
+SMTPPool, and reports messages per second and send latency as JSON:
+
+    python -m src.send_benchmark --messages 2000 --concurrency 4
+
+With ``--relay auth`` (the default) the stand-in requires STARTTLS and
+AUTH like a submission relay, using a throwaway self-signed certificate
+made with the ``openssl`` command. ``--relay plain`` sends without either,
+like the local mode of the Send Email tab.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+from src.benchmark import _text, free_port, summarize
+from src.smtp_pool import SMTPPool
+from src.smtp_sender import SMTPSender
+
+
+MODES = ('unpooled', 'pooled')
+USER = 'bench@example.test'
+PASSWORD = 'bench'
+
+
+class CountingHandler:
+    """Accepts and drops every message"""
+    
+    def __init__(self):
+        self.received = 0
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return '250 OK'
+
+
+def accept_any(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=True)
+
+
+def make_tls_context(directory):
+    """Create a self-signed certificate in ``directory`` and a server context for it"""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+                   check=True, capture_output=True)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def run_mode(mode, args, port, msg):
+    """Send ``args.messages`` messages from ``args.concurrency`` threads"""
+    pool = SMTPPool(max_connections=args.concurrency) if mode == 'pooled' else None
+    remaining = [args.messages]
+    lock = threading.Lock()
+    latencies = []
+    errors = {}
+    
+    def send_one():
+        if args.relay == 'auth':
+            SMTPSender.send_authenticated(USER, ['inbox@example.test'], msg, '127.0.0.1',
+                                          port, USER, PASSWORD, pool)
+        else:
+            SMTPSender.send_local(USER, ['inbox@example.test'], msg, '127.0.0.1', port, pool)
+    
+    def sender():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                send_one()
+            except Exception as e:
+                with lock:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+    
+    threads = [threading.Thread(target=sender) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    
+    report = {
+        'sent': len(latencies),
+        'errors': errors,
+        'elapsed': elapsed,
+        'messages_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'latency': summarize(sorted(latencies)),
+    }
+    if pool is not None:
+        report['pool'] = pool.stats()
+        pool.close()
+    return report
+
+
+def parse_args(argv=None):
+    """Parse command line flags"""
+    parser = argparse.ArgumentParser(prog='python -m src.send_benchmark',
+                                     description='Compare sending with and without '
+                                                 'SMTP session pooling')
+    parser.add_argument('-n', '--messages', type=int, default=1000,
+                        help='messages to send per mode (default: 1000)')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='sending threads (default: 4)')
+    parser.add_argument('--relay', choices=('auth', 'plain'), default='auth',
+                        help='STARTTLS and AUTH like a relay, or neither (default: auth)')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='message body size in bytes (default: 2048)')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f'comma separated modes to run (default: {",".join(MODES)})')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Command line entry point"""
+    args = parse_args(argv)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        print(f"Error: unknown mode: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    # The stand-in logs a deprecation warning for every AUTH
+    logging.getLogger('mail.log').setLevel(logging.ERROR)
+    cert_dir = tempfile.mkdtemp(prefix='send-bench-')
+    try:
+        smtp_kwargs = {}
+        if args.relay == 'auth':
+            try:
+                smtp_kwargs['tls_context'] = make_tls_context(cert_dir)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f"Error: cannot create a test certificate with openssl: {e}",
+                      file=sys.stderr)
+                return 1
+            smtp_kwargs['authenticator'] = accept_any
+        
+        handler = CountingHandler()
+        port = free_port()
+        controller = Controller(handler, hostname='127.0.0.1', port=port, **smtp_kwargs)
+        controller.start()
+        try:
+            msg = SMTPSender.create_message(USER, 'inbox@example.test', '', 'Benchmark',
+                                            _text(args.size), [])
+            report = {'relay': args.relay, 'messages': args.messages,
+                      'concurrency': args.concurrency, 'modes': {}}
+            for mode in modes:
+                report['modes'][mode] = run_mode(mode, args, port, msg)
+            if len(report['modes']) == len(MODES):
+                base = report['modes']['unpooled']['messages_per_second']
+                if base:
+                    report['speedup'] = report['modes']['pooled']['messages_per_second'] / base
+        finally:
+            controller.stop()
+    finally:
+        shutil.rmtree(cert_dir, ignore_errors=True)
+    
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
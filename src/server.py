@@ -0,0 +1,295 @@
+"""Headless SMTP receiver
+
+Runs the receiving side of the email server without the GUI:
+
+    python -m src.server --host 0.0.0.0 --port 1025 --store /var/lib/mail
+
+Options can also be read from a JSON file passed with ``--config``; flags
+given on the command line take precedence over the file. Further
+addresses are served from the same event loop with ``--listen``:
+
+    python -m src.server --port 25 --listen 0.0.0.0:587 --listen [::1]:1025
+
+On SIGTERM or Ctrl+C new connections get 421 while open sessions have
+``--drain-timeout`` seconds to finish; a second signal stops at once. On
+SIGHUP the config file is read again and the receiver restarts with its
+spool and limit settings, handing the listening sockets to the new
+listeners so no connection is refused, and listeners are added or
+removed to match it.
+"""
+
+import argparse
+import json
+import logging
+import signal
+import sys
+import threading
+
+from src.compression import codec_names
+from src.listeners import DRAIN_TIMEOUT, format_address, parse_address
+from src.mail_store import DEFAULT_CODEC, DEFAULT_STORE_DIR, MailStore, StoreLocked
+from src.metrics import MetricsServer
+from src.offload import DEFAULT_MAX_PENDING, DEFAULT_OFFLOAD_THRESHOLD
+from src.search_index import SearchIndex
+from src.server_log import ServerLog
+from src.server_manager import ServerManager
+from src.sink import FanoutSink, LoggingSink
+from src.spooling import DEFAULT_SPOOL_THRESHOLD
+from src.validators import EmailValidator
+
+
+DEFAULTS = {
+    'host': 'localhost',
+    'port': 1025,
+    'listen': [],
+    'store': DEFAULT_STORE_DIR,
+    'retention': None,
+    'compression': DEFAULT_CODEC,
+    'dictionary': False,
+    'workers': 1,
+    'spool_threshold': DEFAULT_SPOOL_THRESHOLD,
+    'spool_dir': None,
+    'search_index': True,
+    'metrics_port': None,
+    'offload': 'off',
+    'offload_workers': None,
+    'offload_queue': DEFAULT_MAX_PENDING,
+    'offload_threshold': DEFAULT_OFFLOAD_THRESHOLD,
+    'max_sessions': None,
+    'peer_sessions': None,
+    'connection_rate': None,
+    'connection_burst': None,
+    'message_rate': None,
+    'message_burst': None,
+    'drain_timeout': DRAIN_TIMEOUT,
+    'log_level': 'INFO',
+    'log_file': None,
+}
+
+LIMIT_OPTIONS = ('max_sessions', 'peer_sessions', 'connection_rate', 'connection_burst',
+                 'message_rate', 'message_burst')
+
+
+def parse_args(argv=None):
+    """Parse command line flags"""
+    parser = argparse.ArgumentParser(prog='python -m src.server',
+                                     description='Run the SMTP receiver without the GUI')
+    parser.add_argument('--config', help='JSON file with default option values')
+    parser.add_argument('--host', help=f"address to listen on (default: {DEFAULTS['host']})")
+    parser.add_argument('--port', help=f"port to listen on (default: {DEFAULTS['port']})")
+    parser.add_argument('--listen', action='append', metavar='HOST:PORT',
+                        help='also listen on this address, e.g. 0.0.0.0:587 or [::1]:1025; '
+                             'may be repeated')
+    parser.add_argument('--store', help='mail store directory')
+    parser.add_argument('--retention', type=float,
+                        help='drop messages older than this many seconds')
+    parser.add_argument('--compression', choices=codec_names() + ['none'],
+                        help=f"codec for stored messages (default: {DEFAULT_CODEC})")
+    parser.add_argument('--dictionary', action='store_true', default=None,
+                        help='compress with a dictionary trained on stored mail '
+                             'once enough has arrived')
+    parser.add_argument('--workers', type=int,
+                        help='number of SO_REUSEPORT receive processes (default: 1)')
+    parser.add_argument('--spool-threshold', dest='spool_threshold', type=int,
+                        help='spool messages larger than this many bytes to disk')
+    parser.add_argument('--spool-dir', dest='spool_dir',
+                        help='directory for spooled messages (default: system temp)')
+    parser.add_argument('--max-sessions', dest='max_sessions', type=int,
+                        help='maximum concurrent SMTP sessions (per worker)')
+    parser.add_argument('--peer-sessions', dest='peer_sessions', type=int,
+                        help='maximum concurrent sessions per client IP')
+    parser.add_argument('--connection-rate', dest='connection_rate', type=float,
+                        help='new connections per second allowed per client IP')
+    parser.add_argument('--connection-burst', dest='connection_burst', type=int,
+                        help='connections a client IP may open at once above the rate')
+    parser.add_argument('--message-rate', dest='message_rate', type=float,
+                        help='messages per second allowed per client IP')
+    parser.add_argument('--message-burst', dest='message_burst', type=int,
+                        help='messages a client IP may send at once above the rate')
+    parser.add_argument('--offload', choices=('off', 'process', 'thread'),
+                        help='process large messages in a process or thread pool '
+                             '(default: off)')
+    parser.add_argument('--offload-workers', dest='offload_workers', type=int,
+                        help='pool size for --offload (default: CPU based)')
+    parser.add_argument('--offload-queue', dest='offload_queue', type=int,
+                        help='large messages processed at once before clients '
+                             f'wait or get 451 (default: {DEFAULT_MAX_PENDING})')
+    parser.add_argument('--offload-threshold', dest='offload_threshold', type=int,
+                        help='offload messages of at least this many bytes '
+                             f'(default: {DEFAULT_OFFLOAD_THRESHOLD})')
+    parser.add_argument('--drain-timeout', dest='drain_timeout', type=float,
+                        help='seconds open sessions get to finish on shutdown or '
+                             f'reload (default: {DRAIN_TIMEOUT:g})')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+                        help='serve Prometheus metrics on this localhost port')
+    parser.add_argument('--no-search-index', dest='search_index', action='store_false',
+                        default=None, help='do not maintain the full-text search index')
+    parser.add_argument('--log-level', dest='log_level', help='logging level (default: INFO)')
+    parser.add_argument('--log-file', dest='log_file',
+                        help='also write server events to this file, rotated at 5 MB')
+    return parser.parse_args(argv)
+
+
+def load_config(args):
+    """Merge defaults, the config file and command line flags"""
+    config = dict(DEFAULTS)
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    config.update({k: v for k, v in vars(args).items() if v is not None and k != 'config'})
+    
+    valid, port = EmailValidator.validate_port(config['port'])
+    if not valid:
+        raise ValueError(f"Invalid port: {port}")
+    config['port'] = port
+    config['listen'] = [parse_address(address, config['host']) for address in config['listen']]
+    return config
+
+
+def apply_listeners(manager, config, logger):
+    """Restart with the settings in ``config`` and match its listeners"""
+    limits = {key: config[key] for key in LIMIT_OPTIONS}
+    success, message = manager.restart(config['spool_threshold'], config['spool_dir'],
+                                       limits, config['drain_timeout'])
+    logger.log(logging.INFO if success else logging.ERROR, message)
+    wanted = {format_address(host, port): (host, port)
+              for host, port in [(config['host'], config['port'])] + config['listen']}
+    current = set(manager.listener_stats())
+    for address in current - wanted.keys():
+        success, message = manager.remove_listener(address)
+        logger.info(message)
+    for address in wanted.keys() - current:
+        success, message = manager.add_listener(*wanted[address])
+        logger.log(logging.INFO if success else logging.ERROR, message)
+
+
+def run(config, reload_config=None):
+    """Run the server until SIGINT or SIGTERM
+
+    ``reload_config`` returns a fresh config; it is called on SIGHUP to
+    bring the listeners in line with it.
+    """
+    logging.basicConfig(level=config['log_level'].upper(),
+                        format='[%(asctime)s] %(levelname)s %(message)s',
+                        datefmt='%H:%M:%S')
+    logger = logging.getLogger('email_server')
+    # aiosmtpd logs every SMTP command at INFO; keep that for DEBUG runs only
+    if logger.getEffectiveLevel() > logging.DEBUG:
+        logging.getLogger('mail.log').setLevel(logging.WARNING)
+    
+    codec = None if config['compression'] == 'none' else config['compression']
+    try:
+        store = MailStore(config['store'], retention=config['retention'], codec=codec,
+                          auto_dictionary=config['dictionary'])
+    except StoreLocked as e:
+        logger.error("%s", e)
+        return 1
+    sink = LoggingSink(logger)
+    search_index = None
+    if config['search_index']:
+        # Keep the index current so the GUI can search this store later
+        search_index = SearchIndex(store, sink=sink)
+        sink = FanoutSink(search_index, sink)
+    server_log = None
+    if config['log_file']:
+        # Written from a background thread, off the receive path
+        server_log = ServerLog(config['log_file'])
+        sink = FanoutSink(sink, server_log)
+    limits = {key: config[key] for key in LIMIT_OPTIONS}
+    offload = None
+    if config['offload'] != 'off':
+        offload = {
+            'mode': config['offload'],
+            'workers': config['offload_workers'],
+            'max_pending': config['offload_queue'],
+            'threshold': config['offload_threshold'],
+        }
+    manager = ServerManager(store, sink, config['spool_threshold'], config['spool_dir'],
+                            limits, offload)
+    
+    stop_event = threading.Event()
+    
+    def request_stop(signum, frame):
+        if stop_event.is_set():
+            logger.warning("Received %s again, not waiting for open sessions",
+                           signal.Signals(signum).name)
+            manager.cut_off()
+            return
+        logger.info("Received %s, shutting down", signal.Signals(signum).name)
+        stop_event.set()
+    
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    
+    reload_event = threading.Event()
+    if reload_config is not None and hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_event.set())
+    
+    success, message = manager.start(config['host'], config['port'], config['workers'],
+                                     config['listen'])
+    if not success:
+        logger.error("Failed to start server: %s", message)
+        if search_index is not None:
+            search_index.close()
+        if server_log is not None:
+            server_log.close()
+        store.close()
+        return 1
+    logger.info(message)
+    addresses = list(manager.listener_stats()) or [format_address(config['host'], config['port'])]
+    logger.info("Listening on %s, storing mail in %s", ', '.join(addresses), config['store'])
+    
+    metrics_server = None
+    if config['metrics_port']:
+        metrics_server = MetricsServer(port=config['metrics_port'])
+        try:
+            metrics_server.start()
+            logger.info("Serving metrics on http://127.0.0.1:%s/metrics", config['metrics_port'])
+        except OSError as e:
+            logger.error("Failed to start metrics endpoint: %s", e)
+            metrics_server = None
+    
+    try:
+        # Wake up periodically so signals are handled promptly on all platforms
+        while not stop_event.wait(0.5):
+            if reload_event.is_set():
+                reload_event.clear()
+                try:
+                    config = reload_config()
+                except (OSError, ValueError) as e:
+                    logger.error("Cannot reload config: %s", e)
+                    continue
+                if config['workers'] > 1:
+                    logger.warning("Reload is not supported with --workers")
+                    continue
+                logger.info("Reloading configuration")
+                apply_listeners(manager, config, logger)
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        for address, stats in manager.listener_stats().items():
+            logger.info("%s: %d sessions, %d refused, %d messages", address,
+                        stats['sessions'], stats['refused'], stats['messages'])
+        success, message = manager.stop(config['drain_timeout'])
+        logger.info(message)
+        if search_index is not None:
+            search_index.close()
+        if server_log is not None:
+            server_log.close()
+        store.close()
+    return 0
+
+
+def main(argv=None):
+    """Command line entry point"""
+    args = parse_args(argv)
+    try:
+        config = load_config(args)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    return run(config, lambda: load_config(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
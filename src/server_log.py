@@ -0,0 +1,131 @@
+"""Bounded in-memory server log with a rotating log file
+
+ServerLog is a MessageSink that keeps the most recent log records in a
+fixed-size ring. Logging a line is an append under a lock, whatever the
+event rate. A background thread writes new records to a rotating file,
+and readers such as the GUI log view fetch what arrived since they last
+looked, so no consumer slows down the server thread.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+from src.sink import MessageSink
+
+
+DEFAULT_LOG_FILE = os.path.join(os.path.expanduser('~'), '.email_server', 'logs', 'server.log')
+DEFAULT_CAPACITY = 10000
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+
+class ServerLog(MessageSink):
+    """Ring buffer of (seq, created, level, message) log records
+
+    With a ``path`` the records are also appended to that file by a
+    background thread, rotating it at ``max_bytes`` and keeping
+    ``backup_count`` old files. If the writer falls more than
+    ``capacity`` records behind the oldest are skipped and counted in
+    ``dropped``.
+    """
+    
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY, max_bytes=5 * 1024 * 1024,
+                 backup_count=5, flush_interval=0.5):
+        self.path = path
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._records = deque(maxlen=capacity)
+        self._unwritten = deque()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = None
+        self._handler = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._handler = RotatingFileHandler(path, maxBytes=max_bytes,
+                                                backupCount=backup_count, encoding='utf-8')
+            self._handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            self._writer = threading.Thread(target=self._run_writer,
+                                            name='server-log-writer', daemon=True)
+            self._writer.start()
+    
+    # MessageSink interface
+    def log(self, message, level=logging.INFO):
+        with self._lock:
+            self._seq += 1
+            record = (self._seq, time.time(), level, message)
+            self._records.append(record)
+            if self._handler is not None:
+                if len(self._unwritten) >= self.capacity:
+                    self._unwritten.popleft()
+                    self.dropped += 1
+                self._unwritten.append(record)
+    
+    # Reading
+    @property
+    def last_seq(self):
+        """Sequence number of the newest record, 0 if there is none"""
+        return self._seq
+    
+    def since(self, seq, level=logging.NOTSET, limit=None):
+        """Return records newer than ``seq`` at ``level`` or above, oldest first
+
+        Records that have already left the ring are skipped. With ``limit``
+        only the newest ``limit`` matching records are returned.
+        """
+        result = []
+        with self._lock:
+            # Walk back from the newest record; cost is the number of new ones
+            for record in reversed(self._records):
+                if record[0] <= seq or (limit is not None and len(result) >= limit):
+                    break
+                if record[2] >= level:
+                    result.append(record)
+        result.reverse()
+        return result
+    
+    # Log file
+    def flush(self):
+        """Write every pending record to the log file now"""
+        if self._handler is None:
+            return
+        with self._lock:
+            pending = list(self._unwritten)
+            self._unwritten.clear()
+        for seq, created, level, message in pending:
+            record = logging.makeLogRecord({
+                'name': 'email_server', 'msg': message, 'levelno': level,
+                'levelname': logging.getLevelName(level), 'created': created,
+                'msecs': (created % 1) * 1000,
+            })
+            self._handler.handle(record)
+        self._handler.flush()
+    
+    def close(self):
+        """Stop the writer thread after writing what is pending"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._wakeup.set()
+            self._writer.join(timeout=5)
+            self.flush()
+            self._handler.close()
+    
+    def _run_writer(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                # Disk full or file gone; keep logging to the ring
+                pass
@@ -1,40 +1,208 @@
 """SMTP server management"""
 
+import logging
 import threading
-from aiosmtpd.controller import Controller
+
+from src.admission import AdmissionControl
 from src.email_handler import EmailHandler
+from src.listeners import DRAIN_TIMEOUT, ListenerGroup
+from src.metrics import REGISTRY
+from src.offload import OffloadStage
+from src.spooling import DEFAULT_SPOOL_THRESHOLD
+from src.workers import WorkerPool
 
 
 class ServerManager:
     """Manages the SMTP server lifecycle"""
     
-    def __init__(self, gui):
-        self.gui = gui
-        self.smtp_controller = None
+    def __init__(self, store, sink, spool_threshold=DEFAULT_SPOOL_THRESHOLD, spool_dir=None,
+                 limits=None, offload=None):
+        self.store = store
+        self.sink = sink
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        # Keyword arguments for AdmissionControl; empty means no limits
+        self.limits = {k: v for k, v in (limits or {}).items() if v is not None}
+        self.admission = None
+        # Keyword arguments for OffloadStage; None processes everything inline
+        self.offload = offload
+        self.offload_stage = None
+        self.handler = None
+        self.listeners = None
+        # Groups replaced by restart() that are still draining
+        self._retired = []
+        self.worker_pool = None
         self.server_running = False
     
-    def start(self, host, port):
-        """Start SMTP server in background thread"""
+    def start(self, host, port, workers=1, listen=()):
+        """Start SMTP server in background thread
+        
+        ``listen`` holds further (host, port) addresses to serve from the
+        same event loop; more can be added later with add_listener().
+        
+        With ``workers`` greater than one the server runs as that many
+        SO_REUSEPORT worker processes instead of a single thread. Each
+        worker then enforces the admission limits on its own. Worker
+        processes serve a single address.
+        """
         try:
-            handler = EmailHandler(self.gui)
-            self.smtp_controller = Controller(handler, hostname=host, port=port)
-            self.smtp_controller.start()
+            if workers > 1:
+                if listen:
+                    return False, "Additional listeners need a single receive process"
+                self.worker_pool = WorkerPool(self.store, self.sink, host, port, workers,
+                                              self.spool_threshold, self.spool_dir,
+                                              self.limits, self.offload)
+                self.worker_pool.start()
+                self.server_running = True
+                return True, f"Server started successfully with {workers} workers"
+            
+            if self.offload is not None:
+                self.offload_stage = OffloadStage(**self.offload)
+                note = self.offload_stage.start()
+                if note:
+                    self.sink.log(note, logging.WARNING)
+            self.handler = EmailHandler(self.store, self.sink, self.offload_stage)
+            self.listeners = self._new_listeners()
+            for address in [(host, port)] + list(listen):
+                self.listeners.add(*address)
             self.server_running = True
             return True, "Server started successfully"
         except Exception as e:
+            if self.worker_pool is not None:
+                self.worker_pool.stop()
+                self.worker_pool = None
+            if self.listeners is not None:
+                self.listeners.stop()
+                self.listeners = None
+            self.admission = None
+            if self.offload_stage is not None:
+                self.offload_stage.stop()
+                self.offload_stage = None
             return False, str(e)
     
-    def stop(self):
-        """Stop SMTP server"""
+    def stop(self, drain_timeout=0):
+        """Stop SMTP server
+
+        With a ``drain_timeout`` new connections get 421 while open
+        sessions have that many seconds to finish; sessions still open
+        after that are cut off.
+        """
         try:
-            if self.smtp_controller:
-                self.smtp_controller.stop()
-                self.smtp_controller = None
+            note = ""
+            if self.listeners:
+                if drain_timeout:
+                    remaining = self.listeners.drain(drain_timeout)
+                    if remaining:
+                        note = f", {remaining} sessions cut off"
+                self.listeners.stop()
+                self.listeners = None
+            for group in list(self._retired):
+                group.stop()
+            self._retired = []
+            # No sessions left to count; the next start begins afresh
+            self.admission = None
+            if self.offload_stage:
+                self.offload_stage.stop()
+                self.offload_stage = None
+            if self.worker_pool:
+                self.worker_pool.stop(drain_timeout)
+                self.worker_pool = None
             self.server_running = False
-            return True, "Server stopped successfully"
+            return True, f"Server stopped successfully{note}"
         except Exception as e:
             return False, str(e)
     
+    def cut_off(self):
+        """Make a stop() that is waiting for open sessions stop them now"""
+        if self.listeners is not None:
+            self.listeners.stop()
+    
+    def restart(self, spool_threshold=None, spool_dir=None, limits=None,
+                drain_timeout=DRAIN_TIMEOUT):
+        """Swap in new listeners with changed settings without refusing connections
+
+        The new listeners take over the listening sockets of the running
+        ones; sessions already open finish on the old ones, which are
+        stopped after at most ``drain_timeout`` seconds. Settings left as
+        None keep their current value.
+        """
+        if self.listeners is None:
+            return False, "Only a running single-process server can be restarted"
+        if spool_threshold is not None:
+            self.spool_threshold = spool_threshold
+        if spool_dir is not None:
+            self.spool_dir = spool_dir
+        if limits is not None:
+            self.limits = {k: v for k, v in limits.items() if v is not None}
+        old = self.listeners
+        try:
+            new = self._new_listeners()
+            try:
+                new.take_over(old)
+            except Exception:
+                new.stop()
+                raise
+        except Exception as e:
+            return False, f"Restart failed: {e}"
+        self.listeners = new
+        self._retired.append(old)
+        threading.Thread(target=self._retire, args=(old, drain_timeout),
+                         name='smtp-listeners-drain', daemon=True).start()
+        return True, "Server restarted"
+    
+    def add_listener(self, host, port):
+        """Start listening on another address while the server runs"""
+        if self.listeners is None:
+            return False, "Listeners can only be added to a running single-process server"
+        try:
+            listener = self.listeners.add(host, port)
+        except Exception as e:
+            return False, f"Cannot listen on {host}:{port}: {e}"
+        return True, f"Listening on {listener.address}"
+    
+    def remove_listener(self, address):
+        """Stop accepting connections on ``address`` (as shown by listener_stats)"""
+        if self.listeners is None or not self.listeners.remove(address):
+            return False, f"Not listening on {address}"
+        return True, f"Stopped listening on {address}"
+    
+    def listener_stats(self):
+        """Sessions, refusals and messages per listener address"""
+        if self.listeners is None:
+            return {}
+        return self.listeners.stats()
+    
+    def _new_listeners(self):
+        """Start a listener group with the current settings, binding nothing yet
+        
+        After a restart the group shares the AdmissionControl of the one it
+        replaces, so the sessions still open there keep counting against
+        the limits and peers keep their rate limit state.
+        """
+        if self.admission is not None:
+            self.admission.configure(**self.limits)
+        elif self.limits:
+            self.admission = AdmissionControl(**self.limits)
+        group = ListenerGroup(self.handler, self.spool_threshold, self.spool_dir,
+                              self.admission)
+        group.start()
+        return group
+    
+    def _retire(self, group, drain_timeout):
+        remaining = group.drain(drain_timeout)
+        group.stop()
+        try:
+            self._retired.remove(group)
+        except ValueError:
+            # stop() got to it first
+            pass
+        if remaining:
+            self.sink.log(f"{remaining} sessions cut off after restart", logging.WARNING)
+    
     def is_running(self):
         """Check if server is running"""
         return self.server_running
+    
+    def metrics(self):
+        """Snapshot of receive counters and per-stage latency percentiles"""
+        return REGISTRY.snapshot()
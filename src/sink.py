@@ -0,0 +1,45 @@
+"""Event sinks for the SMTP server"""
+
+import logging
+
+
+class MessageSink:
+    """Receives notifications from the SMTP server
+    
+    The server only talks to a sink, never to a UI directly. Subclasses
+    override the methods they care about; the default is to ignore events.
+    """
+    
+    def message_received(self, record):
+        """Called with the MessageRecord of a newly stored message"""
+    
+    def log(self, message, level=logging.INFO):
+        """Called with a human readable server event and its logging level"""
+
+
+class LoggingSink(MessageSink):
+    """Sink that writes server events to the logging module"""
+    
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('email_server')
+    
+    def message_received(self, record):
+        self.logger.debug("Stored message %s from %s", record.id, record.sender)
+    
+    def log(self, message, level=logging.INFO):
+        self.logger.log(level, message)
+
+
+class FanoutSink(MessageSink):
+    """Sink that forwards every event to several sinks in order"""
+    
+    def __init__(self, *sinks):
+        self.sinks = sinks
+    
+    def message_received(self, record):
+        for sink in self.sinks:
+            sink.message_received(record)
+    
+    def log(self, message, level=logging.INFO):
+        for sink in self.sinks:
+            sink.log(message, level)
@@ -0,0 +1,290 @@
+"""Pool of reusable SMTP client sessions
+
+Opening a session to a relay costs a TCP connect, EHLO, usually STARTTLS
+with a TLS handshake and a second EHLO, and AUTH, before the first
+message can go. SMTPPool keeps sessions open per (host, port, user) and
+hands them out again, so a run of messages to the same relay pays that
+once per session rather than once per message.
+
+A session is checked with NOOP before reuse if it has been idle for a
+while, reset with RSET after a refused transaction, and closed once it
+has been idle for ``idle_timeout`` seconds or has carried
+``max_messages`` messages. The pool can be shared between threads; each
+session is used by one sender at a time.
+"""
+
+import smtplib
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from src.mime_writer import sendmail
+
+
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_IDLE_TIMEOUT = 30.0
+DEFAULT_MAX_MESSAGES = 100
+DEFAULT_CHECK_AFTER = 2.0
+DEFAULT_TIMEOUT = 10.0
+
+# Errors after which the session is still in a known state
+TRANSACTION_ERRORS = (smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused,
+                      smtplib.SMTPDataError)
+
+
+class PooledSession:
+    """An open smtplib.SMTP or AsyncSMTP and how much it has been used"""
+    
+    def __init__(self, key, smtp):
+        self.key = key
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+
+class SessionPool:
+    """Bookkeeping shared by SMTPPool and async_smtp.AsyncSMTPPool
+
+    Keeps the idle sessions and open counts per (host, port, user) and
+    decides which session is handed out, checked or retired. Subclasses
+    do the I/O and the waiting, and hold their lock around the methods
+    that say so.
+    """
+    
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, max_messages=DEFAULT_MAX_MESSAGES,
+                 check_after=DEFAULT_CHECK_AFTER, timeout=DEFAULT_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.check_after = check_after
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self._idle = {}
+        self._open = {}
+        self._closed = False
+    
+    def stats(self):
+        """Counters and current session numbers"""
+        return {
+            'created': self.created,
+            'reused': self.reused,
+            'discarded': self.discarded,
+            'open': sum(self._open.values()),
+            'idle': sum(len(sessions) for sessions in self._idle.values()),
+        }
+    
+    def _claim(self, key):
+        """Return an idle session for ``key``, None with a slot reserved, or False
+
+        False means ``key`` is at max_connections. Lock held.
+        """
+        if self._closed:
+            raise RuntimeError("SMTP pool is closed")
+        idle = self._idle.get(key)
+        if idle:
+            # Most recently used first; the oldest ones time out
+            return idle.pop()
+        if self._open.get(key, 0) < self.max_connections:
+            self._open[key] = self._open.get(key, 0) + 1
+            return None
+        return False
+    
+    def _busy(self, key):
+        return TimeoutError(f"No SMTP session to {key[0]}:{key[1]} "
+                            f"free after {self.timeout:g}s")
+    
+    def _fresh(self, pooled):
+        """True if ``pooled`` was used too recently to need a NOOP"""
+        return time.monotonic() - pooled.last_used < self.check_after
+    
+    def _take_stale(self, now):
+        """Remove and return idle sessions past idle_timeout; lock held"""
+        stale = []
+        for key, idle in self._idle.items():
+            while idle and now - idle[0].last_used > self.idle_timeout:
+                stale.append(idle.popleft())
+                self._open[key] -= 1
+        return stale
+    
+    def _take_idle(self):
+        """Close the pool and remove and return every idle session; lock held"""
+        self._closed = True
+        idle = [pooled for sessions in self._idle.values() for pooled in sessions]
+        self._idle = {}
+        for pooled in idle:
+            self._open[pooled.key] -= 1
+        return idle
+    
+    def _retired(self, pooled):
+        """True if ``pooled`` has carried max_messages messages"""
+        return pooled.messages >= self.max_messages
+    
+    def _park(self, pooled):
+        """Put a used session back on the idle list; False if the pool is closed; lock held"""
+        if self._closed:
+            return False
+        pooled.last_used = time.monotonic()
+        self._idle.setdefault(pooled.key, deque()).append(pooled)
+        return True
+    
+    def _forget(self, key, discarded=0):
+        """Free the slot of a session that is gone; lock held"""
+        self._open[key] -= 1
+        self.discarded += discarded
+
+
+class SMTPPool(SessionPool):
+    """Live SMTP sessions keyed by (host, port, user)
+
+    At most ``max_connections`` sessions are open per key; further
+    senders wait up to ``timeout`` seconds for one to be returned.
+    Sessions idle for longer than ``check_after`` seconds are checked
+    with NOOP before they are handed out.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._available = threading.Condition()
+    
+    @contextmanager
+    def session(self, host, port, user=None, password=None, starttls=False):
+        """Yield a connected, logged in smtplib.SMTP for one or more messages
+
+        A refused sender, recipient or message leaves the session usable;
+        it is reset and returned to the pool. Any other error closes it.
+        """
+        pooled = self._acquire((host, port, user), password, starttls)
+        try:
+            yield pooled.smtp
+        except TRANSACTION_ERRORS:
+            self._release(pooled, reset=True)
+            raise
+        except BaseException:
+            self._discard(pooled)
+            raise
+        else:
+            self._release(pooled)
+    
+    def sendmail(self, host, port, from_addr, to_addrs, msg, user=None, password=None,
+                 starttls=False):
+        """Send one message over a pooled session; returns sendmail()'s refused dict
+
+        ``msg`` may be a FlatMessage, which is streamed to the server.
+
+        A session the server has closed since its last use is only noticed
+        when sending, so a disconnect is retried once on a new session.
+        """
+        for attempt in range(2):
+            try:
+                with self.session(host, port, user, password, starttls) as smtp:
+                    return sendmail(smtp, from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+    
+    def prune(self):
+        """Close sessions that have been idle for longer than idle_timeout"""
+        with self._available:
+            stale = self._take_stale(time.monotonic())
+            if stale:
+                self._available.notify_all()
+        for pooled in stale:
+            self._quit(pooled)
+    
+    def close(self):
+        """Close every idle session; sessions in use are closed when returned"""
+        with self._available:
+            idle = self._take_idle()
+            self._available.notify_all()
+        for pooled in idle:
+            self._quit(pooled)
+    
+    def stats(self):
+        with self._available:
+            return super().stats()
+    
+    def _acquire(self, key, password, starttls):
+        self.prune()
+        while True:
+            pooled = self._checkout(key)
+            if pooled is None:
+                # A slot has been reserved for a new session
+                try:
+                    return self._connect(key, password, starttls)
+                except BaseException:
+                    self._drop(key)
+                    raise
+            if self._fresh(pooled) or self._healthy(pooled):
+                with self._available:
+                    self.reused += 1
+                return pooled
+            self._discard(pooled)
+    
+    def _checkout(self, key):
+        """Return an idle session for ``key``, or None with a slot reserved"""
+        deadline = time.monotonic() + self.timeout
+        with self._available:
+            while True:
+                pooled = self._claim(key)
+                if pooled is not False:
+                    return pooled
+                now = time.monotonic()
+                if now >= deadline:
+                    raise self._busy(key)
+                self._available.wait(deadline - now)
+    
+    def _connect(self, key, password, starttls):
+        host, port, user = key
+        smtp = smtplib.SMTP(host, port, timeout=self.timeout)
+        try:
+            if starttls:
+                smtp.starttls()
+            if user:
+                smtp.login(user, password)
+        except BaseException:
+            smtp.close()
+            raise
+        with self._available:
+            self.created += 1
+        return PooledSession(key, smtp)
+    
+    def _healthy(self, pooled):
+        try:
+            return pooled.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+    
+    def _release(self, pooled, reset=False):
+        pooled.messages += 1
+        if reset:
+            try:
+                pooled.smtp.rset()
+            except (smtplib.SMTPException, OSError):
+                self._discard(pooled)
+                return
+        if not self._retired(pooled):
+            with self._available:
+                if self._park(pooled):
+                    self._available.notify()
+                    return
+        self._discard(pooled)
+    
+    def _discard(self, pooled):
+        self._drop(pooled.key, discarded=1)
+        self._quit(pooled)
+    
+    def _drop(self, key, discarded=0):
+        with self._available:
+            self._forget(key, discarded)
+            self._available.notify()
+    
+    @staticmethod
+    def _quit(pooled):
+        try:
+            pooled.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pooled.smtp.close()
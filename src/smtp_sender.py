@@ -1,121 +1,437 @@
 """SMTP email sending functionality"""
 
+import asyncio
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
-import os
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+
+from src.async_smtp import AsyncSMTP
+from src.mime_writer import StreamingMessage, flatten, sendmail
+
+
+# Deliveries in flight at once in send_direct, overall and per mail host
+DIRECT_CONCURRENCY = 8
+DIRECT_HOST_CONCURRENCY = 2
+# RFC 5321 requires servers to accept at least 100 recipients per message
+MAX_RECIPIENTS = 100
 
 
 class SMTPSender:
     """Handles sending emails via different methods"""
     
     @staticmethod
-    def send_local(sender, recipients, msg, host, port):
-        """Send email to local SMTP server"""
-        server = smtplib.SMTP(host, port, timeout=10)
-        server.sendmail(sender, recipients, msg.as_string())
-        server.quit()
+    def send_local(sender, recipients, msg, host, port, pool=None):
+        """Send email to local SMTP server, reusing a session from ``pool`` if given"""
+        with flatten(msg) as data:
+            if pool is not None:
+                pool.sendmail(host, port, sender, recipients, data)
+                return True, "Email sent successfully to local server!"
+            server = smtplib.SMTP(host, port, timeout=10)
+            sendmail(server, sender, recipients, data)
+            server.quit()
         return True, "Email sent successfully to local server!"
     
     @staticmethod
-    def send_direct(sender, recipients, msg, logger):
-        """Send email directly to recipient's mail server"""
-        import dns.resolver
+    def send_direct(sender, recipients, msg, logger, concurrency=DIRECT_CONCURRENCY,
+                    host_concurrency=DIRECT_HOST_CONCURRENCY, resolver=None):
+        """Send email directly to recipient's mail server
+
+        Recipients are grouped by domain and then by MX host, and each host
+        gets one transaction carrying all of its recipients. Different hosts
+        are delivered to at the same time, at most ``concurrency`` at once
+        and ``host_concurrency`` to any one host. If the preferred host
+        cannot be reached the next MX host is tried.
+        
+        MX lookups go through ``resolver``, by default the shared cached
+        MXResolver. The message is flattened once for all of them.
+        """
+        with flatten(msg) as data:
+            errors = SMTPSender.deliver_direct(sender, recipients, data, logger,
+                                               concurrency, host_concurrency, resolver)
         
         sent_count = 0
         failed = []
-        
         for recipient_email in recipients:
-            try:
-                # Extract domain from email
-                domain = recipient_email.split('@')[1]
-                
-                # Look up MX records
-                logger(f"Looking up MX records for {domain}...")
-                mx_records = dns.resolver.resolve(domain, 'MX')
-                mx_host = str(mx_records[0].exchange).rstrip('.')
-                
-                logger(f"Connecting to {mx_host}:25 for {recipient_email}...")
-                
-                # Connect to recipient's mail server
-                server = smtplib.SMTP(timeout=20)
-                server.set_debuglevel(1)
-                
-                # Try to connect
-                try:
-                    server.connect(mx_host, 25)
-                except Exception:
-                    logger(f"Port 25 failed, trying port 587...")
-                    server.connect(mx_host, 587)
-                
-                # Try EHLO with a proper hostname
-                server.ehlo('localhost.localdomain')
-                
-                # Try STARTTLS if available
-                if server.has_extn('STARTTLS'):
-                    try:
-                        server.starttls()
-                        server.ehlo('localhost.localdomain')
-                    except:
-                        pass
-                
-                # Send the email
-                server.sendmail(sender, [recipient_email], msg.as_string())
-                server.quit()
-                
+            if recipient_email in errors:
+                reason = SMTPSender.failure_reason(errors[recipient_email])
+                failed.append(f"{recipient_email}: {reason}")
+                logger(f"✗ {recipient_email}: {reason}")
+            else:
                 sent_count += 1
                 logger(f"✓ Sent to {recipient_email}")
-                
-            except smtplib.SMTPRecipientsRefused:
-                error_msg = "Recipient refused (likely needs authentication)"
-                failed.append(f"{recipient_email}: {error_msg}")
-                logger(f"✗ {recipient_email}: {error_msg}")
-            except smtplib.SMTPSenderRefused:
-                error_msg = "Sender refused (server doesn't trust your address)"
-                failed.append(f"{recipient_email}: {error_msg}")
-                logger(f"✗ {recipient_email}: {error_msg}")
-            except ConnectionRefusedError:
-                error_msg = "Connection refused (port 25 likely blocked by ISP)"
-                failed.append(f"{recipient_email}: {error_msg}")
-                logger(f"✗ {recipient_email}: {error_msg}")
-            except Exception as e:
-                error_msg = str(e)
-                failed.append(f"{recipient_email}: {error_msg}")
-                logger(f"✗ Failed to send to {recipient_email}: {error_msg}")
         
         return sent_count, failed
     
     @staticmethod
-    def send_authenticated(sender, recipients, msg, smtp_server, smtp_port, smtp_email, smtp_password):
-        """Send email via authenticated SMTP server (e.g., Gmail)"""
-        server = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
-        server.starttls()
-        server.login(smtp_email, smtp_password)
-        server.sendmail(sender, recipients, msg.as_string())
-        server.quit()
+    def deliver_direct(sender, recipients, data, logger, concurrency=DIRECT_CONCURRENCY,
+                       host_concurrency=DIRECT_HOST_CONCURRENCY, resolver=None):
+        """Deliver ``data`` to each recipient's mail server as send_direct() does
+
+        ``data`` is bytes or a FlatMessage. Returns the recipients that
+        failed, each mapped to its exception. A recipient refused within an
+        accepted transaction maps to an SMTPRecipientsRefused holding only
+        that recipient.
+        """
+        from src.mx_resolver import MXResolver
+        
+        resolver = resolver or MXResolver.shared()
+        domains = {}
+        for recipient_email in recipients:
+            domain = recipient_email.rpartition('@')[2].lower()
+            domains.setdefault(domain, []).append(recipient_email)
+        
+        errors = {}
+        by_host = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            lookups = {domain: executor.submit(SMTPSender._lookup_mx, resolver, domain, logger)
+                       for domain in domains}
+            for domain, lookup in lookups.items():
+                try:
+                    hosts = lookup.result()
+                except Exception as e:
+                    for recipient_email in domains[domain]:
+                        errors[recipient_email] = e
+                    continue
+                # Domains with the same hosts in the same order go together;
+                # the per host limit is on the preferred one
+                by_host.setdefault(tuple(hosts), []).extend(domains[domain])
+            
+            limits = {hosts[0]: threading.Semaphore(host_concurrency) for hosts in by_host}
+            deliveries = {}
+            for hosts, batch_recipients in SMTPSender._host_batches(by_host):
+                future = executor.submit(SMTPSender._deliver, hosts, limits[hosts[0]], sender,
+                                         batch_recipients, data, logger)
+                deliveries[future] = batch_recipients
+            
+            for future, batch_recipients in deliveries.items():
+                try:
+                    refused = future.result()
+                except Exception as e:
+                    refused = {}
+                    for recipient_email in batch_recipients:
+                        errors[recipient_email] = e
+                errors.update(SMTPSender._refusals(refused))
+        return errors
+    
+    @staticmethod
+    def _host_batches(by_host):
+        """Split each host group's recipients into transactions, interleaving the groups
+
+        Interleaved, waiting on one host's limit holds up few workers.
+        """
+        batches = [[(hosts, host_recipients[i:i + MAX_RECIPIENTS])
+                    for i in range(0, len(host_recipients), MAX_RECIPIENTS)]
+                   for hosts, host_recipients in by_host.items()]
+        return [item for batch in zip_longest(*batches) for item in batch if item is not None]
+    
+    @staticmethod
+    def _refusals(refused):
+        """Map recipients refused in an accepted transaction to their own errors"""
+        return {recipient_email: smtplib.SMTPRecipientsRefused({recipient_email: reply})
+                for recipient_email, reply in refused.items()}
+    
+    @staticmethod
+    def _lookup_mx(resolver, domain, logger):
+        """Return the mail hosts for ``domain``, most preferred first"""
+        logger(f"Looking up MX records for {domain}...")
+        return resolver.lookup(domain)
+    
+    @staticmethod
+    def _deliver(mx_hosts, limit, sender, recipients, data, logger):
+        """Send one transaction to the first reachable host; returns the refused recipients"""
+        with limit:
+            for i, mx_host in enumerate(mx_hosts):
+                try:
+                    server = SMTPSender._connect_mx(mx_host, len(recipients), logger)
+                except (OSError, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected) as e:
+                    if i == len(mx_hosts) - 1:
+                        raise
+                    logger(f"{mx_host} unreachable ({e}), trying {mx_hosts[i + 1]}...")
+                    continue
+                try:
+                    # One transaction with a RCPT TO per recipient
+                    return sendmail(server, sender, recipients, data)
+                finally:
+                    SMTPSender._quit(server)
+    
+    @staticmethod
+    def _quit(server):
+        """Say QUIT and close; closes regardless if the server is gone"""
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+    
+    @staticmethod
+    def _connect_mx(mx_host, count, logger):
+        """Connect to ``mx_host`` and greet it, with STARTTLS when offered"""
+        logger(f"Connecting to {mx_host}:25 for {count} recipient(s)...")
+        
+        # Connect to recipient's mail server
+        server = smtplib.SMTP(timeout=20)
+        server.set_debuglevel(1)
+        
+        # Try to connect
+        try:
+            server.connect(mx_host, 25)
+        except Exception:
+            logger(f"Port 25 failed, trying port 587...")
+            server.connect(mx_host, 587)
+        
+        try:
+            # Try EHLO with a proper hostname
+            server.ehlo('localhost.localdomain')
+            
+            # Try STARTTLS if available
+            if server.has_extn('STARTTLS'):
+                try:
+                    server.starttls()
+                    server.ehlo('localhost.localdomain')
+                except:
+                    pass
+        except BaseException:
+            server.close()
+            raise
+        return server
+    
+    @staticmethod
+    def failure_reason(error):
+        """Describe a delivery error for the user"""
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return "Recipient refused (likely needs authentication)"
+        if isinstance(error, smtplib.SMTPSenderRefused):
+            return "Sender refused (server doesn't trust your address)"
+        if isinstance(error, ConnectionRefusedError):
+            return "Connection refused (port 25 likely blocked by ISP)"
+        return str(error)
+    
+    @staticmethod
+    def deliver(route, sender, recipients, data, logger=None, pool=None, password=None,
+                resolver=None):
+        """Deliver ``data`` the way ``route`` says and report failures per recipient
+
+        ``route`` is a dict with a ``mode`` of ``local`` (with ``host`` and
+        ``port``), ``external`` (also ``user``, logging in with
+        ``password``) or ``direct``. Returns the recipients that failed,
+        each mapped to its exception, like deliver_direct().
+        """
+        logger = logger or (lambda message: None)
+        if route['mode'] == 'direct':
+            return SMTPSender.deliver_direct(sender, recipients, data, logger,
+                                             resolver=resolver)
+        
+        user = route.get('user') if route['mode'] == 'external' else None
+        starttls = route['mode'] == 'external'
+        try:
+            if pool is not None:
+                refused = pool.sendmail(route['host'], route['port'], sender, recipients, data,
+                                        user, password, starttls)
+            else:
+                server = smtplib.SMTP(route['host'], route['port'], timeout=10)
+                try:
+                    if starttls:
+                        server.starttls()
+                    if user:
+                        server.login(user, password)
+                    refused = sendmail(server, sender, recipients, data)
+                finally:
+                    # After a 421 the server is gone, and a failing QUIT
+                    # would hide the refusal
+                    SMTPSender._quit(server)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except Exception as e:
+            return {recipient_email: e for recipient_email in recipients}
+        return SMTPSender._refusals(refused)
+    
+    # Asyncio versions, for callers that must not block, such as the GUI
+    @staticmethod
+    async def deliver_async(route, sender, recipients, data, logger=None, pool=None,
+                            password=None, resolver=None, progress=None):
+        """Coroutine doing what deliver() does without blocking its event loop
+
+        ``pool`` is an AsyncSMTPPool. ``progress(recipient, error)`` is
+        called as soon as each recipient's outcome is known, with None for
+        delivered. Cancelling the task abandons the deliveries in flight.
+        """
+        logger = logger or (lambda message: None)
+        if route['mode'] == 'direct':
+            return await SMTPSender.deliver_direct_async(sender, recipients, data, logger,
+                                                         resolver=resolver, progress=progress)
+        
+        user = route.get('user') if route['mode'] == 'external' else None
+        starttls = route['mode'] == 'external'
+        try:
+            if pool is not None:
+                refused = await pool.sendmail(route['host'], route['port'], sender, recipients,
+                                              data, user, password, starttls)
+            else:
+                server = AsyncSMTP()
+                await server.connect(route['host'], route['port'])
+                try:
+                    if starttls:
+                        await server.starttls()
+                    if user:
+                        await server.login(user, password)
+                    refused = await server.sendmail(sender, recipients, data)
+                finally:
+                    await server.quit()
+        except smtplib.SMTPRecipientsRefused as e:
+            errors = SMTPSender._refusals(e.recipients)
+        except Exception as e:
+            errors = {recipient_email: e for recipient_email in recipients}
+        else:
+            errors = SMTPSender._refusals(refused)
+        SMTPSender._report(progress, recipients, errors)
+        return errors
+    
+    @staticmethod
+    async def deliver_direct_async(sender, recipients, data, logger,
+                                   concurrency=DIRECT_CONCURRENCY,
+                                   host_concurrency=DIRECT_HOST_CONCURRENCY, resolver=None,
+                                   progress=None):
+        """Coroutine doing what deliver_direct() does; see deliver_async() for ``progress``
+
+        MX lookups run in the loop's default executor, since MXResolver
+        blocks; they share its cache with the threaded path.
+        """
+        from src.mx_resolver import MXResolver
+        
+        resolver = resolver or MXResolver.shared()
+        loop = asyncio.get_running_loop()
+        domains = {}
+        for recipient_email in recipients:
+            domain = recipient_email.rpartition('@')[2].lower()
+            domains.setdefault(domain, []).append(recipient_email)
+        
+        errors = {}
+        lookups = await asyncio.gather(
+            *(loop.run_in_executor(None, SMTPSender._lookup_mx, resolver, domain, logger)
+              for domain in domains), return_exceptions=True)
+        by_host = {}
+        for (domain, domain_recipients), hosts in zip(domains.items(), lookups):
+            if isinstance(hosts, Exception):
+                domain_errors = {recipient_email: hosts for recipient_email in domain_recipients}
+                errors.update(domain_errors)
+                SMTPSender._report(progress, domain_recipients, domain_errors)
+                continue
+            by_host.setdefault(tuple(hosts), []).extend(domain_recipients)
+        
+        overall = asyncio.Semaphore(concurrency)
+        limits = {hosts[0]: asyncio.Semaphore(host_concurrency) for hosts in by_host}
+        
+        async def deliver_batch(hosts, batch_recipients):
+            async with limits[hosts[0]], overall:
+                try:
+                    refused = await SMTPSender._deliver_async(hosts, sender, batch_recipients,
+                                                              data, logger)
+                except Exception as e:
+                    batch_errors = {recipient_email: e for recipient_email in batch_recipients}
+                else:
+                    batch_errors = SMTPSender._refusals(refused)
+            errors.update(batch_errors)
+            SMTPSender._report(progress, batch_recipients, batch_errors)
+        
+        await asyncio.gather(*(deliver_batch(hosts, batch_recipients) for hosts, batch_recipients
+                               in SMTPSender._host_batches(by_host)))
+        return errors
+    
+    @staticmethod
+    async def _deliver_async(mx_hosts, sender, recipients, data, logger):
+        """Send one transaction to the first reachable host; returns the refused recipients"""
+        for i, mx_host in enumerate(mx_hosts):
+            try:
+                server = await SMTPSender._connect_mx_async(mx_host, len(recipients), logger)
+            except (OSError, smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected) as e:
+                if i == len(mx_hosts) - 1:
+                    raise
+                logger(f"{mx_host} unreachable ({e}), trying {mx_hosts[i + 1]}...")
+                continue
+            try:
+                return await server.sendmail(sender, recipients, data)
+            finally:
+                await server.quit()
+    
+    @staticmethod
+    async def _connect_mx_async(mx_host, count, logger):
+        """Connect to ``mx_host`` and greet it, with STARTTLS when offered"""
+        logger(f"Connecting to {mx_host}:25 for {count} recipient(s)...")
+        server = AsyncSMTP('localhost.localdomain', timeout=20)
+        try:
+            await server.connect(mx_host, 25)
+        except Exception:
+            logger(f"Port 25 failed, trying port 587...")
+            await server.connect(mx_host, 587)
+        
+        try:
+            await server.ehlo()
+            if server.has_extn('STARTTLS'):
+                try:
+                    await server.starttls()
+                except (smtplib.SMTPException, ssl.SSLError):
+                    # Carry on in plain text if the server allows it
+                    await server.ehlo()
+        except BaseException:
+            server.close()
+            raise
+        return server
+    
+    @staticmethod
+    def _report(progress, recipients, errors):
+        if progress is not None:
+            for recipient_email in recipients:
+                progress(recipient_email, errors.get(recipient_email))
+    
+    @staticmethod
+    async def check_login_async(host, port, user, password):
+        """Connect to a relay, STARTTLS and log in; raises what sending would"""
+        server = AsyncSMTP()
+        await server.connect(host, port)
+        try:
+            await server.starttls()
+            await server.login(user, password)
+        finally:
+            await server.quit()
+    
+    @staticmethod
+    def send_authenticated(sender, recipients, msg, smtp_server, smtp_port, smtp_email, smtp_password,
+                           pool=None):
+        """Send email via authenticated SMTP server (e.g., Gmail)
+
+        With a ``pool`` the STARTTLS and login of an earlier message are
+        reused while its session is still open.
+        """
+        with flatten(msg) as data:
+            if pool is not None:
+                pool.sendmail(smtp_server, smtp_port, sender, recipients, data,
+                              smtp_email, smtp_password, starttls=True)
+                return True, f"Email sent successfully to {len(recipients)} recipient(s)!"
+            server = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
+            server.starttls()
+            server.login(smtp_email, smtp_password)
+            sendmail(server, sender, recipients, data)
+            server.quit()
         return True, f"Email sent successfully to {len(recipients)} recipient(s)!"
     
     @staticmethod
     def create_message(sender, recipient, cc, subject, body, attachments):
-        """Create MIME message with attachments"""
-        msg = MIMEMultipart()
+        """Create MIME message with attachments
+
+        Attachments are read and encoded in chunks when the message is
+        written, not here.
+        """
+        msg = StreamingMessage()
         msg['From'] = sender
         msg['To'] = recipient
         if cc:
             msg['Cc'] = cc
         msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
+        msg.attach_text(body, 'plain')
         
         # Add attachments
         for file_path in attachments:
-            with open(file_path, 'rb') as f:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(f.read())
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', 
-                              f'attachment; filename={os.path.basename(file_path)}')
-                msg.attach(part)
+            msg.attach_file(file_path)
         
         return msg
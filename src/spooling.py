@@ -0,0 +1,288 @@
+"""Disk spooling of inbound message data
+
+aiosmtpd collects the whole DATA phase as a list of lines and joins it into
+one bytes object. SpoolingSMTP instead writes each line to a MessageSpool,
+which stays in memory for small messages and moves to a temporary file once
+it passes a size threshold, so memory per session is bounded by the
+threshold rather than the message size.
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from io import BytesIO
+
+from aiosmtpd.smtp import SMTP, MISSING, _DataState
+
+from src.metrics import (BYTES_RECEIVED, DATA_RECEIVE_SECONDS, MESSAGES_REJECTED,
+                         SESSION_SECONDS, SESSIONS, SESSIONS_REFUSED)
+
+
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+
+
+class MessageSpool:
+    """Write-once buffer that rolls over to a temp file past a threshold"""
+    
+    def __init__(self, threshold=DEFAULT_SPOOL_THRESHOLD, directory=None):
+        self.threshold = threshold
+        self.directory = directory
+        self.size = 0
+        self._file = BytesIO()
+        self._path = None
+    
+    @property
+    def in_memory(self):
+        """True while the data has not been written to disk"""
+        return self._path is None
+    
+    @property
+    def path(self):
+        """Path of the spool file, flushed for other processes to read"""
+        if self._path is not None:
+            self._file.flush()
+        return self._path
+    
+    def write(self, data):
+        if self._path is None and self.size + len(data) > self.threshold:
+            self._rollover()
+        self._file.write(data)
+        self.size += len(data)
+    
+    def getvalue(self):
+        """Return the data as bytes; only valid while in memory"""
+        return self._file.getvalue()
+    
+    # Read side, so the spool can be handed to MailStore.append directly
+    def read(self, size=-1):
+        return self._file.read(size)
+    
+    def seek(self, pos, whence=os.SEEK_SET):
+        return self._file.seek(pos, whence)
+    
+    def tell(self):
+        return self._file.tell()
+    
+    def detach(self):
+        """Hand the spool file over to the caller and return its path
+
+        The caller becomes responsible for deleting the file.
+        """
+        if self._path is None:
+            self._rollover()
+        self._file.close()
+        path, self._path = self._path, None
+        self._file = BytesIO()
+        self.size = 0
+        return path
+    
+    def close(self):
+        """Release the buffer and delete the temp file, if any"""
+        self._file.close()
+        if self._path is not None:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+            self._path = None
+    
+    def _rollover(self):
+        fd, path = tempfile.mkstemp(prefix='spool-', suffix='.eml', dir=self.directory)
+        disk = os.fdopen(fd, 'w+b')
+        disk.write(self._file.getbuffer())
+        self._file = disk
+        self._path = path
+
+
+def message_source(envelope):
+    """Return the message as bytes, or the on-disk spool for large ones"""
+    spool = getattr(envelope, 'spool', None)
+    if spool is not None and not spool.in_memory:
+        spool.seek(0)
+        return spool
+    return envelope.content
+
+
+def message_size(envelope):
+    """Return the size of the received message in bytes"""
+    spool = getattr(envelope, 'spool', None)
+    if spool is not None:
+        return spool.size
+    return len(envelope.content or b'')
+
+
+def declared_size(envelope):
+    """Return the SIZE the client gave in MAIL FROM, or None"""
+    for option in envelope.mail_options:
+        name, _, value = option.partition('=')
+        if name == 'SIZE' and value.isdigit():
+            return int(value)
+    return None
+
+
+class SpoolingSMTP(SMTP):
+    """SMTP server protocol that spools DATA instead of buffering it
+
+    Messages up to ``spool_threshold`` bytes are handed to the handler in
+    ``envelope.content`` as usual. Larger messages leave ``content`` as
+    None and are available through ``envelope.spool``.
+    
+    With an AdmissionControl, sessions over its limits get a 421 instead
+    of the greeting and rate limited peers get a 451 to MAIL FROM. A
+    handler with an ``overloaded(envelope)`` method can refuse DATA with a
+    451 before the client sends the message.
+    
+    Sessions and accepted messages are also counted on ``listener``, the
+    Listener this session arrived on, if one is given. While that listener
+    is draining, new sessions get a 421 instead of the greeting.
+    """
+    
+    def __init__(self, handler, *, spool_threshold=DEFAULT_SPOOL_THRESHOLD,
+                 spool_dir=None, admission=None, listener=None, **kwargs):
+        super().__init__(handler, **kwargs)
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.admission = admission
+        self.listener = listener
+        self._admitted = None
+    
+    async def _handle_client(self):
+        if self.listener is not None and self.listener.draining:
+            await self._refuse(f'421 4.3.2 {self.hostname} Service shutting down, '
+                               'try again later')
+            return
+        if self.admission is not None:
+            peer = self._peer_address()
+            reason = self.admission.open_session(peer)
+            if reason is not None:
+                await self._refuse(f'421 4.7.0 {self.hostname} {reason}, try again later')
+                return
+            self._admitted = peer
+        SESSIONS.inc()
+        if self.listener is not None:
+            self.listener.sessions += 1
+            self.listener.active += 1
+        start = time.perf_counter()
+        try:
+            await super()._handle_client()
+        finally:
+            SESSION_SECONDS.observe(time.perf_counter() - start)
+            if self.listener is not None:
+                self.listener.active -= 1
+    
+    async def _refuse(self, status):
+        SESSIONS_REFUSED.inc()
+        if self.listener is not None:
+            self.listener.refused += 1
+        await self.push(status)
+        if self.transport is not None:
+            self.transport.close()
+    
+    def connection_lost(self, error):
+        if self._admitted is not None:
+            self.admission.close_session(self._admitted)
+            self._admitted = None
+        super().connection_lost(error)
+    
+    async def smtp_MAIL(self, arg):
+        if self.admission is not None and self.envelope.mail_from is None \
+                and not self.admission.allow_message(self._peer_address()):
+            MESSAGES_REJECTED.inc()
+            await self.push('451 4.7.1 Message rate limit exceeded, try again later')
+            return
+        await super().smtp_MAIL(arg)
+    
+    async def smtp_DATA(self, arg):
+        if self._decode_data:
+            # Decoded str content has to live in memory anyway
+            return await super().smtp_DATA(arg)
+        if await self.check_helo_needed():
+            return
+        if await self.check_auth_needed("DATA"):
+            return
+        if not self.envelope.rcpt_tos:
+            await self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            await self.push('501 Syntax: DATA')
+            return
+        overloaded = getattr(self.event_handler, 'overloaded', None)
+        if overloaded is not None and overloaded(self.envelope):
+            MESSAGES_REJECTED.inc()
+            await self.push('451 4.3.2 Server busy, try again later')
+            return
+        
+        await self.push('354 End data with <CR><LF>.<CR><LF>')
+        spool = MessageSpool(self.spool_threshold, self.spool_dir)
+        try:
+            start = time.perf_counter()
+            state = await self._receive_data(spool)
+            DATA_RECEIVE_SECONDS.observe(time.perf_counter() - start)
+            if state == _DataState.TOO_LONG:
+                MESSAGES_REJECTED.inc()
+                await self.push("500 Line too long (see RFC5321 4.5.3.1.6)")
+                self._set_post_data_state()
+                return
+            if state == _DataState.TOO_MUCH:
+                MESSAGES_REJECTED.inc()
+                await self.push('552 Error: Too much mail data')
+                self._set_post_data_state()
+                return
+            BYTES_RECEIVED.inc(spool.size)
+            
+            if spool.in_memory:
+                self.envelope.content = self.envelope.original_content = spool.getvalue()
+            else:
+                self.envelope.content = self.envelope.original_content = None
+            self.envelope.spool = spool
+            
+            status = MISSING
+            if "DATA" in self._handle_hooks:
+                status = await self._call_handler_hook('DATA')
+            self._set_post_data_state()
+            if status is MISSING:
+                status = '250 OK'
+            if self.listener is not None and status.startswith('250'):
+                self.listener.messages += 1
+            await self.push(status)
+        finally:
+            spool.close()
+    
+    async def _receive_data(self, spool):
+        """Copy dot-unstuffed DATA lines into the spool"""
+        num_bytes = 0
+        limit = self.data_size_limit
+        fragments = []
+        state = _DataState.NOMINAL
+        while self.transport is not None:
+            try:
+                line = await self._reader.readuntil(b'\r\n')
+            except asyncio.CancelledError:
+                # The connection got reset during the DATA command
+                self._writer.close()
+                raise
+            except asyncio.LimitOverrunError as e:
+                # Drain the oversized line; the error is reported at the end
+                if state == _DataState.NOMINAL:
+                    state = _DataState.TOO_LONG
+                line = await self._reader.read(e.consumed)
+            if not fragments and line == b'.\r\n':
+                break
+            num_bytes += len(line)
+            if state == _DataState.NOMINAL and limit and num_bytes > limit:
+                state = _DataState.TOO_MUCH
+            fragments.append(line)
+            if line.endswith(b'\r\n'):
+                if state == _DataState.NOMINAL:
+                    line = b''.join(fragments)
+                    if len(line) > self.line_length_limit:
+                        state = _DataState.TOO_LONG
+                    else:
+                        spool.write(line[1:] if line.startswith(b'.') else line)
+                fragments = []
+        return state
+    
+    def _peer_address(self):
+        peer = self.session.peer
+        return peer[0] if isinstance(peer, tuple) else peer
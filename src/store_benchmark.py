@@ -0,0 +1,241 @@
+"""Mail store memory and open latency benchmark
+
+Loads the same synthetic inbox in several storage modes and reports, as
+JSON, the disk space used, resident memory once the inbox is loaded and
+after browsing it, and the latency of opening a message body the way the
+Inbox tab does:
+
+    python -m src.store_benchmark --messages 50000 --opens 2000
+
+Modes:
+    strings    every body decoded into a Python string up front, like
+               the original in-memory received_emails list
+    none       mail store without compression
+    zlib       mail store with zlib frames
+    zlib-dict  zlib frames with a dictionary trained on the inbox
+
+The inbox is generated once into a corpus file that each mode streams
+from, and each mode runs in its own process, so memory figures do not
+include the generator or each other.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from src.benchmark import peak_rss, summarize
+from src.parsing import parse_body, parse_headers
+
+
+MODES = ('strings', 'none', 'zlib', 'zlib-dict')
+
+SENDERS = 200
+LISTS = ('announce', 'builds', 'support', 'billing', 'security', 'newsletter')
+CORPUS_RECORD = struct.Struct('<I')
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        rss = peak_rss()
+        return rss and rss['self']
+
+
+def write_corpus(path, count, size, seed):
+    """Generate ``count`` plausible raw messages with repeated boilerplate
+
+    Messages are written to ``path`` as length-prefixed records; returns
+    their total size.
+    """
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                          for _ in range(rng.randint(2, 10))) for _ in range(3000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    footers = {name: (f"--\r\nYou are receiving this because you subscribed to {name}.\r\n"
+                      f"Unsubscribe: https://lists.example.test/{name}/unsubscribe\r\n")
+               for name in LISTS}
+    total = 0
+    with open(path, 'wb') as f:
+        for i in range(count):
+            sender = f"user{rng.randrange(SENDERS)}@example{rng.randrange(20)}.test"
+            mailing_list = rng.choice(LISTS)
+            length = rng.randint(size // 2, size * 3 // 2)
+            words = rng.choices(vocabulary, weights, k=max(1, length // 6))
+            lines = [' '.join(words[n:n + 12]) for n in range(0, len(words), 12)]
+            headers = [
+                f"Received: from mx{rng.randrange(8)}.example.test "
+                f"(mx.example.test [192.0.2.{rng.randrange(256)}])",
+                f"\tby inbox.example.test with ESMTP id {rng.getrandbits(48):012x}",
+                f"From: {sender}",
+                f"To: {mailing_list}@lists.example.test",
+                f"Subject: [{mailing_list}] {' '.join(rng.choices(vocabulary, weights, k=6))}",
+                f"Date: {datetime.fromtimestamp(1.7e9 + i * 60, timezone.utc):%a, %d %b %Y %H:%M:%S} +0000",
+                f"Message-ID: <{rng.getrandbits(64):016x}@example.test>",
+                f"List-Id: <{mailing_list}.lists.example.test>",
+                "MIME-Version: 1.0",
+                "Content-Type: text/plain; charset=\"utf-8\"",
+                "Content-Transfer-Encoding: 7bit",
+            ]
+            raw = ('\r\n'.join(headers) + '\r\n\r\n' + '\r\n'.join(lines) + '\r\n'
+                   + footers[mailing_list]).encode('utf-8')
+            f.write(CORPUS_RECORD.pack(len(raw)) + raw)
+            total += len(raw)
+    return total
+
+
+def read_corpus(path):
+    """Yield the messages written by write_corpus()"""
+    with open(path, 'rb') as f:
+        while True:
+            prefix = f.read(CORPUS_RECORD.size)
+            if not prefix:
+                return
+            yield f.read(CORPUS_RECORD.unpack(prefix)[0])
+
+
+def run_mode(mode, args, corpus, results):
+    """Measure one mode; runs in a child process and puts its report on ``results``"""
+    try:
+        results.put((mode, measure(mode, args, corpus)))
+    except Exception as e:
+        results.put((mode, {'error': f"{type(e).__name__}: {e}"}))
+
+
+def measure(mode, args, corpus):
+    rng = random.Random(args.seed)
+    store_dir = tempfile.mkdtemp(prefix='store-bench-')
+    rss_start = current_rss()
+    try:
+        start = time.perf_counter()
+        if mode == 'strings':
+            inbox = []
+            for msg_id, raw in enumerate(read_corpus(corpus), 1):
+                headers = parse_headers(raw)
+                inbox.append({
+                    'id': msg_id,
+                    'from': headers.get('From', ''),
+                    'to': headers.get('To', ''),
+                    'subject': headers.get('Subject', ''),
+                    'body': parse_body([raw]),
+                })
+            load_seconds = time.perf_counter() - start
+            disk_bytes = 0
+            open_body = lambda idx: inbox[idx]['body']
+        else:
+            # Imported here so the strings mode pays nothing for the store
+            from src.mail_store import MailStore
+            codec = None if mode == 'none' else 'zlib'
+            store = MailStore(store_dir, codec=codec)
+            for n, raw in enumerate(read_corpus(corpus)):
+                if mode == 'zlib-dict' and n == args.messages // 10:
+                    # Learn from the first tenth, as auto_dictionary would
+                    store.train_dictionary()
+                headers = parse_headers(raw)
+                store.append(raw, {'from': headers.get('From', ''),
+                                   'to': [headers.get('To', '')],
+                                   'subject': headers.get('Subject', '')})
+            store.close()
+            load_seconds = time.perf_counter() - start
+            disk_bytes = sum(os.path.getsize(os.path.join(store_dir, name))
+                             for name in os.listdir(store_dir)
+                             if os.path.isfile(os.path.join(store_dir, name)))
+            # Reopen as the application does at startup
+            store = inbox = MailStore(store_dir, codec=codec)
+            open_body = lambda idx: store[idx].body
+        
+        rss_loaded = current_rss()
+        
+        # Cold opens: distinct messages, far more than the body cache holds
+        picks = rng.sample(range(len(inbox)), min(args.opens, len(inbox)))
+        cold = []
+        for idx in picks:
+            start = time.perf_counter()
+            open_body(idx)
+            cold.append(time.perf_counter() - start)
+        # Warm opens: a handful of recently viewed messages again
+        warm = []
+        for idx in picks[-10:] * 10:
+            start = time.perf_counter()
+            open_body(idx)
+            warm.append(time.perf_counter() - start)
+        
+        report = {
+            'disk_bytes': disk_bytes,
+            'load_seconds': load_seconds,
+            'rss_start': rss_start,
+            'rss_loaded': rss_loaded,
+            'rss_after_opens': current_rss(),
+            'peak_rss': (peak_rss() or {}).get('self'),
+            'open_cold': summarize(sorted(cold)),
+            'open_warm': summarize(sorted(warm)),
+        }
+        if mode != 'strings':
+            store.close()
+        return report
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    """Parse command line flags"""
+    parser = argparse.ArgumentParser(prog='python -m src.store_benchmark',
+                                     description='Compare mail store memory and open latency')
+    parser.add_argument('-n', '--messages', type=int, default=20000,
+                        help='messages in the inbox (default: 20000)')
+    parser.add_argument('--size', type=int, default=2048,
+                        help='average body size in bytes (default: 2048)')
+    parser.add_argument('--opens', type=int, default=1000,
+                        help='distinct messages to open (default: 1000)')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f'comma separated modes to run (default: {",".join(MODES)})')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic inbox')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Command line entry point"""
+    args = parse_args(argv)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        print(f"Error: unknown mode: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    fd, corpus = tempfile.mkstemp(prefix='store-bench-', suffix='.corpus')
+    os.close(fd)
+    try:
+        raw_bytes = write_corpus(corpus, args.messages, args.size, args.seed)
+        report = {'messages': args.messages, 'raw_bytes': raw_bytes, 'modes': {}}
+        for mode in modes:
+            process = context.Process(target=run_mode, args=(mode, args, corpus, results))
+            process.start()
+            mode_name, result = results.get()
+            process.join()
+            report['modes'][mode_name] = result
+    finally:
+        os.remove(corpus)
+    
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
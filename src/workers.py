@@ -0,0 +1,446 @@
+"""Multi-process SMTP receive workers
+
+Each worker process binds the same host/port with SO_REUSEPORT and runs its
+own event loop and EmailHandler, so the kernel spreads connections across
+cores. Workers parse messages and cut their attachments out into blob
+files locally, then forward the result to the parent over a
+multiprocessing queue; the parent is the only writer to the mail store.
+A worker replies to the client only once the parent has stored the
+message and answered on the worker's reply queue. A supervisor thread
+restarts workers that die, backing off when they die before they start.
+
+Workers stop at once on SIGTERM. On SIGUSR1 they drain instead: new
+connections get 421 and the worker exits once its open sessions are done.
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+
+from src.admission import AdmissionControl
+from src.attachments import discard_blobs, extract_attachments
+from src.email_handler import DeliveryDeferred, EmailHandler
+from src.listeners import DRAIN_POLL, Listener
+from src.metrics import ATTACHMENT_SECONDS, REGISTRY
+from src.offload import OffloadStage
+from src.sink import MessageSink
+from src.spooling import DEFAULT_SPOOL_THRESHOLD, MessageSpool, SpoolingSMTP
+
+
+START_TIMEOUT = 10.0
+SUPERVISE_INTERVAL = 1.0
+METRICS_INTERVAL = 2.0
+# How long the parent has to take on a forwarded message before the worker
+# refuses it with 451; the parent drops messages it gets to later
+STORE_TIMEOUT = 60.0
+# Allowance for the reply to travel back through the reply queue
+STORE_GRACE = 5.0
+# Delay before restarting a worker that exited before it started
+# listening, doubled after each such exit in a row up to MAX_RESTART_BACKOFF
+RESTART_BACKOFF = 1.0
+MAX_RESTART_BACKOFF = 30.0
+# Consecutive start failures after which a worker slot is given up
+MAX_START_FAILURES = 5
+# Not available on Windows, where SO_REUSEPORT workers are not either
+DRAIN_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+
+class QueueSink(MessageSink):
+    """Sink used inside a worker; forwards log lines to the parent"""
+    
+    def __init__(self, channel):
+        self.channel = channel
+    
+    def log(self, message, level=logging.INFO):
+        self.channel.put(('log', os.getpid(), message, level))
+
+
+class StoreFailed(Exception):
+    """The parent could not store a forwarded message"""
+
+
+class ReplyWaiter:
+    """Matches the parent's replies to the messages a worker forwarded
+
+    The parent answers each message twice: 'taken' when it starts storing
+    it, then 'stored' with the error or None. A message it got to after
+    the deadline is answered 'expired' instead.
+    """
+    
+    def __init__(self, replies, slot, loop):
+        self.replies = replies
+        # Index of this worker in the parent's pool
+        self.slot = slot
+        self.loop = loop
+        self._pending = {}
+        self._ids = itertools.count()
+        self._pid = os.getpid()
+        threading.Thread(target=self._listen, name='reply-listener', daemon=True).start()
+    
+    def expect(self):
+        """Return a new request id and the futures its replies resolve
+
+        The first is set to whether the parent took the message on, the
+        second to the (kind, error) of the final reply.
+        """
+        request_id = (self._pid, next(self._ids))
+        taken = self.loop.create_future()
+        outcome = self.loop.create_future()
+        self._pending[request_id] = taken, outcome
+        return request_id, taken, outcome
+    
+    def forget(self, request_id):
+        self._pending.pop(request_id, None)
+    
+    def _listen(self):
+        while True:
+            item = self.replies.get()
+            if item is None:
+                return
+            try:
+                self.loop.call_soon_threadsafe(self._resolve, *item)
+            except RuntimeError:
+                # The event loop is closed; the worker is exiting
+                return
+    
+    def _resolve(self, request_id, kind, error):
+        futures = self._pending.get(request_id)
+        if futures is None:
+            return
+        taken, outcome = futures
+        if not taken.done():
+            taken.set_result(kind != 'expired')
+        if kind != 'taken':
+            del self._pending[request_id]
+            if not outcome.done():
+                outcome.set_result((kind, error))
+
+
+class ForwardingHandler(EmailHandler):
+    """EmailHandler that has the parent process store the messages"""
+    
+    def __init__(self, channel, replies, offload=None, blob_dir=None):
+        super().__init__(None, QueueSink(channel), offload, blob_dir)
+        self.channel = channel
+        self.replies = replies
+    
+    async def save(self, raw, meta, timestamp, extracted=None):
+        if extracted is None:
+            start = time.perf_counter()
+            spool_dir = raw.directory if isinstance(raw, MessageSpool) else None
+            extracted = extract_attachments(raw, self.blob_dir, spool_dir)
+            ATTACHMENT_SECONDS.observe(time.perf_counter() - start)
+        message, attachments, blobs = extracted
+        if message is None:
+            # Pass large messages by file path; the parent deletes the file
+            message = raw.detach() if isinstance(raw, MessageSpool) else raw
+        request_id, taken, outcome = self.replies.expect()
+        # time.monotonic() is system-wide on the platforms with SO_REUSEPORT,
+        # so the parent can compare the deadline with its own clock
+        deadline = time.monotonic() + STORE_TIMEOUT
+        try:
+            self.channel.put(('message', self.replies.slot, request_id, deadline, message,
+                              meta, timestamp, attachments, blobs))
+            # Once the parent has taken the message on it gets stored whatever
+            # happens here, so refusing it then would have the client send
+            # it twice; wait for the outcome however long the store takes
+            await asyncio.wait_for(taken, STORE_TIMEOUT + STORE_GRACE)
+            kind, error = await outcome
+        except asyncio.TimeoutError:
+            kind = 'expired'
+        finally:
+            self.replies.forget(request_id)
+        if kind == 'expired':
+            raise DeliveryDeferred("The mail store did not confirm the message in time")
+        if error is not None:
+            raise StoreFailed(error)
+
+
+def bind_reuseport(host, port, backlog=128):
+    """Create a listening socket that other processes can bind too"""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError("SO_REUSEPORT is not supported on this platform")
+    family, type_, proto, _, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    return sock
+
+
+def _worker_main(host, port, channel, replies, slot, spool_threshold, spool_dir, limits,
+                 offload, blob_dir):
+    """Entry point of a worker process"""
+    # Ctrl+C goes to the whole process group; only the parent reacts to it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        sock = bind_reuseport(host, port)
+    except OSError as e:
+        channel.put(('failed', os.getpid(), str(e)))
+        return
+    
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stage = None
+    if offload is not None:
+        stage = OffloadStage(**offload)
+        note = stage.start()
+        if note:
+            channel.put(('log', os.getpid(), note, logging.WARNING))
+    handler = ForwardingHandler(channel, ReplyWaiter(replies, slot, loop), stage, blob_dir)
+    admission = AdmissionControl(**limits) if limits else None
+    # Resolve once per worker instead of once per connection
+    hostname = socket.getfqdn()
+    listener = Listener(host, port)
+    server = loop.run_until_complete(loop.create_server(
+        lambda: SpoolingSMTP(handler, hostname=hostname, enable_SMTPUTF8=True,
+                             spool_threshold=spool_threshold, spool_dir=spool_dir,
+                             admission=admission, listener=listener),
+        sock=sock))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    
+    def stop_when_idle():
+        if listener.active:
+            loop.call_later(DRAIN_POLL, stop_when_idle)
+        else:
+            loop.stop()
+    
+    def drain():
+        listener.draining = True
+        stop_when_idle()
+    
+    if DRAIN_SIGNAL is not None:
+        loop.add_signal_handler(DRAIN_SIGNAL, drain)
+    
+    def report_metrics():
+        channel.put(('metrics', os.getpid(), REGISTRY.state()))
+        loop.call_later(METRICS_INTERVAL, report_metrics)
+    
+    channel.put(('started', os.getpid(), None))
+    loop.call_later(METRICS_INTERVAL, report_metrics)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        if stage is not None:
+            stage.stop()
+        channel.put(('metrics', os.getpid(), REGISTRY.state()))
+
+
+class WorkerPool:
+    """Supervises a set of SO_REUSEPORT receive worker processes"""
+    
+    def __init__(self, store, sink, host, port, workers,
+                 spool_threshold=DEFAULT_SPOOL_THRESHOLD, spool_dir=None, limits=None,
+                 offload=None):
+        self.store = store
+        self.sink = sink
+        self.host = host
+        self.port = port
+        self.size = workers
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.limits = limits or {}
+        self.offload = offload
+        # spawn rather than fork: the parent may be running Tk and the
+        # mail store flusher thread, neither of which survive a fork
+        self._context = multiprocessing.get_context('spawn')
+        self._channel = None
+        # One queue per worker slot for the answers to forwarded messages
+        self._replies = []
+        self._handler = EmailHandler(store, sink)
+        self._processes = []
+        self._stopping = threading.Event()
+        self._threads = []
+        self._started = None
+        # Pids of the workers that got as far as listening
+        self._up = set()
+    
+    def start(self):
+        """Start all workers; raise OSError if any fails to bind"""
+        self._channel = self._context.Queue()
+        self._replies = [self._context.Queue() for _ in range(self.size)]
+        self._stopping.clear()
+        self._started = queue.Queue()
+        self._up = set()
+        
+        self._threads = [
+            threading.Thread(target=self._collect, name='worker-collector', daemon=True),
+        ]
+        self._threads[0].start()
+        
+        try:
+            for slot in range(self.size):
+                self._processes.append(self._spawn(slot))
+            
+            for _ in range(self.size):
+                try:
+                    ok, error = self._started.get(timeout=START_TIMEOUT)
+                except queue.Empty:
+                    ok, error = False, "Timed out waiting for workers to start"
+                if not ok:
+                    raise OSError(error)
+        except BaseException:
+            # Do not leave the workers that did start running
+            self.stop()
+            raise
+        
+        supervisor = threading.Thread(target=self._supervise, name='worker-supervisor',
+                                      daemon=True)
+        supervisor.start()
+        self._threads.append(supervisor)
+    
+    def stop(self, drain_timeout=0):
+        """Terminate all workers and drain what they already forwarded
+
+        With a ``drain_timeout`` workers first stop taking new sessions and
+        get that many seconds to finish the open ones.
+        """
+        self._stopping.set()
+        if drain_timeout and DRAIN_SIGNAL is not None:
+            for process in self._processes:
+                if process.is_alive():
+                    os.kill(process.pid, DRAIN_SIGNAL)
+            deadline = time.monotonic() + drain_timeout
+            for process in self._processes:
+                process.join(timeout=max(0, deadline - time.monotonic()))
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self._processes = []
+        
+        if self._channel is not None:
+            self._channel.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=5)
+        self._threads = []
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+        for replies in self._replies:
+            # Nobody may be left to read them
+            replies.cancel_join_thread()
+            replies.close()
+        self._replies = []
+    
+    def alive(self):
+        """Number of worker processes currently running"""
+        return sum(1 for process in self._processes if process.is_alive())
+    
+    def _spawn(self, slot):
+        process = self._context.Process(target=_worker_main, name='smtp-worker',
+                                        args=(self.host, self.port, self._channel,
+                                              self._replies[slot], slot,
+                                              self.spool_threshold, self.spool_dir,
+                                              self.limits, self.offload,
+                                              self.store.attachments.path),
+                                        daemon=True)
+        process.start()
+        return process
+    
+    def _collect(self):
+        """Apply messages forwarded by the workers, in arrival order"""
+        while True:
+            item = self._channel.get()
+            if item is None:
+                return
+            kind = item[0]
+            try:
+                if kind == 'message':
+                    self._commit(*item[1:])
+                elif kind == 'log':
+                    self.sink.log(f"[worker {item[1]}] {item[2]}", item[3])
+                elif kind == 'metrics':
+                    REGISTRY.absorb(item[1], item[2])
+                elif kind == 'started':
+                    self._up.add(item[1])
+                    self._started.put((True, None))
+                elif kind == 'failed':
+                    self._started.put((False, item[2]))
+                    self.sink.log(f"Worker {item[1]} failed to start: {item[2]}",
+                                  logging.ERROR)
+            except Exception as e:
+                self.sink.log(f"Error processing email: {str(e)}", logging.ERROR)
+    
+    def _commit(self, slot, request_id, deadline, raw, meta, timestamp, attachments, blobs):
+        """Store a forwarded message and tell its worker how that went"""
+        replies = self._replies[slot]
+        if time.monotonic() >= deadline:
+            # The worker refuses it with 451 and the client sends it again
+            discard_blobs(blobs)
+            if isinstance(raw, str):
+                os.remove(raw)
+            replies.put((request_id, 'expired', None))
+            self.sink.log(f"Dropped a message from {meta['from']} forwarded too long ago",
+                          logging.WARNING)
+            return
+        replies.put((request_id, 'taken', None))
+        error = None
+        try:
+            self._handler.commit(raw, meta, timestamp, attachments, blobs)
+        except Exception as e:
+            # The worker logs it when it refuses the message
+            error = str(e)
+        replies.put((request_id, 'stored', error))
+    
+    def _supervise(self):
+        """Restart workers that exited unexpectedly
+
+        A worker that exits before it started listening, say because the
+        port cannot be bound, is restarted after a growing delay, and its
+        slot is given up after MAX_START_FAILURES such exits in a row.
+        """
+        failures = [0] * len(self._processes)
+        restart_at = {}
+        given_up = set()
+        while not self._stopping.wait(SUPERVISE_INTERVAL):
+            for i, process in enumerate(self._processes):
+                if process.is_alive() or i in given_up or self._stopping.is_set():
+                    continue
+                if i not in restart_at:
+                    process.join()
+                    if process.pid in self._up:
+                        self._up.discard(process.pid)
+                        failures[i] = 0
+                        delay = 0
+                        self.sink.log(f"Worker {process.pid} exited with code "
+                                      f"{process.exitcode}, restarting", logging.WARNING)
+                    else:
+                        failures[i] += 1
+                        if failures[i] >= MAX_START_FAILURES:
+                            given_up.add(i)
+                            self.sink.log(f"Worker {process.pid} failed to start "
+                                          f"{failures[i]} times in a row, not restarting it",
+                                          logging.ERROR)
+                            continue
+                        delay = min(RESTART_BACKOFF * 2 ** (failures[i] - 1),
+                                    MAX_RESTART_BACKOFF)
+                        self.sink.log(f"Worker {process.pid} exited with code "
+                                      f"{process.exitcode} before it started, restarting "
+                                      f"in {delay:g}s", logging.WARNING)
+                    restart_at[i] = time.monotonic() + delay
+                if time.monotonic() >= restart_at[i]:
+                    del restart_at[i]
+                    self._processes[i] = self._spawn(i)
@@ -0,0 +1,119 @@
+"""Shared fixtures: a local aiosmtpd server and SMTP clients to drive it"""
+
+import asyncio
+import smtplib
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from src.async_smtp import AsyncSMTP
+from src.benchmark import free_port
+from src.mime_writer import sendmail
+
+
+class RecordingHandler:
+    """Accepts mail and records it; refuses addresses by their local part
+
+    ``refuse@`` senders get 550, ``bad@`` recipients 550 and ``shut@``
+    recipients 421. PIPELINING is offered while ``pipelining`` is set.
+    """
+    
+    def __init__(self):
+        self.pipelining = True
+        self.received = []
+        self.commands = []
+    
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        if self.pipelining:
+            responses.insert(-1, '250-PIPELINING')
+        return responses
+    
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        self.commands.append('MAIL')
+        if address.startswith('refuse'):
+            return '550 Sender refused'
+        envelope.mail_from = address
+        return '250 OK'
+    
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        self.commands.append('RCPT')
+        if address.startswith('bad'):
+            return '550 No such user'
+        if address.startswith('shut'):
+            return '421 Closing connection'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.received.append((envelope.mail_from, list(envelope.rcpt_tos), envelope.content))
+        return '250 OK'
+
+
+class CountingSMTP(smtplib.SMTP):
+    """smtplib.SMTP that counts its writes, one per command batch"""
+    
+    writes = 0
+    
+    def send(self, s):
+        self.writes += 1
+        return super().send(s)
+
+
+@pytest.fixture
+def smtp_server():
+    """The RecordingHandler of a running server and the server's port"""
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    try:
+        yield handler, controller.port
+    finally:
+        controller.stop()
+
+
+@pytest.fixture(params=['sync', 'async'])
+def client(request, smtp_server):
+    """send(from_addr, to_addrs, msg) over mime_writer.sendmail() or AsyncSMTP
+
+    Returns sendmail()'s refused dict and the reply to a NOOP sent after
+    the transaction, or the exception type if the session is gone.
+    """
+    _, port = smtp_server
+    
+    def send_sync(from_addr, to_addrs, msg):
+        smtp = CountingSMTP('127.0.0.1', port)
+        try:
+            try:
+                return sendmail(smtp, from_addr, to_addrs, msg)
+            finally:
+                send.writes = smtp.writes
+                try:
+                    send.after = smtp.noop()[0]
+                except (smtplib.SMTPException, OSError) as e:
+                    send.after = type(e)
+        finally:
+            smtp.close()
+    
+    async def send_async(from_addr, to_addrs, msg):
+        smtp = AsyncSMTP(local_hostname='localhost')
+        await smtp.connect('127.0.0.1', port)
+        try:
+            try:
+                return await smtp.sendmail(from_addr, to_addrs, msg)
+            finally:
+                try:
+                    send.after = (await smtp.noop())[0]
+                except (smtplib.SMTPException, OSError) as e:
+                    send.after = type(e)
+        finally:
+            smtp.close()
+    
+    def send(from_addr, to_addrs, msg):
+        if request.param == 'sync':
+            return send_sync(from_addr, to_addrs, msg)
+        return asyncio.run(send_async(from_addr, to_addrs, msg))
+    
+    send.kind = request.param
+    return send
+
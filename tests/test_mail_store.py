@@ -0,0 +1,171 @@
+import os
+import threading
+
+import pytest
+
+from src.mail_store import INDEX_FILE, MailStore, StoreLocked
+
+
+def message(i):
+    return b'Subject: Message %d\r\n\r\n' % i + b'body %d\r\n' % i * 50
+
+
+def meta(i):
+    return {'from': f'sender{i}@example.test', 'to': ['rcpt@example.test'],
+            'subject': f'Message {i}'}
+
+
+def fill(store, count):
+    return [store.append(message(i), meta(i), timestamp=1000.0 + i) for i in range(count)]
+
+
+def segments(path):
+    return sorted(name for name in os.listdir(path) if name.startswith('seg-'))
+
+
+def test_append_and_read(tmp_path):
+    store = MailStore(str(tmp_path))
+    try:
+        ids = fill(store, 3)
+        assert len(store) == 3
+        record = store.get(ids[1])
+        assert record.sender == 'sender1@example.test'
+        assert record.subject == 'Message 1'
+        assert bytes(store.get_raw(ids[2])) == message(2)
+        assert b''.join(store.iter_raw(ids[0], chunk_size=7)) == message(0)
+    finally:
+        store.close()
+
+
+def test_reopen_keeps_messages_and_deletions(tmp_path):
+    store = MailStore(str(tmp_path))
+    ids = fill(store, 5)
+    store.delete(ids[2])
+    store.close()
+    
+    store = MailStore(str(tmp_path))
+    try:
+        assert [record.id for record in store] == ids[:2] + ids[3:]
+        assert store.get(ids[2]) is None
+        # Ids are never reused
+        assert store.append(message(9), meta(9)) > ids[-1]
+    finally:
+        store.close()
+
+
+def test_recovery_truncates_a_torn_write(tmp_path):
+    store = MailStore(str(tmp_path), codec=None)
+    ids = fill(store, 3)
+    store.close()
+    segment = tmp_path / segments(tmp_path)[-1]
+    good_size = segment.stat().st_size
+    with open(segment, 'ab') as f:
+        # Half a record header, as left by a crash mid-append
+        f.write(b'EMR1\x04\x00\x00')
+    
+    store = MailStore(str(tmp_path), codec=None)
+    try:
+        assert [record.id for record in store] == ids
+        assert segment.stat().st_size == good_size
+        new_id = store.append(message(3), meta(3))
+        assert bytes(store.get_raw(new_id)) == message(3)
+    finally:
+        store.close()
+
+
+def test_recovery_rebuilds_a_lost_index(tmp_path):
+    store = MailStore(str(tmp_path))
+    ids = fill(store, 4)
+    store.close()
+    os.remove(tmp_path / INDEX_FILE)
+    
+    store = MailStore(str(tmp_path))
+    try:
+        assert [record.id for record in store] == ids
+        assert bytes(store.get_raw(ids[3])) == message(3)
+    finally:
+        store.close()
+
+
+def test_compact_rewrites_mostly_deleted_segments(tmp_path):
+    store = MailStore(str(tmp_path), segment_size=4096, codec=None)
+    try:
+        ids = fill(store, 30)
+        assert len(segments(tmp_path)) > 2
+        before = sum(os.path.getsize(tmp_path / name) for name in segments(tmp_path))
+        kept = ids[::5]
+        for msg_id in ids:
+            if msg_id not in kept:
+                store.delete(msg_id)
+        
+        assert store.compact() > 0
+        after = sum(os.path.getsize(tmp_path / name) for name in segments(tmp_path))
+        assert after < before
+        assert [record.id for record in store] == kept
+        for msg_id in kept:
+            assert bytes(store.get_raw(msg_id)) == message(ids.index(msg_id))
+    finally:
+        store.close()
+    
+    store = MailStore(str(tmp_path), segment_size=4096, codec=None)
+    try:
+        assert [record.id for record in store] == kept
+        assert bytes(store.get_raw(kept[-1])) == message(ids.index(kept[-1]))
+    finally:
+        store.close()
+
+
+def test_compressed_messages_read_back(tmp_path):
+    store = MailStore(str(tmp_path), codec='zlib')
+    try:
+        msg_id = store.append(message(1) * 20, meta(1))
+        assert bytes(store.get_raw(msg_id)) == message(1) * 20
+        assert b''.join(store.iter_raw(msg_id, chunk_size=100)) == message(1) * 20
+    finally:
+        store.close()
+
+
+def test_second_open_is_refused(tmp_path):
+    store = MailStore(str(tmp_path))
+    try:
+        with pytest.raises(StoreLocked):
+            MailStore(str(tmp_path))
+    finally:
+        store.close()
+    MailStore(str(tmp_path)).close()
+
+
+def test_compact_lets_appends_and_deletes_through(tmp_path, monkeypatch):
+    store = MailStore(str(tmp_path), segment_size=4096, codec=None)
+    try:
+        ids = fill(store, 30)
+        for msg_id in ids[1:20]:
+            store.delete(msg_id)
+        added = []
+        write_compacted = store._write_compacted
+        
+        def copy_with_traffic(segment_no, moves):
+            # Runs in another thread so it would block if compact() held the lock
+            def traffic():
+                added.append(store.append(message(99), meta(99)))
+                store.delete(ids[0])
+            worker = threading.Thread(target=traffic)
+            worker.start()
+            worker.join(5)
+            assert not worker.is_alive(), "compact() blocked an append"
+            write_compacted(segment_no, moves)
+        
+        monkeypatch.setattr(store, '_write_compacted', copy_with_traffic)
+        assert store.compact() > 0
+        assert [record.id for record in store] == ids[20:] + added
+        assert store.get(ids[0]) is None
+        assert bytes(store.get_raw(added[0])) == message(99)
+    finally:
+        store.close()
+    
+    store = MailStore(str(tmp_path), segment_size=4096, codec=None)
+    try:
+        assert [record.id for record in store] == ids[20:] + added
+        assert bytes(store.get_raw(ids[20])) == message(20)
+    finally:
+        store.close()
@@ -0,0 +1,87 @@
+import email
+import os
+from io import BytesIO
+
+from src.mime_writer import CHUNK_SIZE, FlatMessage, StreamingMessage, data_blocks, flatten
+
+
+def stuffed(data):
+    return b''.join(data_blocks(BytesIO(data)))
+
+
+def make_message(attachment):
+    msg = StreamingMessage()
+    msg['From'] = 'me@example.test'
+    msg['To'] = 'you@example.test'
+    msg['Subject'] = 'Files'
+    msg.attach_text('See attached')
+    msg.attach_file(str(attachment))
+    return msg
+
+
+def test_attachments_are_streamed_from_disk(tmp_path):
+    attachment = tmp_path / 'data.bin'
+    attachment.write_bytes(os.urandom(3 * CHUNK_SIZE + 17))
+    with flatten(make_message(attachment)) as flat:
+        with flat.open() as f:
+            parsed = email.message_from_binary_file(f)
+    text, part = parsed.get_payload()
+    assert text.get_payload() == 'See attached'
+    assert part.get_filename() == 'data.bin'
+    assert part.get_payload(decode=True) == attachment.read_bytes()
+
+
+def test_small_messages_stay_in_memory(tmp_path):
+    attachment = tmp_path / 'note.txt'
+    attachment.write_bytes(b'hello')
+    flat = make_message(attachment).flatten()
+    assert flat.path is None
+    assert flat.size == len(flat.data)
+
+
+def test_large_messages_spool_to_a_file_deleted_on_close(tmp_path):
+    attachment = tmp_path / 'data.bin'
+    attachment.write_bytes(os.urandom(CHUNK_SIZE))
+    flat = make_message(attachment).flatten(threshold=1024, directory=str(tmp_path))
+    assert flat.data is None
+    assert os.path.getsize(flat.path) == flat.size
+    assert flat.headers().startswith(b'MIME-Version: 1.0\r\n')
+    path = flat.path
+    flat.close()
+    assert not os.path.exists(path)
+
+
+def test_readers_do_not_share_a_position(tmp_path):
+    path = tmp_path / 'message.eml'
+    path.write_bytes(b'Subject: x\r\n\r\nbody\r\n')
+    flat = FlatMessage(path=str(path))
+    with flat.open() as first, flat.open() as second:
+        first.read(5)
+        assert second.read() == path.read_bytes()
+    # Not owned, so not deleted
+    flat.close()
+    assert path.exists()
+
+
+def test_file_message_is_sent_intact(client, smtp_server, tmp_path):
+    handler, _ = smtp_server
+    body = b''.join(b'.line %d\r\n' % i for i in range(CHUNK_SIZE // 4))
+    path = tmp_path / 'message.eml'
+    path.write_bytes(b'Subject: Big\r\n\r\n' + body)
+    client('a@example.test', ['ok@example.test'], FlatMessage(path=str(path)))
+    assert handler.received[0][2] == path.read_bytes()
+
+
+def test_data_blocks_stuffs_dots_and_ends_message():
+    assert stuffed(b'a\r\n.b\r\n') == b'a\r\n..b\r\n.\r\n'
+    assert stuffed(b'.start') == b'..start\r\n.\r\n'
+    assert stuffed(b'') == b'.\r\n'
+
+
+def test_data_blocks_normalizes_line_endings():
+    assert stuffed(b'a\nb\r\n.c\n') == b'a\r\nb\r\n..c\r\n.\r\n'
+
+
+def test_data_blocks_dot_at_chunk_boundary():
+    data = b'x' * (CHUNK_SIZE - 2) + b'\r\n.y\r\n'
+    assert stuffed(data) == b'x' * (CHUNK_SIZE - 2) + b'\r\n..y\r\n.\r\n'
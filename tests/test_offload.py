@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import pytest
+
+from src.async_smtp import SendLoop
+from src.offload import OffloadBusy, OffloadStage
+
+
+@pytest.fixture
+def loops():
+    """Two event loops in their own threads, like the listener groups during a restart"""
+    started = [SendLoop(), SendLoop()]
+    for loop in started:
+        loop.start()
+    yield started
+    for loop in started:
+        loop.stop()
+
+
+def test_slots_are_shared_by_every_loop(loops):
+    stage = OffloadStage(max_pending=2, wait_timeout=5)
+    first, second = loops
+    first.submit(stage.acquire()).result(5)
+    second.submit(stage.acquire()).result(5)
+    assert stage.full()
+    
+    waiting = second.submit(stage.acquire())
+    with pytest.raises(TimeoutError):
+        waiting.result(0.2)
+    assert (stage.running, stage.waiting) == (2, 1)
+    
+    # A slot freed on one loop goes to the message waiting on the other
+    first.submit(_release(stage)).result(5)
+    waiting.result(5)
+    assert (stage.running, stage.waiting) == (2, 0)
+
+
+def test_waiting_times_out(loops):
+    stage = OffloadStage(max_pending=1, wait_timeout=0.1)
+    first, second = loops
+    first.submit(stage.acquire()).result(5)
+    with pytest.raises(OffloadBusy):
+        second.submit(stage.acquire()).result(5)
+    assert (stage.running, stage.waiting) == (1, 0)
+    stage.release()
+    assert stage.running == 0
+
+
+def test_a_cancelled_waiter_takes_no_slot(loops):
+    stage = OffloadStage(max_pending=1, wait_timeout=5)
+    first, second = loops
+    first.submit(stage.acquire()).result(5)
+    
+    async def process():
+        # As EmailHandler does: release only what was acquired
+        await stage.acquire()
+        try:
+            await asyncio.sleep(60)
+        finally:
+            stage.release()
+    
+    waiting = second.submit(process())
+    while not stage.waiting:
+        time.sleep(0.01)
+    # The session goes away while it waits
+    waiting.cancel()
+    while stage.waiting:
+        time.sleep(0.01)
+    stage.release()
+    first.submit(stage.acquire()).result(5)
+    assert (stage.running, stage.waiting) == (1, 0)
+
+
+async def _release(stage):
+    stage.release()
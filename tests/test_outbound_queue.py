@@ -0,0 +1,216 @@
+import asyncio
+import os
+import smtplib
+import time
+
+import pytest
+
+from src.async_smtp import SendLoop
+from src.outbound_queue import OutboundQueue
+
+
+ROUTE = {'mode': 'local', 'host': '127.0.0.1', 'port': 2525}
+RELAY = {'mode': 'external', 'host': 'smtp.example.test', 'port': 587,
+         'user': 'me@example.test'}
+MESSAGE = b'From: me@example.test\r\nSubject: Hello\r\n\r\nHi\r\n'
+
+
+def temporary(recipient):
+    return smtplib.SMTPRecipientsRefused({recipient: (451, b'Try again later')})
+
+
+def permanent(recipient):
+    return smtplib.SMTPRecipientsRefused({recipient: (550, b'No such user')})
+
+
+class FakeDelivery:
+    """Stands in for SMTPSender.deliver(), failing recipients as scripted
+
+    ``script`` maps a recipient to the errors of its successive attempts,
+    made by calling it with the recipient; None delivers.
+    """
+    
+    def __init__(self, script=None):
+        self.script = script or {}
+        self.attempts = []
+        self.delivered = []
+    
+    def __call__(self, route, sender, recipients, data, password):
+        self.attempts.append((list(recipients), password))
+        with data.open() as f:
+            assert f.read() == MESSAGE
+        errors = {}
+        for recipient in recipients:
+            outcomes = self.script.get(recipient, [])
+            make_error = outcomes.pop(0) if outcomes else None
+            if make_error is None:
+                self.delivered.append(recipient)
+            else:
+                errors[recipient] = make_error(recipient)
+        return errors
+
+
+class Bounces(list):
+    def __call__(self, raw, sender):
+        self.append((sender, raw))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+    
+    def make(deliver, **kwargs):
+        kwargs.setdefault('base_delay', 0)
+        queue = OutboundQueue(str(tmp_path), workers=2, deliver=deliver, **kwargs)
+        queues.append(queue)
+        return queue
+    
+    yield make
+    for queue in queues:
+        queue.stop()
+
+
+def test_delivers_and_removes_the_files(make_queue, tmp_path):
+    deliver = FakeDelivery()
+    queue = make_queue(deliver)
+    queue.start()
+    queue.enqueue('me@example.test', ['a@example.test'], MESSAGE, ROUTE)
+    wait_for(lambda: not len(queue))
+    assert deliver.delivered == ['a@example.test']
+    assert os.listdir(tmp_path) == []
+
+
+def test_temporary_failure_is_retried_for_failed_recipients_only(make_queue):
+    deliver = FakeDelivery({'b@example.test': [temporary, temporary]})
+    bounces = Bounces()
+    queue = make_queue(deliver, bounce=bounces)
+    queue.start()
+    queue.enqueue('me@example.test', ['a@example.test', 'b@example.test'], MESSAGE, ROUTE)
+    wait_for(lambda: not len(queue))
+    assert [recipients for recipients, _ in deliver.attempts] == [
+        ['a@example.test', 'b@example.test'], ['b@example.test'], ['b@example.test']]
+    assert sorted(deliver.delivered) == ['a@example.test', 'b@example.test']
+    assert bounces == []
+
+
+def test_permanent_failure_bounces_to_the_sender(make_queue):
+    deliver = FakeDelivery({'gone@example.test': [permanent]})
+    bounces = Bounces()
+    queue = make_queue(deliver, bounce=bounces)
+    queue.start()
+    queue.enqueue('me@example.test', ['gone@example.test'], MESSAGE, ROUTE)
+    wait_for(lambda: bounces and not len(queue))
+    assert len(deliver.attempts) == 1
+    sender, raw = bounces[0]
+    assert sender == 'me@example.test'
+    assert b'<gone@example.test>: 550 No such user' in raw
+    assert b'Subject of the original message: Hello' in raw
+
+
+def test_gives_up_after_max_attempts(make_queue):
+    deliver = FakeDelivery({'slow@example.test': [temporary] * 10})
+    bounces = Bounces()
+    queue = make_queue(deliver, bounce=bounces, max_attempts=3)
+    queue.start()
+    queue.enqueue('me@example.test', ['slow@example.test'], MESSAGE, ROUTE)
+    wait_for(lambda: bounces and not len(queue))
+    assert len(deliver.attempts) == 3
+    assert b'Gave up after 3 attempts: 451 Try again later' in bounces[0][1]
+
+
+def test_bounces_are_not_bounced(make_queue):
+    bounces = Bounces()
+    queue = make_queue(FakeDelivery({'gone@example.test': [permanent]}), bounce=bounces)
+    queue.start()
+    queue.enqueue('', ['gone@example.test'], MESSAGE, ROUTE)
+    wait_for(lambda: not len(queue))
+    assert bounces == []
+
+
+def test_retry_waits_for_the_backoff(make_queue):
+    deliver = FakeDelivery({'b@example.test': [temporary]})
+    queue = make_queue(deliver, base_delay=60)
+    queue.start()
+    msg_id = queue.enqueue('me@example.test', ['b@example.test'], MESSAGE, ROUTE)
+    wait_for(lambda: queue.pending()[0].attempts == 1)
+    entry = queue.pending()[0]
+    assert entry.id == msg_id
+    assert entry.last_error == '451 Try again later'
+    # Half of the delay is random
+    assert 30 <= entry.next_attempt - time.time() <= 60
+    assert len(deliver.attempts) == 1
+
+
+def test_queue_survives_a_restart(make_queue):
+    first = make_queue(FakeDelivery())
+    msg_id = first.enqueue('me@example.test', ['a@example.test'], MESSAGE, ROUTE)
+    
+    deliver = FakeDelivery()
+    queue = make_queue(deliver)
+    queue.start()
+    wait_for(lambda: deliver.delivered)
+    assert deliver.delivered == ['a@example.test']
+    wait_for(lambda: msg_id not in queue)
+
+
+def test_relay_messages_wait_for_a_password(make_queue):
+    make_queue(FakeDelivery()).enqueue('me@example.test', ['a@example.test'], MESSAGE,
+                                       RELAY, password='secret')
+    
+    # After a restart the password is gone
+    deliver = FakeDelivery()
+    queue = make_queue(deliver)
+    queue.start()
+    wait_for(lambda: queue.held())
+    assert deliver.attempts == []
+    
+    queue.set_password(RELAY, 'secret')
+    wait_for(lambda: not len(queue))
+    assert deliver.attempts == [(['a@example.test'], 'secret')]
+
+
+def test_cancel_removes_a_waiting_message(make_queue, tmp_path):
+    deliver = FakeDelivery({'b@example.test': [temporary]})
+    queue = make_queue(deliver, base_delay=60)
+    queue.start()
+    msg_id = queue.enqueue('me@example.test', ['b@example.test'], MESSAGE, ROUTE)
+    wait_for(lambda: len(deliver.attempts) == 1 and queue.pending()[0].attempts == 1)
+    assert queue.cancel(msg_id)
+    assert msg_id not in queue
+    assert os.listdir(tmp_path) == []
+    assert not queue.cancel(msg_id)
+
+
+def test_shutdown_does_not_count_an_interrupted_attempt(make_queue, monkeypatch):
+    started = []
+    
+    async def hang(*args, **kwargs):
+        started.append(args)
+        await asyncio.sleep(60)
+    
+    monkeypatch.setattr('src.outbound_queue.SMTPSender.deliver_async', hang)
+    send_loop = SendLoop()
+    send_loop.start()
+    try:
+        queue = make_queue(None, send_loop=send_loop)
+        queue.start()
+        msg_id = queue.enqueue('me@example.test', ['a@example.test'], MESSAGE, ROUTE)
+        wait_for(lambda: started)
+    finally:
+        # Ends the attempt before the queue is told to stop
+        send_loop.stop()
+    queue.stop()
+    
+    # Not an attempt: the next start sends it as if for the first time
+    restarted = make_queue(FakeDelivery())
+    restarted._recover()
+    [entry] = restarted.pending()
+    assert entry.id == msg_id
+    assert entry.attempts == 0 and entry.last_error is None
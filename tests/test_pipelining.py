@@ -0,0 +1,82 @@
+import smtplib
+
+import pytest
+
+from src.mime_writer import PIPELINE_BATCH, Envelope
+
+
+MESSAGE = b'Subject: Test\r\n\r\nHello\r\n'
+
+
+def test_sends_to_every_recipient(client, smtp_server):
+    handler, _ = smtp_server
+    recipients = [f'user{i}@example.test' for i in range(250)]
+    assert client('a@example.test', recipients, MESSAGE) == {}
+    assert handler.received == [('a@example.test', recipients, MESSAGE)]
+    assert client.after == 250
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_pipelining_batches_commands(client, smtp_server, pipelining):
+    handler, _ = smtp_server
+    handler.pipelining = pipelining
+    recipients = [f'user{i}@example.test' for i in range(250)]
+    client('a@example.test', recipients, MESSAGE)
+    if client.kind == 'sync':
+        # MAIL, the RCPTs and DATA
+        commands = len(recipients) + 2
+        batches = -(-commands // PIPELINE_BATCH) if pipelining else commands
+        # EHLO, one write per batch, and the message with its final dot
+        assert client.writes == 1 + batches + 1
+    assert handler.received[0][1] == recipients
+
+
+def test_refused_recipients_are_returned(client, smtp_server):
+    handler, _ = smtp_server
+    refused = client('a@example.test', ['ok@example.test', 'bad@example.test'], MESSAGE)
+    assert list(refused) == ['bad@example.test']
+    assert refused['bad@example.test'][0] == 550
+    assert handler.received[0][1] == ['ok@example.test']
+
+
+def test_all_recipients_refused(client, smtp_server):
+    handler, _ = smtp_server
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as info:
+        client('a@example.test', ['bad1@example.test', 'bad2@example.test'], MESSAGE)
+    assert set(info.value.recipients) == {'bad1@example.test', 'bad2@example.test'}
+    assert handler.received == []
+    # The pipelined DATA was ended and the session reset
+    assert client.after == 250
+
+
+def test_sender_refused(client, smtp_server):
+    handler, _ = smtp_server
+    with pytest.raises(smtplib.SMTPSenderRefused) as info:
+        client('refuse@example.test', ['ok@example.test'], MESSAGE)
+    assert info.value.smtp_code == 550
+    assert handler.commands == ['MAIL']
+    assert client.after == 250
+
+
+def test_421_closes_the_session(client, smtp_server):
+    handler, _ = smtp_server
+    recipients = ['ok@example.test', 'shut@example.test', 'later@example.test']
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as info:
+        client('a@example.test', recipients, MESSAGE)
+    assert info.value.recipients['shut@example.test'][0] == 421
+    assert handler.received == []
+    assert client.after is smtplib.SMTPServerDisconnected
+
+
+def test_leading_dots_survive_pipelined_data(client, smtp_server):
+    handler, _ = smtp_server
+    message = b'Subject: Dots\r\n\r\n.hidden\r\n..two\r\n.\r\nend\r\n'
+    client('a@example.test', ['ok@example.test'], message)
+    assert handler.received[0][2] == message
+
+
+def test_envelope_quotes_addresses():
+    envelope = Envelope('Sender <a@example.test>', ['b@example.test'], 10,
+                        lambda name: name in ('size', 'pipelining'))
+    assert envelope.commands == ['MAIL FROM:<a@example.test> SIZE=10',
+                                 'RCPT TO:<b@example.test>', 'DATA']
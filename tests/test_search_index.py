@@ -0,0 +1,129 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from src.mail_store import MailStore
+from src.search_index import SearchIndex
+
+
+MESSAGES = [
+    ('alice@example.test', 'Quarterly report', 'Numbers for the first quarter', (2024, 1, 10)),
+    ('bob@example.test', 'Lunch', 'Pizza on Friday?', (2024, 2, 5)),
+    ('alice@example.test', 'Lunch plans', 'Sushi this time', (2024, 3, 1)),
+]
+
+
+def raw(sender, subject, body):
+    return (f'From: {sender}\r\nTo: team@example.test\r\nSubject: {subject}\r\n\r\n'
+            f'{body}\r\n').encode()
+
+
+def wait_indexed(index, msg_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while index.mark < msg_id:
+        assert time.monotonic() < deadline, "indexer did not catch up"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MailStore(str(tmp_path / 'store'))
+    store.ids = [store.append(raw(sender, subject, body),
+                              {'from': sender, 'to': ['team@example.test'], 'subject': subject},
+                              timestamp=datetime(*day).timestamp())
+                 for sender, subject, body, day in MESSAGES]
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def index(store):
+    index = SearchIndex(store)
+    wait_indexed(index, store.ids[-1])
+    yield index
+    index.close()
+
+
+def test_words_match_any_field_newest_first(store, index):
+    assert index.search('lunch') == [store.ids[2], store.ids[1]]
+    assert index.search('pizza') == [store.ids[1]]
+    assert index.search('nothing') == []
+
+
+def test_field_terms_and_all_terms_must_match(store, index):
+    assert index.search('from:alice') == [store.ids[2], store.ids[0]]
+    assert index.search('from:alice lunch') == [store.ids[2]]
+    assert index.search('subject:sushi') == []
+    assert index.search('body:sushi') == [store.ids[2]]
+
+
+def test_date_ranges(store, index):
+    assert index.search('after:2024-02-01') == [store.ids[2], store.ids[1]]
+    assert index.search('before:2024-02-05') == [store.ids[1], store.ids[0]]
+    assert index.search('lunch before:2024-02-28') == [store.ids[1]]
+
+
+def test_deleted_messages_are_not_returned(store, index):
+    store.delete(store.ids[2])
+    assert index.search('lunch') == [store.ids[1]]
+
+
+def test_new_mail_is_indexed(store, index):
+    msg_id = store.append(raw('carol@example.test', 'Lunch', 'Tacos'),
+                          {'from': 'carol@example.test', 'to': ['team@example.test'],
+                           'subject': 'Lunch'})
+    index.message_received(store.get(msg_id))
+    wait_indexed(index, msg_id)
+    assert index.search('tacos') == [msg_id]
+
+
+def test_index_survives_a_restart(store):
+    index = SearchIndex(store)
+    wait_indexed(index, store.ids[-1])
+    index.close()
+    reopened = SearchIndex(store)
+    try:
+        assert reopened.mark == store.ids[-1]
+        assert reopened.search('from:bob') == [store.ids[1]]
+    finally:
+        reopened.close()
+
+
+def append(store, subject, body):
+    return store.append(raw('dave@example.test', subject, body),
+                        {'from': 'dave@example.test', 'to': ['team@example.test'],
+                         'subject': subject})
+
+
+def wait_found(index, query, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not index.search(query):
+        assert time.monotonic() < deadline, f"{query!r} was never indexed"
+        time.sleep(0.01)
+    return index.search(query)
+
+
+def test_notifications_out_of_order(store, index):
+    alpha = append(store, 'Alpha', 'first')
+    beta = append(store, 'Beta', 'second')
+    # Committed by different threads, the later id is announced first
+    index.message_received(store.get(beta))
+    index.message_received(store.get(alpha))
+    assert wait_found(index, 'alpha') == [alpha]
+    assert wait_found(index, 'beta') == [beta]
+
+
+def test_restart_indexes_ids_below_the_mark(store, index):
+    alpha = append(store, 'Alpha', 'first')
+    beta = append(store, 'Beta', 'second')
+    # Alpha's notification never arrived before the shutdown
+    index.add(beta)
+    index.close()
+    
+    reopened = SearchIndex(store)
+    try:
+        assert wait_found(reopened, 'alpha') == [alpha]
+        assert reopened.search('beta') == [beta]
+    finally:
+        reopened.close()
@@ -0,0 +1,66 @@
+import smtplib
+import time
+
+import pytest
+
+from src.benchmark import free_port
+from src.mail_store import MailStore
+from src.server_manager import ServerManager
+from src.sink import MessageSink
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    store = MailStore(str(tmp_path))
+    manager = ServerManager(store, MessageSink(), limits={'max_sessions': 1})
+    port = free_port()
+    ok, message = manager.start('127.0.0.1', port)
+    assert ok, message
+    try:
+        yield manager, port
+    finally:
+        manager.stop()
+        store.close()
+
+
+def test_restart_keeps_counting_sessions_left_on_the_old_listeners(manager):
+    manager, port = manager
+    admission = manager.admission
+    first = smtplib.SMTP('127.0.0.1', port)
+    try:
+        assert first.noop()[0] == 250
+        ok, message = manager.restart()
+        assert ok, message
+        assert manager.admission is admission
+        
+        # The session still open on the retired group holds the only slot
+        with pytest.raises(smtplib.SMTPConnectError) as info:
+            smtplib.SMTP('127.0.0.1', port)
+        assert info.value.smtp_code == 421
+    finally:
+        first.quit()
+    
+    wait_for(lambda: admission.sessions == 0)
+    second = smtplib.SMTP('127.0.0.1', port)
+    assert second.noop()[0] == 250
+    second.quit()
+
+
+def test_restart_applies_new_limits_to_open_sessions(manager):
+    manager, port = manager
+    first = smtplib.SMTP('127.0.0.1', port)
+    try:
+        ok, message = manager.restart(limits={'max_sessions': 2})
+        assert ok, message
+        second = smtplib.SMTP('127.0.0.1', port)
+        assert second.noop()[0] == 250
+        second.quit()
+    finally:
+        first.quit()
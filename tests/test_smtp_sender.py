@@ -0,0 +1,41 @@
+import smtplib
+
+from src.smtp_sender import SMTPSender
+
+
+MESSAGE = b'From: me@example.test\r\nSubject: Hello\r\n\r\nHi\r\n'
+
+
+class FakeResolver:
+    def __init__(self, hosts):
+        self.hosts = hosts
+    
+    def lookup(self, domain):
+        return self.hosts[domain]
+
+
+def test_421_is_reported_not_the_failed_quit(smtp_server):
+    _, port = smtp_server
+    route = {'mode': 'local', 'host': '127.0.0.1', 'port': port}
+    errors = SMTPSender.deliver(route, 'me@example.test', ['shut@example.test'], MESSAGE)
+    error = errors['shut@example.test']
+    assert isinstance(error, smtplib.SMTPRecipientsRefused)
+    assert error.recipients['shut@example.test'][0] == 421
+
+
+def test_domains_sharing_a_preferred_host_keep_their_backups(monkeypatch):
+    tried = {}
+    
+    def deliver(mx_hosts, limit, sender, recipients, data, logger):
+        for recipient in recipients:
+            tried[recipient] = mx_hosts
+        return {}
+    
+    monkeypatch.setattr(SMTPSender, '_deliver', staticmethod(deliver))
+    resolver = FakeResolver({'a.test': ['mx.shared.test', 'backup-a.test'],
+                             'b.test': ['mx.shared.test', 'backup-b.test']})
+    errors = SMTPSender.deliver_direct('me@example.test', ['x@a.test', 'y@b.test'], MESSAGE,
+                                       lambda message: None, resolver=resolver)
+    assert errors == {}
+    assert tried == {'x@a.test': ('mx.shared.test', 'backup-a.test'),
+                     'y@b.test': ('mx.shared.test', 'backup-b.test')}
@@ -0,0 +1,109 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import src.workers as workers
+from src.mail_store import MailStore
+from src.sink import MessageSink
+from src.workers import MAX_START_FAILURES, WorkerPool
+
+
+META = {'from': 'sender@example.test', 'to': ['rcpt@example.test'], 'subject': 'Hello',
+        'peer': ('127.0.0.1', 25)}
+
+
+class RecordingSink(MessageSink):
+    def __init__(self):
+        self.lines = []
+    
+    def log(self, message, level=logging.INFO):
+        self.lines.append(message)
+
+
+class DeadProcess:
+    """A worker process that exited before it started listening"""
+    
+    pids = itertools.count(1000)
+    
+    def __init__(self):
+        self.pid = next(self.pids)
+        self.exitcode = 1
+    
+    def is_alive(self):
+        return False
+    
+    def join(self, timeout=None):
+        pass
+
+
+def pool_for(tmp_path, sink=None):
+    store = MailStore(str(tmp_path / 'store'))
+    pool = WorkerPool(store, sink or MessageSink(), 'localhost', 0, 1)
+    pool._replies = [queue.Queue()]
+    return store, pool
+
+
+def spooled(tmp_path):
+    path = tmp_path / 'spooled.eml'
+    path.write_bytes(b'Subject: Hello\r\n\r\nbody\r\n')
+    return str(path)
+
+
+def replies(pool):
+    items = []
+    while not pool._replies[0].empty():
+        items.append(pool._replies[0].get_nowait())
+    return items
+
+
+def test_commit_takes_message_before_deadline(tmp_path):
+    store, pool = pool_for(tmp_path)
+    try:
+        pool._commit(0, 'r1', time.monotonic() + 60, spooled(tmp_path), META, 1000.0, [], [])
+        assert replies(pool) == [('r1', 'taken', None), ('r1', 'stored', None)]
+        assert len(store) == 1
+    finally:
+        store.close()
+
+
+def test_commit_drops_message_after_deadline(tmp_path):
+    store, pool = pool_for(tmp_path)
+    try:
+        path = spooled(tmp_path)
+        pool._commit(0, 'r1', time.monotonic() - 1, path, META, 1000.0, [], [])
+        # The worker answered 451, so storing it would duplicate the retry
+        assert replies(pool) == [('r1', 'expired', None)]
+        assert len(store) == 0
+        assert not (tmp_path / 'spooled.eml').exists()
+    finally:
+        store.close()
+
+
+def test_supervisor_gives_up_on_workers_that_never_start(tmp_path, monkeypatch):
+    monkeypatch.setattr(workers, 'SUPERVISE_INTERVAL', 0.01)
+    monkeypatch.setattr(workers, 'RESTART_BACKOFF', 0.01)
+    sink = RecordingSink()
+    store, pool = pool_for(tmp_path, sink)
+    spawned = []
+    
+    def spawn(slot):
+        spawned.append(slot)
+        return DeadProcess()
+    
+    pool._spawn = spawn
+    pool._processes = [DeadProcess()]
+    supervisor = threading.Thread(target=pool._supervise)
+    supervisor.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not any('not restarting' in line for line in sink.lines):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        time.sleep(0.1)
+        assert len(spawned) == MAX_START_FAILURES - 1
+    finally:
+        pool._stopping.set()
+        supervisor.join()
+        store.close()